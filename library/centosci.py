@@ -22,22 +22,82 @@ version_added: "1.6"
 short_description: Allocate and release hosts on the CentOS CI environment
 description:
    - Allocate and release hosts on the CentOS CI environment
+   - When no (suitable) hosts are available, the request is retried with
+     exponential backoff until the timeout. Sessions with unsuitable hosts
+     are returned right away, with one call per session.
+options:
+   request:
+     description:
+        - get hosts, or return them as done or failed
+     choices: ['get', 'done', 'fail']
+     default: get
+   url:
+     description:
+        - URL of the Duffy API
+     required: true
+   ver:
+     description:
+        - CentOS version of the hosts
+     default: 7
+   arch:
+     description:
+        - Architecture of the hosts
+     choices: ['x86_64', 'i386']
+     default: x86_64
+   count:
+     description:
+        - Number of hosts to get
+     default: 1
+   ssid:
+     description:
+        - Session of the hosts to return
+   ram_gb:
+     description:
+        - Memory needed, above 16 GB hufty nodes are not used
+     default: 1
+   timeout:
+     description:
+        - Seconds to keep trying to get the hosts
+     default: 600
+   retry_delay:
+     description:
+        - Seconds to wait before the first retry, doubled for each
+          retry up to retry_delay_max
+     default: 10
+   retry_delay_max:
+     description:
+        - Longest wait between retries, in seconds
+     default: 120
 '''
 
 EXAMPLES = '''
 # Allocate and release hosts on the CentOS CI environment
 - centosci:
+    request: get
+    url: http://admin.ci.centos.org:8080/
+    count: 2
+    ram_gb: 32
+  register: centosci_hosts
+
+- centosci:
+    request: done
+    url: http://admin.ci.centos.org:8080/
+    ssid: "{{ item }}"
+  with_items: centosci_hosts.ssids
 '''
 
 import os
+import time
 import urllib2
 
+HUGE_RAM_GB = 16
+
 
 def get_hosts(url, key, ver, arch, count):
     url_elements = [url, "Node/get",
                     "?key=", key,
                     "&arch=", arch,
-                    "$ver=", ver,
+                    "&ver=", ver,
                     "&count=", count]
     req = urllib2.Request(''.join(url_elements))
     req.add_header('Accept', 'application/json')
@@ -47,7 +107,7 @@ def get_hosts(url, key, ver, arch, count):
         return {'failed': True,
                 "msg": "API call failed. " +
                        "url: " + ''.join(url_elements) +
-                       "reason: " + str(e.reason)}
+                       "reason: " + str(getattr(e, 'reason', e))}
     raw_data = result.read()
     try:
         data = json.loads(raw_data)
@@ -55,15 +115,20 @@ def get_hosts(url, key, ver, arch, count):
         return {'failed': True,
                 "msg": "Can't parse reply from the server as JSON. "
                        "Reply was: " + raw_data}
-    if len(data["hosts"]) != int(count):
+    if not isinstance(data, dict) or "hosts" not in data:
+        # e.g. "Failed to allocate nodes" when there are none available
         return {'failed': True,
-                "msg": "Mismatch between requested and issued host count."}
+                "msg": "No hosts issued. Reply was: " + raw_data}
     host_list = [{"name": "host" + str(i),
                   "hostname": data["hosts"][i]}
                  for i in xrange(len(data["hosts"]))]
-    return {"changed": True,
-            "hosts": host_list,
-            "ssid": data["ssid"]}
+    result = {"changed": True,
+              "hosts": host_list,
+              "ssid": data["ssid"]}
+    if len(data["hosts"]) != int(count):
+        result.update(failed=True,
+                      msg="Mismatch between requested and issued host count.")
+    return result
 
 
 def return_hosts(url, type_, key, ssid):
@@ -75,10 +140,74 @@ def return_hosts(url, type_, key, ssid):
     except urllib2.URLError, e:
         return {'failed': True,
                 "msg": "API call failed. "
-                       "Reason: " + str(e.reason)}
+                       "Reason: " + str(getattr(e, 'reason', e))}
     return {"changed": True}
 
 
+def suitable(hostname, ram_gb):
+    # hufty nodes don't have the memory for rdo-manager jobs
+    return ram_gb <= HUGE_RAM_GB or 'hufty' not in hostname
+
+
+def reserve_hosts(module, key):
+    '''
+    Gets `count` suitable hosts. The hosts are requested in one batch,
+    a session with unsuitable hosts is returned as a whole (the API
+    releases hosts per session) and the missing hosts are requested again
+    after a backoff, until the timeout.
+    '''
+    params = module.params
+    count = int(params["count"])
+    start = time.time()
+    deadline = start + params["timeout"]
+    delay = params["retry_delay"]
+    sessions = []
+    hosts = []
+    rejected = []
+    attempts = 0
+    last_error = None
+    while len(hosts) < count:
+        attempts += 1
+        result = get_hosts(params["url"], key, params["ver"], params["arch"],
+                           str(count - len(hosts)))
+        issued = [host["hostname"] for host in result.get("hosts", [])]
+        unsuitable = [hostname for hostname in issued
+                      if not suitable(hostname, params["ram_gb"])]
+        if result.get("failed") or unsuitable:
+            if "ssid" in result:
+                returned = return_hosts(params["url"], 'done', key,
+                                        result["ssid"])
+                if returned.get("failed"):
+                    return dict(returned, hosts=hosts, ssids=sessions,
+                                attempts=attempts)
+            rejected.extend(unsuitable)
+            last_error = result.get("msg") or (
+                "Unsuitable hosts: " + ', '.join(unsuitable))
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, params["retry_delay_max"])
+            continue
+        sessions.append(result["ssid"])
+        hosts.extend(issued)
+
+    result = {"changed": bool(sessions) or bool(rejected),
+              "hosts": [{"name": "host" + str(i), "hostname": hostname}
+                        for i, hostname in enumerate(hosts)],
+              "ssid": sessions[0] if sessions else None,
+              "ssids": sessions,
+              "rejected": rejected,
+              "attempts": attempts,
+              "elapsed": round(time.time() - start, 1)}
+    if len(hosts) < count:
+        result.update(failed=True,
+                      msg="Got %d of %d hosts after %d attempts in %ds: %s" % (
+                          len(hosts), count, attempts, result["elapsed"],
+                          last_error))
+    return result
+
+
 def main():
     module = AnsibleModule(
         argument_spec=dict(
@@ -88,6 +217,9 @@ def main():
             ver=dict(default="7", type='str'),
             arch=dict(default='x86_64', choices=['x86_64', 'i386']),
             count=dict(default='1', type='str'),
+            timeout=dict(default=600, type='int'),
+            retry_delay=dict(default=10, type='int'),
+            retry_delay_max=dict(default=120, type='int'),
             # needed for done or fail
             ssid=dict(default=None, type='str'),
             # needed for selecting non-hufty nodes for rdo-manager jobs
@@ -98,22 +230,14 @@ def main():
     if key is None:
         module.fail_json(msg="Set the PROVISIONER_KEY environment variable.")
     if module.params["request"] == "get":
-        result = None
-        while result is None:
-            result = get_hosts(module.params["url"],
-                               key,
-                               module.params["ver"],
-                               module.params["arch"],
-                               module.params["count"])
-            if module.params.get("ram_gb", 1) > 16 and 'hufty' in result['hosts'][0]['hostname']:
-                return_hosts(module.params["url"], 'done', result['ssid'])
-                result = None
-
+        result = reserve_hosts(module, key)
     else:
         result = return_hosts(module.params["url"],
                               module.params["request"],
                               key,
                               module.params["ssid"])
+    if result.get("failed"):
+        module.fail_json(**result)
     module.exit_json(**result)
 
 # see http://docs.ansible.com/developing_modules.html#common-module-boilerplate
@@ -0,0 +1,416 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# (c) 2016, Red Hat, Inc.
+#
+# This module is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: collect_diagnostics
+short_description: Collect command outputs and files of a host in one archive
+description:
+  - Runs the diagnostic commands concurrently, each with its own timeout,
+    and writes their outputs and the files into one tar archive, with a
+    manifest.json of the commands (exit codes, durations, sizes) and of
+    the files which could not be read.
+  - The archive members are under a top directory (prefix), the outputs
+    and files at their path without the leading slash, like
+    C(cp -rL --parents) would copy them. Symlinks are followed.
+version_added: "1.9"
+options:
+  dest:
+    description:
+    - The archive to write, gzip compressed unless it ends with .tar
+    required: true
+  prefix:
+    description:
+    - The top directory in the archive, by default the name of dest
+      without the .tar/.tar.gz/.tgz extension
+    required: false
+  commands:
+    description:
+    - List of commands, dictionaries with cmd (run by bash), name (the path
+      of its output in the archive, stdout and stderr together), timeout
+      (seconds, default the timeout option) and fact (a fact set to the
+      lines of the standard output instead of archiving it, the standard
+      error is returned as stderr of the command; the fact is an empty
+      list when the collection fails). Either name or fact is required.
+    required: false
+    default: []
+  files:
+    description:
+    - Files and directories (recursively) to archive after the commands
+      ran, shell patterns are expanded, missing ones are skipped
+    required: false
+    default: []
+  gzip_members:
+    description:
+    - Gzip every member (adding .gz to its name) instead of the whole
+      archive, dest should then end with .tar
+    required: false
+    default: no
+  timeout:
+    description:
+    - Default timeout of the commands, in seconds
+    required: false
+    default: 300
+  jobs:
+    description:
+    - How many commands run at the same time
+    required: false
+    default: 8
+  incremental:
+    description:
+    - Record the sha1, size and mtime of the archived files in the
+      manifest (as hashes), and leave out the files which did not change
+      since the collection described by previous
+    required: false
+    default: no
+  previous:
+    description:
+    - The hashes of the previous collection (path in the archive ->
+      [sha1, size, mtime]), a file with the same size and mtime or the
+      same sha1 is not archived again
+    required: false
+    default: {}
+'''
+
+EXAMPLES = '''
+- collect_diagnostics:
+    dest: /tmp/{{ inventory_hostname }}.tar.gz
+    commands:
+      - name: var/log/extra/lsof
+        cmd: lsof -P
+      - name: var/log/extra/lvm
+        cmd: vgs; pvs; lvs
+        timeout: 30
+      - fact: oom_killer_problems_found
+        cmd: grep -v ansible-command /var/log/messages | grep oom-killer
+    files:
+      - /var/log/messages
+      - /etc/nova
+'''
+
+import glob
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import signal
+import subprocess
+import tarfile
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+
+# how often the running commands are checked for their timeout
+POLL_INTERVAL = 0.1
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+class _HashingReader(object):
+    """ Updates the digest with what is read from the file """
+
+    def __init__(self, fileobj, digest):
+        self.fileobj = fileobj
+        self.digest = digest
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+
+def _file_sha1(fileobj):
+    digest = hashlib.sha1()
+    for block in iter(lambda: fileobj.read(HASH_BLOCK_SIZE), ''):
+        digest.update(block)
+    return digest.hexdigest()
+
+
+class _FixedSizeReader(object):
+    """ Reads exactly size bytes of a file, padded with zeros if it got
+        shorter since its size was taken, so a log rotated or truncated
+        while archived can't break the tar stream """
+
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size)
+        if len(data) < size:
+            data += '\0' * (size - len(data))
+        self.remaining -= len(data)
+        return data
+
+
+def _run_command(spec, spool_dir, default_timeout):
+    """ Runs one command with its output in a spool file, killing it (and
+        its children) when it runs longer than its timeout """
+    timeout = spec.get('timeout') or default_timeout
+    spool = tempfile.NamedTemporaryFile(dir=spool_dir, delete=False)
+    result = dict(name=(spec.get('name') or '').lstrip('/') or None,
+                  fact=spec.get('fact'),
+                  cmd=spec['cmd'], spool=spool.name, timed_out=False)
+    # facts are made of the standard output only, like the stdout_lines
+    # of the shell module
+    stderr = subprocess.STDOUT
+    if result['fact']:
+        stderr = tempfile.TemporaryFile(dir=spool_dir)
+    start = time.time()
+    try:
+        proc = subprocess.Popen(['/bin/bash', '-c', spec['cmd']],
+                                stdin=open(os.devnull), stdout=spool,
+                                stderr=stderr, close_fds=True,
+                                preexec_fn=os.setsid)
+    except OSError, e:
+        if result['fact']:
+            stderr.close()
+            result['stderr'] = str(e)
+        else:
+            spool.write(str(e))
+        spool.close()
+        result.update(rc=None, duration=0.0, size=os.path.getsize(spool.name))
+        return result
+    while proc.poll() is None:
+        if time.time() - start > timeout:
+            result['timed_out'] = True
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            proc.wait()
+            break
+        time.sleep(POLL_INTERVAL)
+    spool.close()
+    if result['fact']:
+        stderr.seek(0)
+        result['stderr'] = stderr.read()
+        stderr.close()
+    result.update(rc=proc.returncode, duration=round(time.time() - start, 3),
+                  size=os.path.getsize(spool.name))
+    return result
+
+
+class Archive(object):
+    """ The tar archive being written, members are added as they are ready """
+
+    def __init__(self, dest, prefix, gzip_members, spool_dir, previous=None):
+        self.prefix = prefix
+        self.gzip_members = gzip_members
+        self.spool_dir = spool_dir
+        self.names = set()
+        # incremental when the previous hashes are given
+        self.previous = previous
+        self.hashes = {}
+        self.unchanged = 0
+        self.tmp = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(dest)), prefix='.', delete=False)
+        mode = 'w' if gzip_members or not dest.endswith(('.gz', '.tgz')) else 'w:gz'
+        self.tar = tarfile.open(fileobj=self.tmp, mode=mode)
+
+    def _gzipped(self, fileobj):
+        spool = tempfile.TemporaryFile(dir=self.spool_dir)
+        zipped = gzip.GzipFile(fileobj=spool, mode='wb')
+        shutil.copyfileobj(fileobj, zipped)
+        zipped.close()
+        spool.seek(0)
+        return spool
+
+    def add(self, name, fileobj, mtime=None, digest=None):
+        """ Adds the content of the open file at name (relative to the
+            prefix), with 644 permissions, updating digest with it """
+        self.names.add(name)
+        source = fileobj
+        if digest is not None:
+            source = _HashingReader(fileobj, digest)
+        if self.gzip_members:
+            fileobj = source = self._gzipped(source)
+            name += '.gz'
+        stat = os.fstat(fileobj.fileno())
+        info = tarfile.TarInfo(os.path.join(self.prefix, name))
+        info.size = stat.st_size
+        info.mtime = mtime or stat.st_mtime
+        info.mode = 0644
+        self.tar.addfile(info, _FixedSizeReader(source, info.size))
+
+    def add_data(self, name, data):
+        info = tarfile.TarInfo(os.path.join(self.prefix, name))
+        info.size = len(data)
+        info.mtime = time.time()
+        info.mode = 0644
+        self.tar.addfile(info, StringIO(data))
+
+    def add_path(self, path, errors):
+        """ Adds a file or a directory tree, following symlinks, recording
+            the unreadable ones in errors """
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path, followlinks=True):
+                for name in sorted(files):
+                    self.add_path(os.path.join(root, name), errors)
+            return
+        name = path.lstrip('/')
+        # fifos, sockets and devices are skipped
+        if name in self.names or name in self.hashes or not os.path.isfile(path):
+            return
+        try:
+            if self.previous is None:
+                with open(path, 'rb') as fileobj:
+                    self.add(name, fileobj)
+            else:
+                self._add_changed(name, path)
+        except (IOError, OSError), e:
+            errors.append(dict(path=path, error=str(e)))
+
+    def _add_changed(self, name, path):
+        """ Adds the file only if it changed since the previous collection,
+            recording its hash either way """
+        stat = os.stat(path)
+        entry = [None, stat.st_size, int(stat.st_mtime)]
+        previous = self.previous.get(name)
+        if previous and list(previous[1:]) == entry[1:]:
+            self.hashes[name] = list(previous)
+            self.unchanged += 1
+            return
+        with open(path, 'rb') as fileobj:
+            if previous:
+                # touched, or rewritten with the same content
+                entry[0] = _file_sha1(fileobj)
+                if entry[0] == previous[0]:
+                    self.hashes[name] = entry
+                    self.unchanged += 1
+                    return
+                fileobj.seek(0)
+            digest = hashlib.sha1()
+            self.add(name, fileobj, digest=digest)
+            entry[0] = digest.hexdigest()
+            self.hashes[name] = entry
+
+    def commit(self, dest):
+        self.tar.close()
+        self.tmp.close()
+        os.chmod(self.tmp.name, 0644)
+        os.rename(self.tmp.name, dest)
+
+    def abort(self):
+        self.tmp.close()
+        os.unlink(self.tmp.name)
+
+
+def _prefix(dest):
+    name = os.path.basename(dest)
+    for ext in ('.tar.gz', '.tgz', '.tar'):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            dest=dict(required=True),
+            prefix=dict(),
+            commands=dict(type='list', default=[]),
+            files=dict(type='list', default=[]),
+            gzip_members=dict(type='bool', default=False),
+            timeout=dict(type='int', default=300),
+            jobs=dict(type='int', default=8),
+            incremental=dict(type='bool', default=False),
+            previous=dict(type='dict', default={}),
+        )
+    )
+    if module.params['incremental'] and module.params['gzip_members']:
+        module.fail_json(msg='incremental archives are compressed as a whole, '
+                             'gzip_members is not supported with them')
+    dest = os.path.expanduser(module.params['dest'])
+    prefix = module.params['prefix'] or _prefix(dest)
+    commands = module.params['commands']
+    for spec in commands:
+        if not isinstance(spec, dict) or 'cmd' not in spec:
+            module.fail_json(msg='commands must be dictionaries with cmd: %s' % spec)
+        if not spec.get('name') and not spec.get('fact'):
+            module.fail_json(msg='command without name nor fact: %s' % spec['cmd'])
+
+    start = time.time()
+    # a failed collection must not leave the archive of the previous one
+    if os.path.exists(dest):
+        os.unlink(dest)
+    spool_dir = tempfile.mkdtemp(prefix='collect_diagnostics.')
+    # the facts are set even by a failed collection, tasks using them must
+    # not break on undefined variables
+    facts = dict((spec['fact'], []) for spec in commands if spec.get('fact'))
+    manifest = dict(commands=[], files=[], errors=[])
+    try:
+        previous = None
+        if module.params['incremental']:
+            previous = module.params['previous'] or {}
+        archive = Archive(dest, prefix, module.params['gzip_members'],
+                          spool_dir, previous)
+        try:
+            if commands:
+                pool = ThreadPool(max(1, min(module.params['jobs'], len(commands))))
+                try:
+                    # outputs are archived in the order the commands finish
+                    for result in pool.imap_unordered(
+                            lambda spec: _run_command(spec, spool_dir,
+                                                      module.params['timeout']),
+                            commands):
+                        spool = result.pop('spool')
+                        if result['fact']:
+                            with open(spool) as f:
+                                facts[result['fact']] = f.read().splitlines()
+                        else:
+                            with open(spool, 'rb') as f:
+                                archive.add(result['name'], f,
+                                            mtime=time.time())
+                        os.unlink(spool)
+                        manifest['commands'].append(result)
+                finally:
+                    pool.close()
+                    pool.join()
+
+            for pattern in module.params['files']:
+                for path in sorted(glob.glob(os.path.expanduser(pattern))):
+                    manifest['files'].append(path)
+                    archive.add_path(path, manifest['errors'])
+
+            manifest['duration'] = round(time.time() - start, 3)
+            if previous is not None:
+                manifest['hashes'] = archive.hashes
+                manifest['unchanged'] = archive.unchanged
+            archive.add_data('manifest.json', json.dumps(manifest, indent=2,
+                                                         sort_keys=True))
+            archive.commit(dest)
+        except Exception:
+            archive.abort()
+            raise
+    except (IOError, OSError), e:
+        module.fail_json(msg='Error writing %s: %s' % (dest, e),
+                         ansible_facts=facts)
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+    manifest['commands'].sort(key=lambda result: result['cmd'])
+    # the hashes are read from the archive, don't print them all
+    manifest.pop('hashes', None)
+    module.exit_json(changed=True, dest=dest, ansible_facts=facts, **manifest)
+
+from ansible.module_utils.basic import *
+main()
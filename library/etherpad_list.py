@@ -42,11 +42,23 @@ options:
   topic:
     description:
     - The top level yaml topic of the list. RESERVED - all, done
-    required: true
+    required: false
   contents:
     description:
-    - The new list to be merged with the existing list on the pad
-    required: true
+    - The new list to be merged with the existing list on the pad,
+      required with topic
+    required: false
+  topics:
+    description:
+    - A dictionary of topics and their new lists, all merged in one
+      update of the pad. Either topic and contents or topics is required
+    required: false
+  retries:
+    description:
+    - How many times the update is done again when someone else changed
+      the pad between its read and its write
+    required: false
+    default: 5
 examples:
   - description: Update horizon dependencies
     code: etherpad_list
@@ -55,6 +67,14 @@ examples:
             pad: 'test'
             topic: 'nova'
             contents: "{{ nova }}"
+  - description: Update several lists at once
+    code: etherpad_list
+            url: "{{ url }}"
+            key: '{{api_key}}'
+            pad: 'test'
+            topics:
+              nova: "{{ nova }}"
+              horizon: "{{ horizon }}"
 '''
 # ### CREDITS ###
 # Etherpad client **heavily** based on the popular pip package
@@ -65,15 +85,18 @@ examples:
 # ###
 
 from functools import partial
+import hashlib
 import json
 import re
+import socket
 import yaml
 try:
-    from urllib.request import urlopen
-    from urllib.parse import urlencode
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.parse import urlencode, urlparse
 except ImportError:
-    from urllib2 import urlopen
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
     from urllib import urlencode
+    from urlparse import urlparse
 
 
 class EtherpadResponseError(Exception):
@@ -86,6 +109,10 @@ class EtherpadApiError(Exception):
         self.code = code
 
 
+class EtherpadConflictError(Exception):
+    pass
+
+
 class EtherpadClient(object):
     def __init__(self, url, apikey, version='1', timeout=20, **kwargs):
         self.url = url
@@ -93,13 +120,48 @@ class EtherpadClient(object):
         self.timeout = timeout
         self.default_params = dict(**kwargs)
         self.default_params['apikey'] = apikey
+        self._conn = None
+
+    def _connection(self):
+        # one keep-alive connection for all the calls
+        if self._conn is None:
+            parsed = urlparse(self.url)
+            cls = HTTPSConnection if parsed.scheme == 'https' else HTTPConnection
+            self._conn = cls(parsed.netloc, timeout=self.timeout)
+        return self._conn
+
+    def _post(self, url, data):
+        path = urlparse(url).path
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        # the server may have closed the idle connection, try once again
+        # on a new one
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request('POST', path, data, headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (socket.error, HTTPException):
+                self.close()
+                if attempt:
+                    raise
+                continue
+            if response.status != 200:
+                raise EtherpadResponseError('API returned HTTP %s: %s' %
+                                            (response.status, response.reason))
+            return body.decode('utf-8')
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
 
     def __call__(self, api, **params):
         url = '%(url)s/%(version)s/%(api)s' % {
             "url": self.url, "version": self.version, "api": api
         }
         data = urlencode(dict(self.default_params, **params)).encode('ascii')
-        response = urlopen(url, data, self.timeout).read().decode('utf-8')
+        response = self._post(url, data)
 
         res = json.loads(response)
         if not res or not isinstance(res, dict):
@@ -128,33 +190,95 @@ class EtherpadListModule(object):
         self.pad_id = module.params['pad']
 
     def run(self):
-        # updates the existing list or creates a new list
-        # add the new items in 'contents' to the existing list for the topic
+        # updates the existing lists or creates new lists
+        # add the new items in 'contents' to the existing list of each topic
         # if a package seems to be removed in the new contents and
         # and is in 'done' topic, it gets removed in the new list
+        #
+        # the pad is read once and written once (or not at all when nothing
+        # changed), the write is done again on a fresh read if the pad got
+        # a new revision in between
 
-        self._ensure_pad_exists()
-        doc = self._parse_pad()
-
-        topic = self.module.params['topic']
-        new_contents = set(self.module.params['contents'])
-        done = doc['done']
+        topics = self._topics()
+        retries = self.module.params['retries']
+        try:
+            for attempt in range(retries + 1):
+                try:
+                    result = self._update(topics)
+                    break
+                except EtherpadConflictError:
+                    if attempt == retries:
+                        self.module.fail_json(
+                            msg='pad %s kept changing while updating it'
+                            % self.pad_id, attempts=attempt + 1)
+        except EtherpadApiError as e:
+            self.module.fail_json(msg=e.message, code=e.code)
+        except Exception as e:
+            self.module.fail_json(msg=str(e))
+        finally:
+            self.epad.close()
 
-        existing_list = set(doc.get(topic, []))
-        updated_list = existing_list.difference(done).union(new_contents)
-        contents_changed = existing_list != updated_list
+        result['attempts'] = attempt + 1
+        self.module.exit_json(**result)
 
-        if contents_changed:
-            doc[topic] = sorted(updated_list)
+    def _topics(self):
+        topics = dict(self.module.params['topics'] or {})
+        if self.module.params['topic']:
+            topics[self.module.params['topic']] = self.module.params['contents']
+        for topic in topics:
+            if topic in ('all', 'done'):
+                self.module.fail_json(msg='%s is a reserved topic' % topic)
+        return topics
+
+    def _update(self, topics):
+        revision, text = self._read_pad()
+        doc = self._parse_pad(text)
+        before = self._digest(doc)
+
+        changed_topics = []
+        for topic, contents in sorted(topics.items()):
+            existing_list = set(doc.get(topic, []))
+            updated_list = existing_list.difference(doc['done']).union(
+                contents or [])
+            if existing_list != updated_list:
+                doc[topic] = sorted(updated_list)
+                changed_topics.append(topic)
+        if changed_topics:
             doc['all'] = sorted(self._all_items(doc, ['all', 'done']))
-            updated_yaml = yaml.safe_dump(doc, default_flow_style=False)
+
+        updated_yaml = yaml.safe_dump(doc, default_flow_style=False)
+        changed = self._digest(doc, updated_yaml) != before
+        if changed:
+            # etherpad has no conditional write, check the revision we
+            # merged into is still the last one right before writing
+            if self._revision() != revision:
+                raise EtherpadConflictError()
             self.epad.setText(padID=self.pad_id, text=updated_yaml)
 
-        result = {'changed': contents_changed}
-        self.module.exit_json(**result)
+        return {'changed': changed, 'topics': changed_topics}
 
-    def _parse_pad(self):
-        text = self.epad.getText(padID=self.pad_id)['text']
+    def _digest(self, doc, dumped=None):
+        if dumped is None:
+            dumped = yaml.safe_dump(doc, default_flow_style=False)
+        return hashlib.sha1(dumped.encode('utf-8')).hexdigest()
+
+    def _revision(self):
+        return self.epad.getRevisionsCount(padID=self.pad_id)['revisions']
+
+    def _read_pad(self):
+        # returns the head revision and the text of the pad at that revision,
+        # the pad is created (empty) when it does not exist yet
+        try:
+            revision = self._revision()
+        except EtherpadApiError as e:
+            if e.code == 1 and 'does not exist' in e.message:
+                self._create_pad()
+                return self._revision(), ''
+            raise
+        text = self.epad.getText(padID=self.pad_id, rev=revision)['text']
+        return revision, text
+
+    def _parse_pad(self, text):
         doc = yaml.safe_load(text) or {'done': []}    # dict if text is empty
         if 'done' not in doc:
             doc['done'] = []
@@ -175,26 +299,29 @@ class EtherpadListModule(object):
             url += '/api'
         return url
 
-    def _ensure_pad_exists(self):
+    def _create_pad(self):
         try:
-            self.epad.createPad(padID=self.pad_id)
-            self.epad.setText(padID=self.pad_id, text='')
+            self.epad.createPad(padID=self.pad_id, text='')
         except EtherpadApiError as e:
-            if e.code == 1 and 'already exist' in e.message:
-                return
-            self.module.fail_json(msg=e.message, code=e.code)
-        except Exception as e:
-            self.module.fail_json(msg=e.message)
+            # created meanwhile by another writer
+            if not (e.code == 1 and 'already exist' in e.message):
+                raise
 
 
 def main():
-    module = AnsibleModule(argument_spec=dict(
-        url=dict(type='str', required=True),
-        key=dict(type='str', required=True),
-        pad=dict(type='str', required=True),
-        topic=dict(type='str', required=True),
-        contents=dict(type='list', required=True)
-    ))
+    module = AnsibleModule(
+        argument_spec=dict(
+            url=dict(type='str', required=True),
+            key=dict(type='str', required=True),
+            pad=dict(type='str', required=True),
+            topic=dict(type='str'),
+            contents=dict(type='list'),
+            topics=dict(type='dict'),
+            retries=dict(type='int', default=5)
+        ),
+        required_one_of=[['topic', 'topics']],
+        required_together=[['topic', 'contents']],
+    )
     EtherpadListModule(module).run()
 
 # this is magic, see lib/ansible/module_common.py
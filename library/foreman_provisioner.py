@@ -16,6 +16,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this software.  If not, see <http://www.gnu.org/licenses/>.
 
+import errno
+import select
+import socket
+import time
+from multiprocessing.pool import ThreadPool
+
 import requests
 
 
@@ -43,7 +49,12 @@ options:
    host_id:
      description:
          - Name or ID of the host as listed in foreman
-     required: true
+     required: false
+   host_ids:
+     description:
+         - List of names or IDs of hosts to rebuild at once, instead of
+           host_id. The result has the host details in 'hosts'.
+     required: false
    rebuild:
      description:
          - Should we rebuilt the requested host
@@ -65,6 +76,20 @@ options:
          - Whether we should wait for the host given the 'rebuild' state was set.
      default: true
      required: false
+   timeout:
+     description:
+         - Seconds to wait for the hosts to finish building.
+     default: 3600
+     required: false
+   jobs:
+     description:
+         - How many hosts are sent the rebuild requests at the same time.
+     default: 10
+     required: false
+notes:
+   - The result has the timeline of each rebuilt host (seconds from the
+     start when the rebuild was requested, the build finished and the
+     host was reachable) in 'timeline' or 'timelines'.
 '''
 
 
@@ -72,6 +97,11 @@ MIN_SUPPORTED_VERSION = 2
 FOREMAN_MGMT_SUPPORTED_STRATEGIES = ['foreman']
 WAIT_TO_FINISH_BUILDING = 10
 WAIT_TO_FINISH_BOOTING = 10
+# polling of building hosts slows down up to this while nothing changes
+MAX_WAIT_TO_FINISH_BUILDING = 60
+# a host is reachable when its ssh port answers, even with a reset
+REACHABILITY_PORT = 22
+REACHABILITY_TIMEOUT = 300
 
 
 class ForemanManager(object):
@@ -80,7 +110,8 @@ class ForemanManager(object):
     get / reserve hosts from foreman.
     *Foreman: http://theforeman.org/
     """
-    def __init__(self, url, username, password, extra_headers=None, version=2):
+    def __init__(self, url, username, password, extra_headers=None, version=2,
+                 pool_size=10):
         """
         :param url: the url of the foreman we wish to authenticate with
         :param username: the username we will use to login
@@ -89,6 +120,8 @@ class ForemanManager(object):
         http request
         :param version: the version of foreman API we wish to use (default: 2)
         :type version: int
+        :param pool_size: how many connections to foreman are kept open for
+        requests sent at the same time
         """
         if version < MIN_SUPPORTED_VERSION:
             raise Exception("API version: {0} "
@@ -96,6 +129,9 @@ class ForemanManager(object):
 
         self.session = requests.Session()
         self.session.auth = (username, password)
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
         headers = {'Accept': 'application/json',
                    'Content-type': 'application/json'}
@@ -199,41 +235,180 @@ class ForemanManager(object):
                 break
         return found_bmc
 
-    def provision(self, host_id, mgmt_strategy, mgmt_action,
-                  wait_for_host=True):
+    def start_rebuild(self, host_id, mgmt_strategy, mgmt_action):
         """
-        This method rebuilds a machine, doing so by running get_host and bmc.
+        This method starts the rebuild of a machine: sets its build flag and
+        power cycles it (or whatever mgmt_action is).
         :param host_id: the name or ID of the host we wish to rebuild
         :param mgmt_strategy: the way we wish to reboot the machine
         (i.e: foreman, ipmi, etc)
         :param mgmt_action: the action we wish to use with the strategy
         (e.g: cycle, reset, etc)
-        :param wait_for_host: whether the function will wait until host has
-        finished rebuilding before exiting.
         :raises: KeyError if BMC hasn't been found on the given host
-                 Exception in case of machine could not be reached after
-                 rebuild
         """
+        if mgmt_strategy != 'foreman':
+            raise Exception("{0} is not a supported "
+                            "management strategy".format(mgmt_strategy))
         if not self._validate_bmc(host_id):
             raise KeyError("BMC not found on {}".format(host_id))
         self.set_build_on_host(host_id, True)
-        if mgmt_strategy == 'foreman':
-            self.bmc(host_id, mgmt_action)
-        else:
-            raise Exception("{0} is not a supported "
-                            "management strategy".format(mgmt_strategy))
+        self.bmc(host_id, mgmt_action)
 
-        building_host = self.get_host(host_id)
-        if wait_for_host:
-            while building_host.get('build'):
-                time.sleep(WAIT_TO_FINISH_BUILDING)
-                building_host = self.get_host(host_id)
+    def provision(self, host_id, mgmt_strategy, mgmt_action,
+                  wait_for_host=True):
+        """
+        This method rebuilds a machine, see provision_many.
+        :raises: KeyError if BMC hasn't been found on the given host
+                 Exception in case of machine could not be reached after
+                 rebuild
+        """
+        timeline = self.provision_many([host_id], mgmt_strategy, mgmt_action,
+                                       wait_for_host)[host_id]
+        if 'error' in timeline:
+            if 'BMC not found' in timeline['error']:
+                raise KeyError(timeline['error'])
+            raise Exception(timeline['error'])
+        return timeline
+
+    def provision_many(self, host_ids, mgmt_strategy, mgmt_action,
+                       wait_for_host=True, timeout=3600, jobs=10):
+        """
+        This method rebuilds machines: starts the rebuilds of all of them
+        at once, then waits until they finish building and are reachable.
+        :param host_ids: names or IDs of the hosts we wish to rebuild
+        :param wait_for_host: whether the function will wait until hosts
+        have finished rebuilding before exiting.
+        :param timeout: seconds to wait for the hosts to finish building
+        :param jobs: how many rebuilds are requested at the same time
+        :returns: timeline of each host, seconds since the start of the
+        rebuild requested / built / reachable and 'error' if it failed
+        :rtype: dict of dictionaries
+        """
+        start = time.time()
+        timelines = dict((host_id, {}) for host_id in host_ids)
+
+        def rebuild(host_id):
+            try:
+                self.start_rebuild(host_id, mgmt_strategy, mgmt_action)
+            except Exception as e:
+                timelines[host_id]['error'] = e.args[0] if e.args else str(e)
+            else:
+                timelines[host_id]['rebuild_requested'] = round(
+                    time.time() - start, 1)
+
+        pool = ThreadPool(max(1, min(jobs, len(host_ids))))
+        try:
+            pool.map(rebuild, host_ids)
+        finally:
+            pool.close()
+            pool.join()
 
-            command = "ping -q -c 30 -w 300 {0}".format(building_host.get('ip'))
-            return_code = subprocess.call(command.split(" "))
+        if wait_for_host:
+            self._wait_for_hosts(
+                [host_id for host_id in host_ids
+                 if 'error' not in timelines[host_id]],
+                timelines, start, timeout)
+        return timelines
 
-            if return_code > 0:
-                raise Exception("Could not reach {0}".format(host_id))
+    def _wait_for_hosts(self, host_ids, timelines, start, timeout):
+        """
+        Polls the building hosts in one loop, checking the reachability
+        of the built ones in the meantime. The polling slows down while no
+        host changes and speeds up again when one does.
+        """
+        building = list(host_ids)
+        reaching = {}
+        interval = WAIT_TO_FINISH_BUILDING
+        deadline = start + timeout
+        while building or reaching:
+            changed = False
+            for host_id in list(building):
+                host = self.get_host(host_id)
+                if host.get('build'):
+                    continue
+                building.remove(host_id)
+                changed = True
+                timeline = timelines[host_id]
+                timeline['built'] = round(time.time() - start, 1)
+                timeline['ip'] = host.get('ip')
+                if not host.get('ip'):
+                    timeline['error'] = "No ip address of {0}".format(host_id)
+                    continue
+                reaching[host_id] = time.time() + REACHABILITY_TIMEOUT
+
+            if reaching:
+                # also the wait between the polls of the building hosts
+                reachable = _reachable(
+                    set(timelines[host_id]['ip'] for host_id in reaching),
+                    WAIT_TO_FINISH_BOOTING)
+                for host_id, reach_deadline in reaching.items():
+                    timeline = timelines[host_id]
+                    if timeline['ip'] in reachable:
+                        timeline['reachable'] = round(time.time() - start, 1)
+                        del reaching[host_id]
+                        changed = True
+                    elif time.time() >= reach_deadline:
+                        timeline['error'] = "Could not reach {0}".format(
+                            host_id)
+                        del reaching[host_id]
+
+            if building and time.time() >= deadline:
+                for host_id in building:
+                    timelines[host_id]['error'] = "{0} still building after " \
+                                                  "{1}s".format(host_id,
+                                                                timeout)
+                return
+            if changed:
+                interval = WAIT_TO_FINISH_BUILDING
+            elif building and not reaching:
+                time.sleep(min(interval, max(0, deadline - time.time())))
+                interval = min(interval * 1.5, MAX_WAIT_TO_FINISH_BUILDING)
+
+
+def _reachable(addresses, wait):
+    """
+    Connects to the ssh port of all the addresses at once.
+    :returns: the addresses which answered (accepted or refused) in `wait`
+    seconds
+    :rtype: set
+    """
+    reachable = set()
+    pending = {}
+    for address in addresses:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        try:
+            err = sock.connect_ex((address, REACHABILITY_PORT))
+        except socket.error:
+            sock.close()
+            continue
+        if err in (0, errno.ECONNREFUSED):
+            reachable.add(address)
+            sock.close()
+        elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            pending[sock] = address
+        else:
+            sock.close()
+
+    deadline = time.time() + wait
+    while pending:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        _, writable, _ = select.select([], pending.keys(), [], remaining)
+        for sock in writable:
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err in (0, errno.ECONNREFUSED):
+                reachable.add(pending[sock])
+            sock.close()
+            del pending[sock]
+    for sock in pending:
+        sock.close()
+    # the wait is also the polling interval of the caller
+    remaining = deadline - time.time()
+    if remaining > 0 and len(reachable) < len(addresses):
+        time.sleep(remaining)
+    return reachable
 
 
 def main():
@@ -242,38 +417,61 @@ def main():
             username=dict(default='admin'),
             password=dict(required=True),
             auth_url=dict(required=True),
-            host_id=dict(required=True),
+            host_id=dict(default=None),
+            host_ids=dict(default=None, type='list'),
             rebuild=dict(default=True, choices=BOOLEANS),
             mgmt_strategy=dict(default='foreman',
                                choices=FOREMAN_MGMT_SUPPORTED_STRATEGIES),
             mgmt_action=dict(default='cycle', choices=['on', 'off', 'cycle',
                                                        'reset', 'soft']),
-            wait_for_host=dict(default=True, choices=BOOLEANS)))
+            wait_for_host=dict(default=True, choices=BOOLEANS),
+            timeout=dict(default=3600, type='int'),
+            jobs=dict(default=10, type='int')),
+        required_one_of=[['host_id', 'host_ids']],
+        mutually_exclusive=[['host_id', 'host_ids']])
 
+    host_ids = module.params['host_ids'] or [module.params['host_id']]
     foreman_client = ForemanManager(url=module.params['auth_url'],
                                     username=module.params['username'],
-                                    password=module.params['password'])
+                                    password=module.params['password'],
+                                    pool_size=max(1, module.params['jobs']))
 
     status_changed = False
+    timelines = {}
+    errors = []
 
     if module.boolean(module.params['rebuild']):
-        try:
-            foreman_client.provision(module.params['host_id'],
-                                     module.params['mgmt_strategy'],
-                                     module.params['mgmt_action'],
-                                     module.boolean(
-                                         module.params['wait_for_host']))
-        except KeyError as e:
-            module.fail_json(msg=e.message)
-        else:
-            status_changed = True
+        timelines = foreman_client.provision_many(
+            host_ids,
+            module.params['mgmt_strategy'],
+            module.params['mgmt_action'],
+            module.boolean(module.params['wait_for_host']),
+            module.params['timeout'],
+            module.params['jobs'])
+        status_changed = any('rebuild_requested' in timeline
+                             for timeline in timelines.values())
+        errors = [timelines[host_id]['error'] for host_id in host_ids
+                  if 'error' in timelines[host_id]]
 
     #TODO(tkammer): implement RESERVE and RELEASE
-    host = foreman_client.get_host(module.params['host_id'])
-    if host.has_key('error'):
-        module.fail_json(msg=host['error'])
-
-    module.exit_json(changed=status_changed, host=host)
+    hosts = {}
+    for host_id in host_ids:
+        host = foreman_client.get_host(host_id)
+        if host.has_key('error'):
+            errors.append(host['error'])
+        hosts[host_id] = host
+
+    if module.params['host_id']:
+        result = dict(changed=status_changed,
+                      host=hosts[module.params['host_id']],
+                      timeline=timelines.get(module.params['host_id'], {}))
+    else:
+        result = dict(changed=status_changed, hosts=hosts,
+                      timelines=timelines)
+    if errors:
+        module.fail_json(msg='; '.join(str(error) for error in errors),
+                         **result)
+    module.exit_json(**result)
 
 
 from ansible.module_utils.basic import *
@@ -1,9 +1,22 @@
 #!/usr/bin/python
 #coding: utf-8 -*-
 
+import calendar
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
 try:
-    from time import sleep
+    from keystoneclient import access
+    from keystoneclient import exceptions as ks_exceptions
     from keystoneclient.v2_0 import client as ksclient
+    from heatclient import exc as heat_exc
     from heatclient.client import Client
     from heatclient.common import template_utils
     from heatclient.common import utils
@@ -60,6 +73,24 @@ options:
         - List of environment files that should be used for the stack creation
      required: false
      default: None
+   wait:
+     description:
+        - Wait until the stack is created or deleted, following its events.
+          Fails on the first failed resource, with the reason from its event.
+     required: false
+     default: yes
+   wait_for:
+     description:
+        - Names of existing stacks to wait on, until none of them is in
+          progress (e.g. stacks created or updated by a command). Used
+          instead of stack_name.
+     required: false
+     default: None
+   wait_timeout:
+     description:
+        - Seconds to wait for the stacks
+     required: false
+     default: 3600
 requirements: ["heatclient", "keystoneclient"]
 '''
 
@@ -75,6 +106,18 @@ EXAMPLES = '''
     login_tenant_name: admin
     tenant_name: admin
     template: /home/stack/test.yaml
+
+# Wait for the overcloud stack deployed by the command line client,
+# the result has the status and the timing of each resource
+- name: wait for the overcloud
+  heat_stack:
+    wait_for: [overcloud]
+    wait_timeout: 7200
+    login_username: admin
+    login_password: admin
+    auth_url: http://192.168.1.14:5000/v2.0
+    login_tenant_name: admin
+  register: overcloud_stack
 '''
 
 _os_keystone   = None
@@ -82,18 +125,130 @@ _os_tenant_id  = None
 _os_network_id = None
 _inc = 0
 
+# BEGIN keystone cache
+# Keystone tokens (with the service catalog) and the tenant ids listed with
+# them are cached on disk between the module runs, per auth_url and
+# credentials. Ansible 1.x modules can't share code, this block is repeated
+# in our modules using keystone and checked to be identical by
+# tools/check_module_blocks.sh. KHALEESI_KEYSTONE_CACHE set to empty string
+# disables the cache.
+KEYSTONE_CACHE = os.environ.get('KHALEESI_KEYSTONE_CACHE', os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'khaleesi', 'keystone.json'))
+# cached token is used only while it's valid at least this many seconds
+KEYSTONE_CACHE_MARGIN = 300
+
+_os_keystone_key = None
+# tenant name -> id, listed with the token
+_os_tenants = None
+# the token refused by a service was renewed
+_os_keystone_renewed = False
+
+def _keystone_cache_key(kwargs):
+    credentials = json.dumps([kwargs.get(name) for name in (
+        'auth_url', 'login_username', 'login_password', 'login_tenant_name')])
+    return hashlib.sha1(credentials).hexdigest()
+
+@contextlib.contextmanager
+def _keystone_cache():
+    # yields the cache locked against other jobs, writes it back if changed;
+    # it's held only to read or update the file, never around a request
+    if not KEYSTONE_CACHE:
+        yield {}
+        return
+    cache_dir = os.path.dirname(KEYSTONE_CACHE)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+    with open(KEYSTONE_CACHE + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(KEYSTONE_CACHE) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            cache = {}
+        before = json.dumps(cache, sort_keys=True)
+        yield cache
+        if json.dumps(cache, sort_keys=True) != before:
+            # readable only by the user, as mkstemp creates it
+            fd, tmp = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f)
+            os.rename(tmp, KEYSTONE_CACHE)
+
+def _keystone_cached(cache):
+    # the entry of our credentials if it still holds our token
+    entry = cache.get(_os_keystone_key)
+    if entry and access.AccessInfo.factory(
+            **entry['auth_ref']).auth_token == _os_keystone.auth_token:
+        return entry
+    return None
+
 def _get_ksclient(module, kwargs):
+    # a cached token is used without asking keystone, it's renewed only
+    # when a request made with it gets a 401, see _keystone_refused
+    global _os_keystone, _os_keystone_key, _os_tenants
+    _os_keystone_key = _keystone_cache_key(kwargs)
+    credentials = dict(username=kwargs.get('login_username'),
+                       password=kwargs.get('login_password'),
+                       tenant_name=kwargs.get('login_tenant_name'),
+                       auth_url=kwargs.get('auth_url'))
     try:
-        kclient = ksclient.Client(username=kwargs.get('login_username'),
-                                 password=kwargs.get('login_password'),
-                                 tenant_name=kwargs.get('login_tenant_name'),
-                                 auth_url=kwargs.get('auth_url'))
+        with _keystone_cache() as cache:
+            entry = cache.get(_os_keystone_key) or {}
+        auth_ref = entry.get('auth_ref')
+        if auth_ref and not access.AccessInfo.factory(
+                **auth_ref).will_expire_soon(KEYSTONE_CACHE_MARGIN):
+            kclient = ksclient.Client(auth_ref=auth_ref, **credentials)
+            _os_tenants = entry.get('tenants')
+        else:
+            kclient = ksclient.Client(**credentials)
+            _os_tenants = None
+            with _keystone_cache() as cache:
+                cache[_os_keystone_key] = {'auth_ref': dict(kclient.auth_ref)}
     except Exception, e:
-        module.fail_json(msg = "Error authenticating to the keystone: %s" %e.message)
-    global _os_keystone
+        module.fail_json(msg = "Error authenticating to the keystone: %s" % e)
     _os_keystone = kclient
     return kclient
 
+def _keystone_refused(module):
+    # the token was refused, revoked or of a cloud redeployed at the same
+    # URL: it's dropped and main() is run again from the start with a new
+    # token and tenant ids, our modules look at the state before changing
+    # it. Returns only if that's not possible, the token was renewed
+    # already or this is a worker thread.
+    global _os_keystone_renewed
+    if _os_keystone_renewed or threading.current_thread().name != 'MainThread':
+        return
+    _os_keystone_renewed = True
+    try:
+        with _keystone_cache() as cache:
+            if _keystone_cached(cache):
+                del cache[_os_keystone_key]
+    except Exception, e:
+        module.fail_json(msg = "Error renewing the keystone token: %s" % e)
+    main()
+
+def _get_tenant_id(module, tenant_name):
+    global _os_tenants
+    if tenant_name not in (_os_tenants or {}):
+        try:
+            _os_tenants = dict((tenant.name, tenant.id)
+                               for tenant in _os_keystone.tenants.list())
+            with _keystone_cache() as cache:
+                entry = _keystone_cached(cache)
+                if entry:
+                    entry['tenants'] = _os_tenants
+        except Exception, e:
+            if isinstance(e, ks_exceptions.Unauthorized):
+                _keystone_refused(module)
+            module.fail_json(msg = "Error in listing tenants: %s" % e)
+    return _os_tenants.get(tenant_name)
+# END keystone cache
+
 def _get_endpoint(module, ksclient):
     try:
         endpoint = ksclient.service_catalog.url_for(service_type='orchestration', endpoint_type='publicURL')
@@ -108,10 +263,7 @@ def _set_tenant_id(module):
     else:
         tenant_name = module.params['tenant_name']
 
-    for tenant in _os_keystone.tenants.list():
-        if tenant.name == tenant_name:
-            _os_tenant_id = tenant.id
-            break
+    _os_tenant_id = _get_tenant_id(module, tenant_name)
     if not _os_tenant_id:
             module.fail_json(msg = "The tenant id cannot be found, please check the parameters")
 
@@ -123,30 +275,183 @@ def _get_heat_client(module, kwargs):
         heat = Client('1', endpoint=endpoint, token=token)
     except Exception, e:
         module.fail_json(msg = " Error in connecting to heat: %s" % e.message)
+    # heatclient doesn't authenticate again when the token is refused
+    request = heat.http_client._http_request
+
+    def _http_request(*args, **kwargs):
+        try:
+            return request(*args, **kwargs)
+        except heat_exc.HTTPUnauthorized:
+            _keystone_refused(module)
+            raise
+    heat.http_client._http_request = _http_request
     return heat
 
+# BEGIN polling
+# Ansible 1.x modules can't share code, this block is repeated in our
+# modules polling OpenStack and checked to be identical by
+# tools/check_module_blocks.sh.
+def _polling(expire=None, first=1.0, cap=15.0):
+    '''
+    Yields until `expire` (forever when None) sleeping between the
+    iterations. The interval starts at `first` and grows by half each
+    time up to `cap`, with 20% jitter so parallel jobs don't poll in step.
+    '''
+    interval = first
+    while True:
+        yield
+        delay = interval * random.uniform(0.8, 1.2)
+        if expire is not None:
+            remaining = expire - time.time()
+            if remaining <= 0:
+                return
+            delay = min(delay, remaining)
+        time.sleep(delay)
+        interval = min(interval * 1.5, cap)
+# END polling
+
+# BEGIN stack watch
+# Waiting on stacks follows their event lists, each poll only fetches the
+# events after the last one seen (marker), so all the stacks are waited on
+# in one run instead of re-running the module from until loops. This block
+# is repeated in heat_stack and os_heat_stack and checked to be identical
+# by tools/check_module_blocks.sh.
+EVENT_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+STACK_STATES = ('_IN_PROGRESS', '_COMPLETE', '_FAILED')
+
+def _event_time(value):
+    # heat times are UTC, with or without fractions and zone
+    try:
+        return calendar.timegm(time.strptime(value[:19], EVENT_TIME_FORMAT))
+    except (TypeError, ValueError):
+        return None
+
+class _StackWatch(object):
+    """
+    Follows a stack until its action (CREATE, DELETE, ...) completes or
+    fails, or until it leaves any *_IN_PROGRESS status when the action is
+    None. Records the timing of the resources from the events and the
+    first failed resource.
+    """
+
+    def __init__(self, heat, stack, action=None):
+        self.heat = heat
+        self.name = stack.stack_name
+        self.id = stack.id
+        self.identifier = '%s/%s' % (stack.stack_name, stack.id)
+        self.action = action
+        self.status = stack.stack_status
+        self.reason = getattr(stack, 'stack_status_reason', None)
+        # events of earlier actions of the stack are not ours
+        self.since = _event_time(getattr(stack, 'updated_time', None) or
+                                 getattr(stack, 'creation_time', None))
+        self.marker = None
+        self.events = 0
+        self.resources = {}
+        self.failed = None
+        self.start = time.time()
+        self.duration = None
+
+    def done(self):
+        if self.failed is not None:
+            return True
+        if self.action:
+            return self.status in (self.action + '_COMPLETE',
+                                   self.action + '_FAILED')
+        return not self.status.endswith('_IN_PROGRESS')
+
+    def poll(self):
+        try:
+            stack = self.heat.stacks.get(self.identifier)
+        except Exception, e:
+            if getattr(e, 'code', None) != 404:
+                raise
+            self.status, self.reason = 'DELETE_COMPLETE', 'Stack not found'
+        else:
+            # events first, the stack status is at least as new as them
+            for event in self.heat.events.list(self.identifier,
+                                               marker=self.marker,
+                                               sort_dir='asc'):
+                self.marker = event.id
+                self.events += 1
+                self._record(event)
+            self.status = stack.stack_status
+            self.reason = getattr(stack, 'stack_status_reason', None)
+        if self.done():
+            self.duration = round(time.time() - self.start, 1)
+
+    def _record(self, event):
+        if getattr(event, 'physical_resource_id', None) == self.id:
+            return
+        when = _event_time(getattr(event, 'event_time', None))
+        if self.since and when and when < self.since:
+            return
+        status = event.resource_status
+        if self.action and not status.startswith(self.action + '_'):
+            return
+        resource = self.resources.setdefault(event.resource_name, {
+            'started': None, 'finished': None, 'duration': None})
+        if status.endswith('_IN_PROGRESS'):
+            if resource['finished'] or not resource['started']:
+                resource.update(started=event.event_time, finished=None,
+                                duration=None)
+        else:
+            resource['finished'] = event.event_time
+            started = _event_time(resource['started'])
+            if started is not None and when is not None:
+                resource['duration'] = when - started
+        resource['status'] = status
+        resource['reason'] = event.resource_status_reason
+        if status.endswith('_FAILED') and self.failed is None:
+            self.failed = (event.resource_name, event.resource_status_reason)
+
+    def result(self):
+        return dict(id=self.id, status=self.status, reason=self.reason,
+                    duration=self.duration, events=self.events,
+                    resources=self.resources)
+
+def _wait_stacks(module, watches, timeout):
+    '''
+    Polls the stacks until all are done, fails on the first failed
+    resource or stack, or once `timeout` seconds passed.
+    '''
+    results = lambda: dict((watch.name, watch.result()) for watch in watches)
+    pending = list(watches)
+    for _ in _polling(time.time() + timeout, first=2.0):
+        for watch in pending:
+            try:
+                watch.poll()
+            except Exception, e:
+                module.fail_json(msg="Error in polling stack %s: %s" % (watch.name, e),
+                                 stacks=results())
+            if watch.failed:
+                module.fail_json(msg="Stack %s failed: resource %s: %s" % (
+                    watch.name, watch.failed[0], watch.failed[1]), stacks=results())
+            if watch.status.endswith('_FAILED'):
+                module.fail_json(msg="Stack %s is %s: %s" % (
+                    watch.name, watch.status, watch.reason), stacks=results())
+        pending = [watch for watch in pending if not watch.done()]
+        if not pending:
+            return results()
+    module.fail_json(msg="Timeout waiting for stacks: %s" % ', '.join(
+        watch.name for watch in pending), stacks=results())
+# END stack watch
+
 def _create_stack(module, heat):
     heat.format = 'json'
     template_file = module.params['template']
     env_file = module.params['environment_files']
     tpl_files, template = template_utils.get_template_contents(template_file)
     env_files, env = template_utils.process_multiple_environments_and_files(env_paths=env_file)
-
-    stack = heat.stacks.create(stack_name=module.params['stack_name'],
-                               template=template,
-                               environment=env,
-                               files=dict(list(tpl_files.items()) + list(env_files.items())),
-                               parameters={})
-    uid = stack['stack']['id']
-
-    stack = heat.stacks.get(stack_id=uid).to_dict()
-    while stack['stack_status'] == 'CREATE_IN_PROGRESS':
-        stack = heat.stacks.get(stack_id=uid).to_dict()
-        sleep(5)
-    if stack['stack_status'] == 'CREATE_COMPLETE':
-        return stack['stack']['id']
-    else:
-        module.fail_json(msg = "Failure in creating stack: ".format(stack))
+    try:
+        stack = heat.stacks.create(stack_name=module.params['stack_name'],
+                                   template=template,
+                                   environment=env,
+                                   files=dict(list(tpl_files.items()) + list(env_files.items())),
+                                   parameters={})
+        return heat.stacks.get(stack['stack']['id'])
+    except Exception, e:
+        module.fail_json(msg = "Failure in creating stack: %s" % e)
 
 def _list_stack(module, heat):
     fields = ['id', 'stack_name', 'stack_status', 'creation_time',
@@ -155,48 +460,69 @@ def _list_stack(module, heat):
     stacks = heat.stacks.list()
     return utils.print_list(stacks, fields)
 
-def _delete_stack(module, heat):
-    heat.stacks.delete(module.param['stack_name'])
-    return _list_stack
+def _delete_stack(module, heat, stack):
+    try:
+        heat.stacks.delete(stack.id)
+    except Exception, e:
+        module.fail_json(msg = "Failure in deleting stack: %s" % e)
 
-def _get_stack_id(module, heat):
-    stacks = heat.stacks.list()
-    while True:
-        try:
-            stack = stacks.next()
-            if module.param['stack_name'] == stack.stack_name:
-                return stack.id
-        except StopIteration:
-            break
-            return False
+def _get_stack(module, heat, stack_name):
+    try:
+        return heat.stacks.get(stack_name)
+    except Exception, e:
+        if getattr(e, 'code', None) == 404:
+            return None
+        module.fail_json(msg = "Error in getting stack %s: %s" % (stack_name, e))
 
 def main():
 
     argument_spec = openstack_argument_spec()
     argument_spec.update(dict(
-            stack_name              = dict(required=True),
+            stack_name              = dict(default=None),
             template                = dict(default=None),
             environment_files       = dict(default=None, type='dict'),
             state                   = dict(default='present', choices=['absent', 'present']),
             tenant_name             = dict(default=None),
+            wait                    = dict(default='yes', type='bool'),
+            wait_for                = dict(default=None, type='list'),
+            wait_timeout            = dict(default=3600, type='int'),
     ))
-    module = AnsibleModule(argument_spec=argument_spec)
+    module = AnsibleModule(argument_spec=argument_spec,
+                           required_one_of=[['stack_name', 'wait_for']],
+                           mutually_exclusive=[['stack_name', 'wait_for']])
     heat = _get_heat_client(module, module.params)
     _set_tenant_id(module)
+    wait_timeout = module.params['wait_timeout']
+
+    if module.params['wait_for']:
+        watches = []
+        for stack_name in module.params['wait_for']:
+            stack = _get_stack(module, heat, stack_name)
+            if not stack:
+                module.fail_json(msg = "Stack %s not found" % stack_name)
+            watches.append(_StackWatch(heat, stack))
+        module.exit_json(changed = False, result = "success",
+                         stacks = _wait_stacks(module, watches, wait_timeout))
+
+    stack = _get_stack(module, heat, module.params['stack_name'])
     if module.params['state'] == 'present':
-        stack_id = _get_stack_id(module, heat)
-        if not stack_id:
-            stack_id = _create_stack(module, heat)
-            module.exit_json(changed = True, result = "Created" , id = stack_id)
-        else:
-            module.exit_json(changed = False, result = "success" , id = stack_id)
+        changed = not stack
+        if changed:
+            stack = _create_stack(module, heat)
+        stacks = {}
+        if module.params['wait'] and (changed or stack.stack_status.endswith('_IN_PROGRESS')):
+            action = 'CREATE' if changed else None
+            stacks = _wait_stacks(module, [_StackWatch(heat, stack, action)], wait_timeout)
+        module.exit_json(changed = changed, result = "Created" if changed else "success",
+                         id = stack.id, stacks = stacks)
     else:
-        stack_id = _get_stack_id(module, stack)
-        if not stack_id:
+        if not stack:
             module.exit_json(changed = False, result = "success")
-        else:
-            _delete_stack(module, stack, stack_id)
-            module.exit_json(changed = True, result = "deleted")
+        _delete_stack(module, heat, stack)
+        stacks = {}
+        if module.params['wait']:
+            stacks = _wait_stacks(module, [_StackWatch(heat, stack, 'DELETE')], wait_timeout)
+        module.exit_json(changed = True, result = "deleted", stacks = stacks)
 
 # this is magic, see lib/ansible/module.params['common.py
 from ansible.module_utils.basic import *
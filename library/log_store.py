@@ -0,0 +1,251 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# (c) 2016, Red Hat, Inc.
+#
+# This module is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: log_store
+short_description: Keeps the collected logs of the hosts by content
+description:
+  - Controller side of the incremental log collection (run it with
+    local_action). The files of the archives written by
+    collect_diagnostics (incremental=yes) are kept in a store by their
+    sha1, and the collected tree of a host is made of hard links to the
+    store, so identical files of several hosts and runs are kept once.
+  - Without archive, returns as files the hashes of the previous
+    collection of the host, to be passed to collect_diagnostics as
+    previous, so only the new and changed files are transferred.
+  - With archive, imports it in the store and makes the tree of the host
+    in dest (the files left out of the archive as unchanged are linked
+    from the store), then records its hashes in manifest for the next
+    collection.
+version_added: "1.9"
+options:
+  manifest:
+    description:
+    - The file with the hashes of the files collected from the host
+    required: true
+  store:
+    description:
+    - The directory of the stored files
+    required: true
+  archive:
+    description:
+    - The archive written by collect_diagnostics to import
+    required: false
+  dest:
+    description:
+    - The directory where the tree of the host is made, required with
+      archive
+    required: false
+  remove_archive:
+    description:
+    - Remove the archive once imported
+    required: false
+    default: yes
+'''
+
+EXAMPLES = '''
+- local_action: log_store store=/srv/logs manifest=/srv/logs/manifests/{{ inventory_hostname }}.json
+  register: previous_logs
+
+- collect_diagnostics:
+    dest: /tmp/{{ inventory_hostname }}.tar.gz
+    files: [ /var/log ]
+    incremental: yes
+    previous: "{{ previous_logs.files }}"
+
+- fetch: src=/tmp/{{ inventory_hostname }}.tar.gz dest=/tmp/{{ inventory_hostname }}.tar.gz flat=yes
+
+- local_action: log_store store=/srv/logs manifest=/srv/logs/manifests/{{ inventory_hostname }}.json archive=/tmp/{{ inventory_hostname }}.tar.gz dest=collected_files
+'''
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+
+MANIFEST_NAME = 'manifest.json'
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class Store(object):
+    """ Files kept by their sha1 as objects/<first 2 hex digits>/<sha1> """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_dir = os.path.join(path, 'tmp')
+        _makedirs(self.tmp_dir)
+
+    def object_path(self, sha1):
+        return os.path.join(self.path, 'objects', sha1[:2], sha1)
+
+    def has(self, sha1):
+        return os.path.exists(self.object_path(sha1))
+
+    def put(self, fileobj):
+        """ Stores the content of the file, returns its sha1 and whether it
+            was stored already """
+        digest = hashlib.sha1()
+        fd, tmp = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for block in iter(lambda: fileobj.read(COPY_BLOCK_SIZE), ''):
+                    digest.update(block)
+                    f.write(block)
+            sha1 = digest.hexdigest()
+            path = self.object_path(sha1)
+            if os.path.exists(path):
+                os.unlink(tmp)
+                return sha1, True
+            _makedirs(os.path.dirname(path))
+            # shared by links, nobody should change it in place
+            os.chmod(tmp, 0444)
+            os.rename(tmp, path)
+            return sha1, False
+        except Exception:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def link(self, sha1, target):
+        _makedirs(os.path.dirname(target))
+        if os.path.lexists(target):
+            os.unlink(target)
+        try:
+            os.link(self.object_path(sha1), target)
+        except OSError, e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copyfile(self.object_path(sha1), target)
+
+
+def _load_manifest(path, store):
+    """ The hashes of the previous collection whose files are still stored """
+    try:
+        with open(path) as f:
+            hashes = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    return dict((name, entry) for name, entry in hashes.items()
+                if store.has(entry[0]))
+
+
+def _save_manifest(path, hashes):
+    _makedirs(os.path.dirname(os.path.abspath(path)))
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(hashes, f)
+    os.rename(tmp, path)
+
+
+def _safe_name(name):
+    name = os.path.normpath(name)
+    if name.startswith(('/', '..')):
+        return None
+    return name
+
+
+def _import(store, archive, dest):
+    """ Stores the files of the archive and links them in dest, then links
+        the unchanged files listed in its manifest """
+    result = dict(stored=0, deduplicated=0, linked=0, missing=[])
+    archived = {}
+    manifest = None
+    prefix = None
+    # one pass over the (compressed) stream, the manifest is the last member
+    tar = tarfile.open(archive, 'r|*')
+    try:
+        for member in tar:
+            name = _safe_name(member.name)
+            if not member.isfile() or name is None:
+                continue
+            if prefix is None:
+                # the tree of the previous collection
+                shutil.rmtree(os.path.join(dest, name.partition('/')[0]),
+                              ignore_errors=True)
+            prefix, _, relative = name.partition('/')
+            fileobj = tar.extractfile(member)
+            if relative == MANIFEST_NAME:
+                manifest = json.load(fileobj)
+                continue
+            sha1, existed = store.put(fileobj)
+            result['deduplicated' if existed else 'stored'] += 1
+            store.link(sha1, os.path.join(dest, name))
+            archived[relative] = sha1
+    finally:
+        tar.close()
+    if manifest is None or 'hashes' not in manifest:
+        raise ValueError('%s has no hashes, was it written with incremental=yes?'
+                         % archive)
+
+    with open(os.path.join(dest, prefix, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    hashes = {}
+    for relative, entry in manifest['hashes'].items():
+        sha1 = archived.get(relative, entry[0])
+        if relative not in archived:
+            if not store.has(sha1):
+                result['missing'].append(relative)
+                continue
+            store.link(sha1, os.path.join(dest, prefix, relative))
+            result['linked'] += 1
+        hashes[relative] = [sha1] + list(entry[1:])
+    return hashes, result
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            manifest=dict(required=True),
+            store=dict(required=True),
+            archive=dict(),
+            dest=dict(),
+            remove_archive=dict(type='bool', default=True),
+        ),
+        required_together=[['archive', 'dest']],
+    )
+    manifest = os.path.expanduser(module.params['manifest'])
+    try:
+        store = Store(os.path.expanduser(module.params['store']))
+        if not module.params['archive']:
+            module.exit_json(changed=False,
+                             files=_load_manifest(manifest, store))
+
+        archive = os.path.expanduser(module.params['archive'])
+        hashes, result = _import(store, archive,
+                                 os.path.expanduser(module.params['dest']))
+        _save_manifest(manifest, hashes)
+        if module.params['remove_archive']:
+            os.unlink(archive)
+    except (IOError, OSError, ValueError, tarfile.TarError), e:
+        module.fail_json(msg=str(e))
+    module.exit_json(changed=True, files_count=len(hashes), **result)
+
+from ansible.module_utils.basic import *
+main()
@@ -19,10 +19,12 @@
 
 import itertools
 import operator
+import os
 import pprint
 import random
 import time
 import traceback
+import uuid
 
 try:
     from novaclient.v1_1 import client as nova_client
@@ -31,6 +33,21 @@ try:
 except ImportError:
     print("failed=True msg='novaclient is required for this module'")
 
+# fault of servers which failed because the cloud is out of capacity
+CAPACITY_FAULT = 'No valid host'
+# floating IPs tried for a server, times the IPs of servers are reattached
+MAX_FLOATING_IP_ATTEMPTS = 10
+# metadata key marking the servers booted by one request of this module
+REQUEST_META = 'khaleesi_request'
+# boot phases reported in the timing of the servers
+PHASES = ('scheduling', 'networking', 'spawning', 'floating_ip')
+TASK_STATE_PHASES = {
+    'scheduling': 'scheduling',
+    'networking': 'networking',
+    'block_device_mapping': 'spawning',
+    'spawning': 'spawning',
+}
+
 DOCUMENTATION = '''
 ---
 module: nova_compute
@@ -71,9 +88,26 @@ options:
      default: present
    name:
      description:
-        - Name that has to be given to the instance
+        - Name that has to be given to the instance, with I(count) the
+          prefix of the instance names
      required: true
      default: None
+   names:
+     description:
+        - List of names of instances to create at once with the same image,
+          flavor and networks. All boot requests are issued before waiting,
+          failed instances are replaced one by one. Only with state=present.
+     required: false
+     default: None
+   count:
+     description:
+        - Number of instances named I(name)-1 .. I(name)-I(count) to create
+          at once, booted by a single request when none of them exists yet
+          (the instances of such request are renamed when Nova names them
+          otherwise, they keep a khaleesi_request metadata item). Only with
+          state=present.
+     required: false
+     default: None
    image_id:
      description:
         - The id of the base image to boot. Mutually exclusive with image_name
@@ -133,7 +167,8 @@ options:
      version_added: "1.8"
    floating_ip_pools:
      description:
-        - list of floating IP pools from which to choose a floating IP
+        - list of floating IP pools, a floating IP from each of them is
+          attached to the server
      required: false
      default: None
      version_added: "1.8"
@@ -266,86 +301,150 @@ EXAMPLES = '''
       image_name: Ubuntu 14.04 LTS (Trusty Tahr) (PVHVM)
       flavor_ram: 4096
       flavor_include: Performance
+
+# Creates three VMs at once, each gets a floating IP from the pool
+- nova_compute:
+       state: present
+       login_username: admin
+       login_password: admin
+       login_tenant_name: admin
+       name: compute
+       count: 3
+       image_id: 4f905f38-e52a-43d2-b6ec-754a13ffb529
+       flavor_id: 4
+       nics:
+         - net-id: 34605f38-e52a-25d2-b6ec-754a13ffb723
+       floating_ip_pools:
+         - external
+  register: computes
+# computes.servers is a dict of compute-1 .. compute-3 with the id,
+# private_ip, public_ip, status and info of each, plus the seconds the server
+# spent in each boot phase as timing: scheduling, networking, spawning and
+# floating_ip (a single created server returns its timing too)
 '''
 
 
 
 def _delete_server(module, nova):
-    name = None
-    server_list = None
+    name = module.params['name']
+    watch = _ServerWatch(module, nova, name)
     try:
-        server_list = nova.servers.list(True, {'name': module.params['name']})
-        if server_list:
-            server = [x for x in server_list if x.name == module.params['name']]
-            nova.servers.delete(server.pop())
+        watch.poll()
+        servers = watch.named(name)
+        if servers:
+            nova.servers.delete(servers.pop())
     except Exception, e:
         module.fail_json( msg = "Error in deleting vm: %s" % e.message)
     if module.params['wait'] == 'no':
         module.exit_json(changed = True, result = "deleted")
     expire = time.time() + int(module.params['wait_for'])
-    name = []
-    while time.time() < expire:
-        name = nova.servers.list(True, {'name': module.params['name']})
-        if not name:
+    for _ in _polling(expire, first=2.0):
+        watch.poll()
+        if not watch.named(name):
             module.exit_json(changed = True, result = "deleted")
-        time.sleep(5)
     module.fail_json(msg=("Timed out waiting for server to get deleted, "
                           "please check manually.\n"
                           "Still have list:\n%s") % (
-                              pprint.pformat([s._info for s in name])))
+                              pprint.pformat([s._info for s in watch.named(name)])))
 
 
-def _add_floating_ip_from_pool(module, nova, server):
+class _FloatingIPAllocator(object):
+    """
+    hands out free floating IPs from pools (None: any pool). The floating
+    IPs are listed once and the free ones indexed by pool, in random order
+    so concurrent jobs seldom pick the same one. A candidate which fails to
+    attach is skipped for the next one, one taken over by somebody else is
+    found by the listing of lost(), which is indexed for the next round.
+    New IPs are created only when the pool has no free one left.
+    """
 
-    # instantiate FloatingIPManager object
-    floating_ip_obj = floating_ips.FloatingIPManager(nova)
+    def __init__(self, module, nova, pools=None):
+        self.module = module
+        self.nova = nova
+        self.pools = pools or [None]
+        self.free = None
 
-    # empty dict and list
-    usable_floating_ips = {}
-    pools = []
+    def index(self, listed):
+        self.free = {}
+        for f_ip in listed:
+            if f_ip.instance_id is None:
+                self.free.setdefault(f_ip.pool, []).append(f_ip)
+        for candidates in self.free.values():
+            random.shuffle(candidates)
 
-    # user specified
-    pools = module.params['floating_ip_pools']
+    def _next_free(self, pool):
+        for name in ([pool] if pool is not None else self.free.keys()):
+            if self.free.get(name):
+                return self.free[name].pop()
+        return None
 
-    # get the list of all floating IPs. Mileage may
-    # vary according to Nova Compute configuration
-    # per cloud provider
-    all_floating_ips = floating_ip_obj.list()
-
-    # iterate through all pools of IP address. Empty
-    # string means all and is the default value
-    for pool in pools:
-        # temporary list per pool
-        pool_ips = []
-        # loop through all floating IPs
-        for f_ip in all_floating_ips:
-            # if not reserved and the correct pool, add
-            if f_ip.instance_id is None and (f_ip.pool == pool):
-                pool_ips.append(f_ip.ip)
-                # only need one
-                break
-
-        # if the list is empty, add for this pool
-        if not pool_ips:
-            try:
-                new_ip = nova.floating_ips.create(pool)
-            except Exception, e:
-                module.fail_json(msg = "Unable to create floating ip")
-            pool_ips.append(new_ip.ip)
-        # Add to the main list
-        usable_floating_ips[pool] = pool_ips
-
-    # finally, add ip(s) to instance for each pool
-    for pool in usable_floating_ips:
-        for ip in usable_floating_ips[pool]:
+    def attach(self, server, pool):
+        """ attaches a floating IP of pool to server and returns it """
+        if self.free is None:
+            self.index(floating_ips.FloatingIPManager(self.nova).list())
+        errors = []
+        f_ip = self._next_free(pool)
+        while f_ip is not None and len(errors) < MAX_FLOATING_IP_ATTEMPTS:
             try:
-                server.add_floating_ip(ip)
-                # We only need to assign one ip - but there is an inherent
-                # race condition and some other cloud operation may have
-                # stolen an available floating ip
-                break
+                server.add_floating_ip(f_ip.ip)
+                return f_ip.ip
             except Exception, e:
-                module.fail_json(msg = "Error attaching IP %s to instance %s: %s " % (ip, server.id, e.message))
+                # most likely somebody else took it since the listing
+                errors.append("Error attaching IP %s to instance %s: %s"
+                              % (f_ip.ip, server.id, e))
+            f_ip = self._next_free(pool)
+        # no free IP left in the pool
+        try:
+            ip = self.nova.floating_ips.create(
+                *([pool] if pool is not None else [])).ip
+            server.add_floating_ip(ip)
+            return ip
+        except Exception, e:
+            errors.append("Unable to add new floating ip from pool %s"
+                          " to instance %s: %s" % (pool, server.id, e))
+        self.module.fail_json(msg = '\n'.join(errors))
+
+    def lost(self, attached):
+        """
+        returns the keys of attached ((server id, pool) -> ip) whose server
+        doesn't own the IP anymore, it was taken over by somebody else
+        (Neutron moves an associated floating IP instead of refusing it)
+        """
+        listed = floating_ips.FloatingIPManager(self.nova).list()
+        owners = dict((f_ip.ip, f_ip.instance_id) for f_ip in listed)
+        self.index(listed)
+        return set(key for key, ip in attached.items()
+                   if owners.get(ip) != key[0])
+
+
+def _add_floating_ips(module, nova, servers, timers=None):
+    """
+    attaches a floating IP from each of floating_ip_pools (or from any pool
+    with auto_floating_ip) to each of the servers, checking that none was
+    taken over by a concurrent job
+    """
+    allocator = _FloatingIPAllocator(module, nova,
+                                     module.params['floating_ip_pools'])
+    timers = timers or {}
+    pending = [(server, pool) for server in servers
+               for pool in allocator.pools]
+    for _ in range(MAX_FLOATING_IP_ATTEMPTS):
+        attached = {}
+        for server, pool in pending:
+            timer = timers.get(server.id)
+            if timer:
+                timer.switch('floating_ip')
+            attached[(server.id, pool)] = allocator.attach(server, pool)
+            if timer:
+                timer.switch(None)
+        lost = allocator.lost(attached)
+        pending = [(server, pool) for server, pool in pending
+                   if (server.id, pool) in lost]
+        if not pending:
+            return
+    module.fail_json(msg = "Floating IPs of instances %s keep being taken"
+                     " by others" % ', '.join(sorted(set(
+                         str(server.id) for server, pool in pending))))
 
 
 def _add_floating_ip_list(module, server, ips):
@@ -357,26 +456,13 @@ def _add_floating_ip_list(module, server, ips):
             module.fail_json(msg = "Error attaching IP %s to instance %s: %s " % (ip, server.id, e.message))
 
 
-def _add_auto_floating_ip(module, nova, server):
-    floating_ip_obj = floating_ips.FloatingIPManager(nova)
-    for f_ip in floating_ip_obj.list():
-        if f_ip.instance_id is None:
-            ip = f_ip.ip
-            break
-    else:
-        ip = nova.floating_ips.create()
-
-    server.add_floating_ip(ip)
-
-
 def _add_floating_ip(module, nova, server):
 
-    if module.params['floating_ip_pools']:
-        _add_floating_ip_from_pool(module, nova, server)
-    elif module.params['floating_ips']:
+    if module.params['floating_ips']:
         _add_floating_ip_list(module, server, module.params['floating_ips'])
-    elif module.params['auto_floating_ip']:
-        _add_auto_floating_ip(module, nova, server)
+    elif (module.params['floating_ip_pools'] or
+            module.params['auto_floating_ip']):
+        _add_floating_ips(module, nova, [server])
     else:
         return server
 
@@ -411,10 +497,9 @@ def _get_flavor_id(module, nova):
     return module.params['flavor_id']
 
 
-def _create_server(module, nova):
+def _boot_args(module, nova):
     image_id = _get_image_id(module, nova)
     flavor_id = _get_flavor_id(module, nova)
-    bootargs = [module.params['name'], image_id, flavor_id]
     bootkwargs = {
                 'nics' : module.params['nics'],
                 'meta' : module.params['meta'],
@@ -426,31 +511,157 @@ def _create_server(module, nova):
     for optional_param in ('region_name', 'key_name', 'availability_zone'):
         if module.params[optional_param]:
             bootkwargs[optional_param] = module.params[optional_param]
+    return image_id, flavor_id, bootkwargs
+
+
+def _retry_delay(attempt, fault):
+    '''
+    Returns the delay before the boot attempt number `attempt` (from 1).
+    Only when the cloud is out of capacity it waits long (random,
+    exponentially growing), other failures are retried almost right away.
+    '''
+    if CAPACITY_FAULT in fault:
+        return random.uniform(0, 5*60 * (1.5**attempt-1))
+    return random.uniform(0, min(2**attempt, 30))
+
+
+# BEGIN polling
+# Ansible 1.x modules can't share code, this block is repeated in our
+# modules polling OpenStack and checked to be identical by
+# tools/check_module_blocks.sh.
+def _polling(expire=None, first=1.0, cap=15.0):
+    '''
+    Yields until `expire` (forever when None) sleeping between the
+    iterations. The interval starts at `first` and grows by half each
+    time up to `cap`, with 20% jitter so parallel jobs don't poll in step.
+    '''
+    interval = first
+    while True:
+        yield
+        delay = interval * random.uniform(0.8, 1.2)
+        if expire is not None:
+            remaining = expire - time.time()
+            if remaining <= 0:
+                return
+            delay = min(delay, remaining)
+        time.sleep(delay)
+        interval = min(interval * 1.5, cap)
+# END polling
+
+
+def _fault(server):
+    return server._info.get('fault', {}).get('message', '')
+
+
+class _ServerWatch(object):
+    """
+    follows the servers with names starting with prefix; after the first
+    listing only the servers changed since the previous one are listed
+    (changes-since, by the cloud's clock), so one request covers all the
+    servers waited on whatever their number
+    """
+
+    def __init__(self, module, nova, prefix):
+        self.module = module
+        self.nova = nova
+        self.prefix = prefix
+        self.servers = {}
+        self.since = None
+
+    def poll(self, full=False):
+        # the name filter is a regexp, servers are matched strictly here
+        search_opts = {'name': self.prefix}
+        if self.since and not full:
+            search_opts['changes-since'] = self.since
+        try:
+            listed = self.nova.servers.list(True, search_opts)
+        except Exception, e:
+            self.module.fail_json(msg = "Error in getting the server list: %s" % e)
+        if full:
+            self.servers = {}
+        for server in listed:
+            if not server.name.startswith(self.prefix):
+                continue
+            # deleted servers are listed only with changes-since
+            if server.status == 'DELETED':
+                self.servers.pop(server.id, None)
+            else:
+                self.servers[server.id] = server
+            self.since = max(self.since, getattr(server, 'updated', None))
+        return self.servers
+
+    def named(self, name):
+        return [s for s in self.servers.values() if s.name == name]
+
+
+class _PhaseTimer(object):
+    """ seconds a server spent in each boot phase, as seen when polling """
+
+    def __init__(self):
+        self.seconds = dict((phase, 0.0) for phase in PHASES)
+        self.phase = 'scheduling'
+        self.start = time.time()
+
+    def switch(self, phase):
+        now = time.time()
+        if self.phase:
+            self.seconds[self.phase] += now - self.start
+        self.phase = phase
+        self.start = now
+
+    def observe(self, server):
+        if server.status == 'BUILD':
+            task_state = getattr(server, 'OS-EXT-STS:task_state', None)
+            phase = TASK_STATE_PHASES.get(task_state, self.phase)
+        else:
+            phase = None
+        if phase != self.phase:
+            self.switch(phase)
+
+    def result(self):
+        return dict((phase, round(seconds, 1))
+                    for phase, seconds in self.seconds.items())
+
+
+def _server_result(server, timer=None):
+    private = openstack_find_nova_addresses(
+        getattr(server, 'addresses'), 'fixed', 'private')
+    public = openstack_find_nova_addresses(
+        getattr(server, 'addresses'), 'floating', 'public')
+    result = dict(id=server.id,
+                  private_ip=' '.join(private),
+                  public_ip=' '.join(public),
+                  status=server.status,
+                  info=server._info)
+    if timer:
+        result['timing'] = timer.result()
+    return result
+
+
+def _create_server(module, nova):
+    image_id, flavor_id, bootkwargs = _boot_args(module, nova)
+    bootargs = [module.params['name'], image_id, flavor_id]
 
     wait = module.params['wait'] == 'yes'
     wait_for = float(module.params['wait_for'])
     expire = time.time() + wait_for
 
     def retrier():
-        for t in expbackoff():
-            time.sleep(t)
+        for attempt in itertools.count():
+            if attempt:
+                delay = _retry_delay(attempt, faults[-1])
+                time.sleep(min(delay, max(0, expire - time.time())))
             server = nova_create()
             yield server
+            # wait for the delete before booting the replacement
             try:
-                for i in range(24):
+                for _ in _polling(time.time() + 240, first=2.0):
                     nova.servers.delete(server)
-                    time.sleep(10)
+                    nova.servers.get(server.id)
             except exceptions.NotFound:
                 # Delete succeed
                 pass
 
-
-    def expbackoff():
-        '''
-        Returns an infinte sequence of random values under exponential function.
-        '''
-        return (random.uniform(0, 5*60 * (1.5**k-1)) for k in itertools.count())
-
     def nova_create():
         try:
             server = nova.servers.create(*bootargs, **bootkwargs)
@@ -459,17 +670,19 @@ def _create_server(module, nova):
             module.fail_json(msg=("Error in creating instance: %s\n%s"
                                   % (e, traceback.format_exc())))
 
-    def server_poller(server, poll_interval=2):
+    def server_poller(server):
         try:
-            while True:
+            for _ in _polling():
                 yield nova.servers.get(server.id)
-                time.sleep(poll_interval)
         except Exception, e:
             module.fail_json(msg = "Error in getting instance  %s: %s " % (server.id, e.message))
 
     errors_log = []
+    faults = []
     for booted_server in retrier():
+        timer = _PhaseTimer()
         for polled_server in server_poller(booted_server):
+            timer.observe(polled_server)
             if polled_server.status == 'ACTIVE':
                 missing_networks = _check_networks(module, nova, polled_server)
                 if missing_networks:
@@ -478,24 +691,15 @@ def _create_server(module, nova):
                                        " ERROR state.") % (
                                            polled_server.id,
                                            missing_networks))
+                    faults.append('')
                     break  # stop waiting for status, get new server
 
+                timer.switch('floating_ip')
                 polled_server = _add_floating_ip(module, nova, polled_server)
-                private = openstack_find_nova_addresses(
-                    getattr(polled_server, 'addresses'),
-                    'fixed',
-                    'private')
-                public = openstack_find_nova_addresses(
-                    getattr(polled_server, 'addresses'),
-                    'floating',
-                    'public')
+                timer.switch(None)
                 module.exit_json(changed=True,
-                                id=polled_server.id,
-                                private_ip=' '.join(private),
-                                public_ip=' '.join(public),
-                                status=polled_server.status,
-                                info=polled_server._info,
-                                attempts_errors_log=errors_log)
+                                attempts_errors_log=errors_log,
+                                **_server_result(polled_server, timer))
 
             elif not wait or time.time() >= expire:
                 msgs = []
@@ -509,23 +713,262 @@ def _create_server(module, nova):
             elif polled_server.status == 'ERROR':
                 errors_log.append("Error in creating the server %s"
                                   % pprint.pformat(polled_server._info))
+                faults.append(_fault(polled_server))
                 break # Get new server instead of current one.
             # Server is still in some transitional state. Let's poll again.
 
 
+class _Slot(object):
+    """ one of the servers requested by names or count """
+
+    def __init__(self, name):
+        self.name = name
+        self.server_id = None
+        self.server = None
+        # the boot request was sent, but the server wasn't listed yet
+        self.booting = False
+        self.boot_at = None
+        self.attempts = 0
+        self.timer = None
+        self.changed = False
+        self.done = False
+        # the failed server being deleted before the replacement is booted
+        self.deleting = None
+        self.deleted_by = None
+
+
+def _create_all_by_one_request(module, nova, slots, image_id, flavor_id,
+                               bootkwargs, errors_log):
+    """
+    boots the servers of all the slots by one request, returns the slots
+    left to boot one by one. Nova names the servers of such request by its
+    multi_instance_display_name_template (<name>-<uuid> by default since
+    Icehouse), so they are found by the REQUEST_META marker of the request
+    in their metadata (the name filter also matches the servers of other
+    jobs) and renamed to the names of the slots.
+    """
+    name = module.params['name']
+    count = len(slots)
+    marker = uuid.uuid4().hex
+    meta = dict(bootkwargs.get('meta') or {})
+    meta[REQUEST_META] = marker
+    created = []
+    try:
+        first = nova.servers.create(name, image_id, flavor_id,
+                                    min_count=count, max_count=count,
+                                    **dict(bootkwargs, meta=meta))
+        # Nova records all of them before answering, they are listed now
+        created = [listed for listed in
+                   nova.servers.list(True, {'name': name})
+                   if getattr(listed, 'metadata', {}).get(REQUEST_META)
+                   == marker]
+        if first.id not in [listed.id for listed in created]:
+            raise Exception("server %s of the request isn't listed"
+                            % first.id)
+        by_name = dict((listed.name, listed) for listed in created)
+        others = [listed for listed in created
+                  if listed.name not in [slot.name for slot in slots]]
+        for slot in slots:
+            server = by_name.get(slot.name)
+            if server is None and others:
+                server = others.pop(0)
+                nova.servers.update(server, name=slot.name)
+            if server is None:
+                continue
+            slot.server_id = server.id
+            slot.changed = slot.booting = True
+            slot.attempts = 1
+            slot.timer = _PhaseTimer()
+    except Exception, e:
+        errors_log.append("Unable to boot all %d servers by one"
+                          " request: %s" % (count, e))
+    # servers of the request without slot (left by a failure) are removed
+    adopted = set(slot.server_id for slot in slots)
+    leftovers = [listed for listed in created if listed.id not in adopted]
+    for server in leftovers:
+        try:
+            nova.servers.delete(server)
+        except exceptions.NotFound:
+            pass
+    if leftovers:
+        _wait_deleted(nova, leftovers)
+    return [slot for slot in slots if slot.server_id is None]
+
+
+def _wait_deleted(nova, servers, timeout=240):
+    """ waits for the deleted servers to be gone, as their quota with them """
+    ids = set(server.id for server in servers)
+    for _ in _polling(time.time() + timeout, first=2.0):
+        for server_id in list(ids):
+            try:
+                nova.servers.get(server_id)
+            except exceptions.NotFound:
+                ids.discard(server_id)
+        if not ids:
+            return
+
+
+def _create_servers(module, nova):
+    """
+    creates the servers of names/count together: all the boot requests are
+    sent first, then all the servers are watched by one listing per poll,
+    a failed server is deleted and only its replacement booted (with the
+    same retry delays as _create_server)
+    """
+    if module.params['floating_ips']:
+        module.fail_json(msg = "floating_ips can't be used with names or count")
+    if module.params['names']:
+        names = module.params['names']
+        prefix = os.path.commonprefix(names)
+    else:
+        prefix = module.params['name'] + '-'
+        names = [prefix + str(i) for i in range(1, module.params['count'] + 1)]
+    if len(set(names)) != len(names):
+        module.fail_json(msg = "Server names must be unique: %s" % names)
+    image_id, flavor_id, bootkwargs = _boot_args(module, nova)
+    wait = module.params['wait'] == 'yes'
+    expire = time.time() + float(module.params['wait_for'])
+    # listed by the first _check_networks
+    networks = {}
+
+    # existing servers are kept, only the missing ones are booted
+    slots = [_Slot(name) for name in names]
+    watch = _ServerWatch(module, nova, prefix)
+    watch.poll()
+    missing = []
+    for slot in slots:
+        existing = watch.named(slot.name)
+        if existing:
+            slot.server_id = existing[0].id
+        else:
+            missing.append(slot)
+
+    def boot(slot):
+        slot.changed = True
+        slot.booting = True
+        slot.boot_at = None
+        slot.attempts += 1
+        slot.timer = _PhaseTimer()
+        try:
+            slot.server_id = nova.servers.create(
+                slot.name, image_id, flavor_id, **bootkwargs).id
+        except Exception as e:
+            module.fail_json(msg=("Error in creating instance %s: %s\n%s"
+                                  % (slot.name, e, traceback.format_exc())))
+
+    def replace(slot, error, fault=''):
+        errors_log.append(error)
+        try:
+            nova.servers.delete(slot.server_id)
+            # the replacement is booted once the server is gone, so it
+            # doesn't need the quota of both
+            slot.deleting = slot.server_id
+            slot.deleted_by = time.time() + 240
+        except exceptions.NotFound:
+            pass
+        slot.server_id = None
+        slot.boot_at = time.time() + _retry_delay(slot.attempts, fault)
+
+    errors_log = []
+    if len(missing) == len(slots) > 1 and module.params['count']:
+        missing = _create_all_by_one_request(module, nova, missing, image_id,
+                                             flavor_id, bootkwargs, errors_log)
+    for slot in missing:
+        boot(slot)
+
+    for _ in _polling():
+        servers = watch.poll()
+        for slot in slots:
+            if slot.done:
+                continue
+            if slot.boot_at is not None:
+                if slot.deleting in servers and time.time() < slot.deleted_by:
+                    continue
+                if time.time() >= slot.boot_at:
+                    slot.deleting = None
+                    boot(slot)
+                continue
+            server = servers.get(slot.server_id)
+            if server is None:
+                if not slot.booting:
+                    module.fail_json(msg = "Server %s (%s) disappeared" % (slot.name, slot.server_id))
+                continue
+            slot.booting = False
+            slot.server = server
+            if slot.timer:
+                slot.timer.observe(server)
+            if server.status == 'ACTIVE':
+                missing_networks = _check_networks(module, nova, server,
+                                                   networks)
+                if missing_networks:
+                    replace(slot, ("Server %s is ACTIVE but missing"
+                                   " networks %s, considering it as"
+                                   " ERROR state.") % (server.id,
+                                                       missing_networks))
+                else:
+                    slot.done = True
+            elif server.status == 'ERROR':
+                replace(slot, "Error in creating the server %s"
+                        % pprint.pformat(server._info), _fault(server))
+
+        pending = [slot for slot in slots if not slot.done]
+        if not wait:
+            module.exit_json(changed=any(slot.changed for slot in slots),
+                             servers=dict((slot.name, {'id': slot.server_id})
+                                          for slot in slots))
+        if not pending:
+            break
+        if time.time() >= expire:
+            msgs = ["Timeouted when waiting for the servers to come up:"]
+            msgs += ["%s: %s" % (slot.name, slot.server and slot.server._info)
+                     for slot in pending]
+            if errors_log:
+                msgs += [ "Previous failed boot attempts:" ] + errors_log
+            module.fail_json(msg = '\n'.join(msgs))
+
+    changed = any(slot.changed for slot in slots)
+    if (module.params['floating_ip_pools'] or
+            module.params['auto_floating_ip']):
+        without_ip = [slot.server for slot in slots
+                      if not openstack_find_nova_addresses(
+                          slot.server.addresses, 'floating')]
+        if without_ip:
+            _add_floating_ips(module, nova, without_ip,
+                              dict((slot.server_id, slot.timer)
+                                   for slot in slots))
+            changed = True
+            # attaching an IP doesn't always touch the server's updated time
+            servers = watch.poll(full=True)
+            for slot in slots:
+                slot.server = servers.get(slot.server_id, slot.server)
+
+    module.exit_json(changed=changed,
+                     servers=dict((slot.name,
+                                   _server_result(slot.server, slot.timer))
+                                  for slot in slots),
+                     attempts_errors_log=errors_log)
+
+
 def _delete_floating_ip_list(module, nova, server, extra_ips):
     for ip in extra_ips:
         nova.servers.remove_floating_ip(server=server.id, address=ip)
 
 
-def _check_networks(module, nova, server):
+def _check_networks(module, nova, server, all_networks=None):
     # Return all networks which VM should have but are missing
     # ... in form of list of str('name (id)')
     # ... empty list if it has all requested networks
+    # ... all_networks (id -> label) is filled by the first call and
+    # ... reused by the next ones, the networks are listed once
 
     missing = []
-    all_networks = dict((net.id, net.label) for net in nova.networks.list())
-    for nic in module.params['nics']:
+    if not module.params['nics']:
+        return missing
+    if all_networks is None:
+        all_networks = {}
+    if not all_networks:
+        all_networks.update((net.id, net.label) for net in nova.networks.list())
+    for nic in module.params['nics'] or []:
         net_id = nic['net-id']
         if net_id not in all_networks:
             module.fail_json('Unable to find network with id %s' % net_id)
@@ -603,7 +1046,9 @@ def _get_server_state(module, nova):
 def main():
     argument_spec = openstack_argument_spec()
     argument_spec.update(dict(
-        name                            = dict(required=True),
+        name                            = dict(default=None),
+        names                           = dict(default=None, type='list'),
+        count                           = dict(default=None, type='int'),
         image_id                        = dict(default=None),
         image_name                      = dict(default=None),
         image_exclude                   = dict(default='(deprecated)'),
@@ -631,8 +1076,14 @@ def main():
             ['floating_ips','floating_ip_pools'],
             ['image_id','image_name'],
             ['flavor_id','flavor_ram'],
+            ['names','count'],
         ],
     )
+    if not module.params['name'] and not module.params['names']:
+        module.fail_json(msg = "Parameter 'name' or 'names' is required")
+    if ((module.params['names'] or module.params['count'])
+            and module.params['state'] != 'present'):
+        module.fail_json(msg = "Parameters 'names' and 'count' are only supported with state == 'present'")
 
     nova = nova_client.Client(module.params['login_username'],
                               module.params['login_password'],
@@ -650,6 +1101,8 @@ def main():
     if module.params['state'] == 'present':
         if not module.params['image_id'] and not module.params['image_name']:
             module.fail_json( msg = "Parameter 'image_id' or `image_name` is required if state == 'present'")
+        elif module.params['names'] or module.params['count']:
+            _create_servers(module, nova)
         else:
             _get_server_state(module, nova)
             _create_server(module, nova)
@@ -1,9 +1,12 @@
 #!/usr/bin/python
 #coding: utf-8 -*-
 
+import calendar
+import random
+import time
+
 try:
     import shade
-    from time import sleep
     HAS_SHADE = True
 except ImportError:
     HAS_SHADE = False
@@ -39,6 +42,25 @@ options:
         - List of environment files that should be used for the stack creation
      required: false
      default: None
+   wait:
+     description:
+        - Wait until the stack is created or deleted, following its events.
+          Fails on the first failed resource, with the reason from its event.
+     required: false
+     default: yes
+   wait_for:
+     description:
+        - Names of existing stacks to wait on, until none of them is in
+          progress (e.g. stacks created or updated by a command). Used
+          instead of stack_name.
+     required: false
+     default: None
+   wait_timeout:
+     description:
+        - Seconds to wait for the stacks (C(timeout) is the one of each
+          OpenStack API call)
+     required: false
+     default: 3600
 requirements:
     - "python >= 2.6"
     - "shade"
@@ -46,22 +68,173 @@ requirements:
 
 EXAMPLES = '''
 # Create a stack with given template and environment files
+- os_heat_stack:
+    stack_name: test
+    template: /home/stack/test.yaml
+
+# Wait for several stacks, the result has the status and the timing
+# of each resource
+- os_heat_stack:
+    wait_for: [overcloud, test]
+    wait_timeout: 7200
 '''
 
+# BEGIN polling
+# Ansible 1.x modules can't share code, this block is repeated in our
+# modules polling OpenStack and checked to be identical by
+# tools/check_module_blocks.sh.
+def _polling(expire=None, first=1.0, cap=15.0):
+    '''
+    Yields until `expire` (forever when None) sleeping between the
+    iterations. The interval starts at `first` and grows by half each
+    time up to `cap`, with 20% jitter so parallel jobs don't poll in step.
+    '''
+    interval = first
+    while True:
+        yield
+        delay = interval * random.uniform(0.8, 1.2)
+        if expire is not None:
+            remaining = expire - time.time()
+            if remaining <= 0:
+                return
+            delay = min(delay, remaining)
+        time.sleep(delay)
+        interval = min(interval * 1.5, cap)
+# END polling
+
+# BEGIN stack watch
+# Waiting on stacks follows their event lists, each poll only fetches the
+# events after the last one seen (marker), so all the stacks are waited on
+# in one run instead of re-running the module from until loops. This block
+# is repeated in heat_stack and os_heat_stack and checked to be identical
+# by tools/check_module_blocks.sh.
+EVENT_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+STACK_STATES = ('_IN_PROGRESS', '_COMPLETE', '_FAILED')
+
+def _event_time(value):
+    # heat times are UTC, with or without fractions and zone
+    try:
+        return calendar.timegm(time.strptime(value[:19], EVENT_TIME_FORMAT))
+    except (TypeError, ValueError):
+        return None
+
+class _StackWatch(object):
+    """
+    Follows a stack until its action (CREATE, DELETE, ...) completes or
+    fails, or until it leaves any *_IN_PROGRESS status when the action is
+    None. Records the timing of the resources from the events and the
+    first failed resource.
+    """
+
+    def __init__(self, heat, stack, action=None):
+        self.heat = heat
+        self.name = stack.stack_name
+        self.id = stack.id
+        self.identifier = '%s/%s' % (stack.stack_name, stack.id)
+        self.action = action
+        self.status = stack.stack_status
+        self.reason = getattr(stack, 'stack_status_reason', None)
+        # events of earlier actions of the stack are not ours
+        self.since = _event_time(getattr(stack, 'updated_time', None) or
+                                 getattr(stack, 'creation_time', None))
+        self.marker = None
+        self.events = 0
+        self.resources = {}
+        self.failed = None
+        self.start = time.time()
+        self.duration = None
+
+    def done(self):
+        if self.failed is not None:
+            return True
+        if self.action:
+            return self.status in (self.action + '_COMPLETE',
+                                   self.action + '_FAILED')
+        return not self.status.endswith('_IN_PROGRESS')
+
+    def poll(self):
+        try:
+            stack = self.heat.stacks.get(self.identifier)
+        except Exception, e:
+            if getattr(e, 'code', None) != 404:
+                raise
+            self.status, self.reason = 'DELETE_COMPLETE', 'Stack not found'
+        else:
+            # events first, the stack status is at least as new as them
+            for event in self.heat.events.list(self.identifier,
+                                               marker=self.marker,
+                                               sort_dir='asc'):
+                self.marker = event.id
+                self.events += 1
+                self._record(event)
+            self.status = stack.stack_status
+            self.reason = getattr(stack, 'stack_status_reason', None)
+        if self.done():
+            self.duration = round(time.time() - self.start, 1)
+
+    def _record(self, event):
+        if getattr(event, 'physical_resource_id', None) == self.id:
+            return
+        when = _event_time(getattr(event, 'event_time', None))
+        if self.since and when and when < self.since:
+            return
+        status = event.resource_status
+        if self.action and not status.startswith(self.action + '_'):
+            return
+        resource = self.resources.setdefault(event.resource_name, {
+            'started': None, 'finished': None, 'duration': None})
+        if status.endswith('_IN_PROGRESS'):
+            if resource['finished'] or not resource['started']:
+                resource.update(started=event.event_time, finished=None,
+                                duration=None)
+        else:
+            resource['finished'] = event.event_time
+            started = _event_time(resource['started'])
+            if started is not None and when is not None:
+                resource['duration'] = when - started
+        resource['status'] = status
+        resource['reason'] = event.resource_status_reason
+        if status.endswith('_FAILED') and self.failed is None:
+            self.failed = (event.resource_name, event.resource_status_reason)
+
+    def result(self):
+        return dict(id=self.id, status=self.status, reason=self.reason,
+                    duration=self.duration, events=self.events,
+                    resources=self.resources)
+
+def _wait_stacks(module, watches, timeout):
+    '''
+    Polls the stacks until all are done, fails on the first failed
+    resource or stack, or once `timeout` seconds passed.
+    '''
+    results = lambda: dict((watch.name, watch.result()) for watch in watches)
+    pending = list(watches)
+    for _ in _polling(time.time() + timeout, first=2.0):
+        for watch in pending:
+            try:
+                watch.poll()
+            except Exception, e:
+                module.fail_json(msg="Error in polling stack %s: %s" % (watch.name, e),
+                                 stacks=results())
+            if watch.failed:
+                module.fail_json(msg="Stack %s failed: resource %s: %s" % (
+                    watch.name, watch.failed[0], watch.failed[1]), stacks=results())
+            if watch.status.endswith('_FAILED'):
+                module.fail_json(msg="Stack %s is %s: %s" % (
+                    watch.name, watch.status, watch.reason), stacks=results())
+        pending = [watch for watch in pending if not watch.done()]
+        if not pending:
+            return results()
+    module.fail_json(msg="Timeout waiting for stacks: %s" % ', '.join(
+        watch.name for watch in pending), stacks=results())
+# END stack watch
+
 def _create_stack(module, stack, cloud):
     try:
         stack = cloud.create_stack(module.params['stack_name'],
                                    template_file=module.params['template'],
                                    files=module.params['environment_files'])
-
-        stack = cloud.get_stack(stack['stack']['id'], None)
-        while stack['stack_status'] == 'CREATE_IN_PROGRESS':
-            stack = cloud.get_stack(stack['id'])
-            sleep(5)
-        if stack['stack_status'] == 'CREATE_COMPLETE':
-            return stack
-        else:
-            module.fail_json(msg = "Failure in creating stack: ".format(stack))
+        return cloud.heat_client.stacks.get(stack['stack']['id'])
     except shade.OpenStackCloudException as e:
         module.fail_json(msg=e.message)
 
@@ -77,13 +250,19 @@ def _system_state_change(module, stack, cloud):
 def main():
 
     argument_spec = openstack_full_argument_spec(
-        stack_name=dict(required=True),
+        stack_name=dict(default=None),
         template=dict(default=None),
         environment_files=dict(default=None, type='dict'),
         state=dict(default='present', choices=['absent', 'present']),
+        wait=dict(default=True, type='bool'),
+        wait_for=dict(default=None, type='list'),
+        wait_timeout=dict(default=3600, type='int'),
     )
 
-    module_kwargs = openstack_module_kwargs()
+    module_kwargs = openstack_module_kwargs(
+        required_one_of=[['stack_name', 'wait_for']],
+        mutually_exclusive=[['stack_name', 'wait_for']],
+    )
     module = AnsibleModule(argument_spec,
                            supports_check_mode=True,
                            **module_kwargs)
@@ -95,37 +274,68 @@ def main():
     stack_name = module.params['stack_name']
     template = module.params['template']
     environment_files = module.params['environment_files']
+    wait = module.params['wait']
+    wait_timeout = module.params['wait_timeout']
 
     # Check for required parameters when state == 'present'
-    if state == 'present':
+    if state == 'present' and stack_name:
         for p in ['stack_name', 'template']:
             if not module.params[p]:
                 module.fail_json(msg='%s required with present state' % p)
 
     try:
         cloud = shade.openstack_cloud(**module.params)
+        heat = cloud.heat_client
+
+        if module.params['wait_for']:
+            watches = []
+            for name in module.params['wait_for']:
+                stack = cloud.get_stack(name)
+                if not stack:
+                    module.fail_json(msg='Stack %s not found' % name)
+                watches.append(_StackWatch(heat, heat.stacks.get(stack['id'])))
+            if module.check_mode:
+                module.exit_json(changed=False)
+            module.exit_json(changed=False,
+                             stacks=_wait_stacks(module, watches, wait_timeout))
+
         stack = cloud.get_stack(stack_name)
 
         if module.check_mode:
             module.exit_json(changed=_system_state_change(module, stack,
                                                           cloud))
 
+        stacks = {}
         if state == 'present':
             if not stack:
                 stack = _create_stack(module, stack, cloud)
+                action = 'CREATE'
                 changed = True
             else:
+                stack = heat.stacks.get(stack['id'])
+                action = None
                 changed = False
+            if wait and (changed or
+                         stack.stack_status.endswith('_IN_PROGRESS')):
+                stacks = _wait_stacks(module,
+                                      [_StackWatch(heat, stack, action)],
+                                      wait_timeout)
+            stack = heat.stacks.get(stack.id).to_dict()
             module.exit_json(changed=changed,
                              stack=stack,
-                             id=stack['id'])
+                             id=stack['id'],
+                             stacks=stacks)
         elif state == 'absent':
             if not stack:
                 changed = False
             else:
                 changed = True
+                watch = _StackWatch(heat, heat.stacks.get(stack['id']),
+                                    'DELETE')
                 cloud.delete_stack(stack_name)
-            module.exit_json(changed=changed)
+                if wait:
+                    stacks = _wait_stacks(module, [watch], wait_timeout)
+            module.exit_json(changed=changed, stacks=stacks)
 
     except shade.OpenStackCloudException as e:
         module.fail_json(msg=e.message)
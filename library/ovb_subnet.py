@@ -1,11 +1,22 @@
 #!/usr/bin/python
 #coding: utf-8 -*-
 
+import bisect
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
 try:
     from neutronclient.neutron import client
     from neutronclient.common import exceptions
+    from keystoneclient import access
+    from keystoneclient import exceptions as ks_exceptions
     from keystoneclient.v2_0 import client as ksclient
-    from netaddr import IPNetwork
+    from netaddr import IPAddress, IPNetwork
 except ImportError:
     print("failed=True msg='neutronclient, keystoneclient are required'")
 
@@ -95,30 +106,164 @@ options:
         - From the subnet pool the last IP that should be assigned to the virtual machines
      required: 10.0.0.40
      default: None
+   subnets:
+     description:
+        - List of subnets to create (or remove) in one run, each a dict with
+          C(name), C(network_name) and C(cidr), and optionally any of
+          the options above to override them for that subnet. Replaces
+          C(name), C(network_name) and C(cidr).
+     required: false
+     default: None
 requirements: ["neutronclient", "keystoneclient"]
 '''
 
 EXAMPLES = '''
 # Create a subnet for a tenant with the specified subnet
+# (the first free /24 from 192.168.0.0/24 up is used)
+- ovb_subnet: state=present login_username=admin login_password=admin
+              login_tenant_name=admin network_name=provision
+              name=provision cidr=192.168.0.0/24
+
+# Create several subnets at once, none of them overlapping
+- ovb_subnet:
+    state: present
+    login_username: admin
+    login_password: admin
+    login_tenant_name: admin
+    subnets:
+      - {name: provision, network_name: provision, cidr: 192.168.0.0/24,
+         enable_dhcp: false}
+      - {name: private, network_name: private, cidr: 192.168.0.0/24,
+         dns_nameservers: "8.8.8.8"}
 '''
 
 _os_keystone   = None
 _os_tenant_id  = None
-_os_network_id = None
-_inc = 0
+
+# BEGIN keystone cache
+# Keystone tokens (with the service catalog) and the tenant ids listed with
+# them are cached on disk between the module runs, per auth_url and
+# credentials. Ansible 1.x modules can't share code, this block is repeated
+# in our modules using keystone and checked to be identical by
+# tools/check_module_blocks.sh. KHALEESI_KEYSTONE_CACHE set to empty string
+# disables the cache.
+KEYSTONE_CACHE = os.environ.get('KHALEESI_KEYSTONE_CACHE', os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'khaleesi', 'keystone.json'))
+# cached token is used only while it's valid at least this many seconds
+KEYSTONE_CACHE_MARGIN = 300
+
+_os_keystone_key = None
+# tenant name -> id, listed with the token
+_os_tenants = None
+# the token refused by a service was renewed
+_os_keystone_renewed = False
+
+def _keystone_cache_key(kwargs):
+    credentials = json.dumps([kwargs.get(name) for name in (
+        'auth_url', 'login_username', 'login_password', 'login_tenant_name')])
+    return hashlib.sha1(credentials).hexdigest()
+
+@contextlib.contextmanager
+def _keystone_cache():
+    # yields the cache locked against other jobs, writes it back if changed;
+    # it's held only to read or update the file, never around a request
+    if not KEYSTONE_CACHE:
+        yield {}
+        return
+    cache_dir = os.path.dirname(KEYSTONE_CACHE)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+    with open(KEYSTONE_CACHE + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(KEYSTONE_CACHE) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            cache = {}
+        before = json.dumps(cache, sort_keys=True)
+        yield cache
+        if json.dumps(cache, sort_keys=True) != before:
+            # readable only by the user, as mkstemp creates it
+            fd, tmp = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f)
+            os.rename(tmp, KEYSTONE_CACHE)
+
+def _keystone_cached(cache):
+    # the entry of our credentials if it still holds our token
+    entry = cache.get(_os_keystone_key)
+    if entry and access.AccessInfo.factory(
+            **entry['auth_ref']).auth_token == _os_keystone.auth_token:
+        return entry
+    return None
 
 def _get_ksclient(module, kwargs):
+    # a cached token is used without asking keystone, it's renewed only
+    # when a request made with it gets a 401, see _keystone_refused
+    global _os_keystone, _os_keystone_key, _os_tenants
+    _os_keystone_key = _keystone_cache_key(kwargs)
+    credentials = dict(username=kwargs.get('login_username'),
+                       password=kwargs.get('login_password'),
+                       tenant_name=kwargs.get('login_tenant_name'),
+                       auth_url=kwargs.get('auth_url'))
     try:
-        kclient = ksclient.Client(username=kwargs.get('login_username'),
-                                 password=kwargs.get('login_password'),
-                                 tenant_name=kwargs.get('login_tenant_name'),
-                                 auth_url=kwargs.get('auth_url'))
+        with _keystone_cache() as cache:
+            entry = cache.get(_os_keystone_key) or {}
+        auth_ref = entry.get('auth_ref')
+        if auth_ref and not access.AccessInfo.factory(
+                **auth_ref).will_expire_soon(KEYSTONE_CACHE_MARGIN):
+            kclient = ksclient.Client(auth_ref=auth_ref, **credentials)
+            _os_tenants = entry.get('tenants')
+        else:
+            kclient = ksclient.Client(**credentials)
+            _os_tenants = None
+            with _keystone_cache() as cache:
+                cache[_os_keystone_key] = {'auth_ref': dict(kclient.auth_ref)}
     except Exception, e:
-        module.fail_json(msg = "Error authenticating to the keystone: %s" %e.message)
-    global _os_keystone
+        module.fail_json(msg = "Error authenticating to the keystone: %s" % e)
     _os_keystone = kclient
     return kclient
 
+def _keystone_refused(module):
+    # the token was refused, revoked or of a cloud redeployed at the same
+    # URL: it's dropped and main() is run again from the start with a new
+    # token and tenant ids, our modules look at the state before changing
+    # it. Returns only if that's not possible, the token was renewed
+    # already or this is a worker thread.
+    global _os_keystone_renewed
+    if _os_keystone_renewed or threading.current_thread().name != 'MainThread':
+        return
+    _os_keystone_renewed = True
+    try:
+        with _keystone_cache() as cache:
+            if _keystone_cached(cache):
+                del cache[_os_keystone_key]
+    except Exception, e:
+        module.fail_json(msg = "Error renewing the keystone token: %s" % e)
+    main()
+
+def _get_tenant_id(module, tenant_name):
+    global _os_tenants
+    if tenant_name not in (_os_tenants or {}):
+        try:
+            _os_tenants = dict((tenant.name, tenant.id)
+                               for tenant in _os_keystone.tenants.list())
+            with _keystone_cache() as cache:
+                entry = _keystone_cached(cache)
+                if entry:
+                    entry['tenants'] = _os_tenants
+        except Exception, e:
+            if isinstance(e, ks_exceptions.Unauthorized):
+                _keystone_refused(module)
+            module.fail_json(msg = "Error in listing tenants: %s" % e)
+    return _os_tenants.get(tenant_name)
+# END keystone cache
+
 
 def _get_endpoint(module, ksclient):
     try:
@@ -139,6 +284,8 @@ def _get_neutron_client(module, kwargs):
         neutron = client.Client('2.0', **kwargs)
     except Exception, e:
         module.fail_json(msg = " Error in connecting to neutron: %s" % e.message)
+    # the client authenticates again when the token is refused
+    neutron.httpclient.authenticate = lambda: _keystone_refused(module)
     return neutron
 
 def _set_tenant_id(module):
@@ -148,79 +295,125 @@ def _set_tenant_id(module):
     else:
         tenant_name = module.params['tenant_name']
 
-    for tenant in _os_keystone.tenants.list():
-        if tenant.name == tenant_name:
-            _os_tenant_id = tenant.id
-            break
+    _os_tenant_id = _get_tenant_id(module, tenant_name)
     if not _os_tenant_id:
             module.fail_json(msg = "The tenant id cannot be found, please check the parameters")
 
-def _get_net_id(neutron, module):
-    kwargs = {
-        'tenant_id': _os_tenant_id,
-        'name': module.params['network_name'],
-    }
+SUBNET_OPTIONS = ('ip_version', 'enable_dhcp', 'gateway_ip', 'dns_nameservers',
+                  'allocation_pool_start', 'allocation_pool_end')
+
+class _CidrAllocator(object):
+    """
+    Hands out free CIDRs. The used address space is kept, per IP version,
+    as a sorted list of disjoint (first, last) address intervals, each
+    allocated block is added to it, so the blocks never overlap.
+    """
+
+    def __init__(self, cidrs):
+        self._used = {}
+        networks = sorted(IPNetwork(cidr) for cidr in cidrs)
+        for network in networks:
+            used = self._used.setdefault(network.version, [])
+            if used and network.first <= used[-1][1] + 1:
+                used[-1] = (used[-1][0], max(used[-1][1], network.last))
+            else:
+                used.append((network.first, network.last))
+
+    def allocate(self, cidr):
+        # first free block of the prefix length of cidr, from cidr up
+        network = IPNetwork(cidr).cidr
+        used = self._used.setdefault(network.version, [])
+        size = network.size
+        end = 2 ** (32 if network.version == 4 else 128)
+        first = network.first
+        index = max(bisect.bisect_right(used, (first, end)) - 1, 0)
+        while first + size <= end:
+            last = first + size - 1
+            if index == len(used) or used[index][0] > last:
+                used.insert(index, (first, last))
+                return str(IPNetwork('%s/%d' % (
+                    IPAddress(first, network.version), network.prefixlen)))
+            if used[index][1] >= first:
+                first = (used[index][1] // size + 1) * size
+            index += 1
+        return None
+
+def _requested_subnets(module):
+    params = module.params
+    if not params['subnets']:
+        names = ('name', 'network_name', 'cidr') + SUBNET_OPTIONS
+        return [dict((name, params[name]) for name in names)]
+    subnets = []
+    for subnet in params['subnets']:
+        requested = dict((name, params[name]) for name in
+                         ('network_name', 'cidr') + SUBNET_OPTIONS)
+        requested.update(subnet)
+        if not requested.get('name') or not requested.get('network_name'):
+            module.fail_json(msg = "name and network_name are required for each subnet: %s" % subnet)
+        requested['enable_dhcp'] = module.boolean(requested['enable_dhcp'])
+        subnets.append(requested)
+    return subnets
+
+def _get_net_ids(module, neutron, names):
     try:
-        networks = neutron.list_networks(**kwargs)
+        networks = neutron.list_networks(tenant_id=_os_tenant_id)['networks']
     except Exception, e:
-        module.fail_json("Error in listing neutron networks: %s" % e.message)
-    if not networks['networks']:
-            return None
-    return networks['networks'][0]['id']
-
-
-def _get_subnet_id(module, neutron):
-    global _os_network_id
-    subnet_id = None
-    _os_network_id = _get_net_id(neutron, module)
-    if not _os_network_id:
-        module.fail_json(msg = "network id of network not found.")
-    else:
-        kwargs = {
-            'tenant_id': _os_tenant_id,
-            'name': module.params['name'],
-        }
-        try:
-            subnets = neutron.list_subnets(**kwargs)
-        except Exception, e:
-            module.fail_json( msg = " Error in getting the subnet list:%s " % e.message)
-        if not subnets['subnets']:
-            return None
-        return subnets['subnets'][0]['id']
+        module.fail_json(msg = "Error in listing neutron networks: %s" % e.message)
+    net_ids = {}
+    for network in networks:
+        net_ids.setdefault(network['name'], network['id'])
+    missing = sorted(set(names) - set(net_ids))
+    if missing:
+        module.fail_json(msg = "network id of network not found: %s" % ', '.join(missing))
+    return net_ids
 
-def _create_subnet(module, neutron):
-    neutron.format = 'json'
-    cidr = _get_available_cidr(module, neutron, module.params['cidr'])
+def _list_subnets(module, neutron):
+    # all subnets, both to find ours and the cidrs in use
+    try:
+        return neutron.list_subnets()['subnets']
+    except Exception, e:
+        module.fail_json(msg = " Error in getting the subnet list:%s " % e.message)
+
+def _nth_address(cidr, address):
+    # the host part of the option (last octet) applied to the allocated cidr
+    return str(IPNetwork(cidr)[int(address.split('.')[3])])
+
+def _subnet_body(requested, network_id, cidr):
     subnet = {
-            'name':            module.params['name'],
-            'ip_version':      module.params['ip_version'],
-            'enable_dhcp':     module.params['enable_dhcp'],
+            'name':            requested['name'],
+            'ip_version':      requested['ip_version'],
+            'enable_dhcp':     requested['enable_dhcp'],
             'tenant_id':       _os_tenant_id,
-            'gateway_ip':      str(IPNetwork(cidr)[module.params['gateway_ip'].split('.')[3]]),
-            'dns_nameservers': module.params['dns_nameservers'],
-            'network_id':      _os_network_id,
+            'network_id':      network_id,
             'cidr':            cidr,
     }
-    if module.params['allocation_pool_start'] and module.params['allocation_pool_end']:
-        allocation_pools = [
+    if requested['gateway_ip']:
+        subnet['gateway_ip'] = _nth_address(cidr, requested['gateway_ip'])
+    if requested['allocation_pool_start'] and requested['allocation_pool_end']:
+        subnet['allocation_pools'] = [
             {
-                'start' : str(IPNetwork(cidr)[module.params['allocation_pool_start'].split('.')[3]]),
-                'end'   :  str(IPNetwork(cidr)[module.params['allocation_pool_end'].split('.')[3]]) 
+                'start' : _nth_address(cidr, requested['allocation_pool_start']),
+                'end'   : _nth_address(cidr, requested['allocation_pool_end']),
             }
         ]
-        subnet.update({'allocation_pools': allocation_pools})
-    if not module.params['gateway_ip']:
-        subnet.pop('gateway_ip')
-    if module.params['dns_nameservers']:
-        subnet['dns_nameservers'] = module.params['dns_nameservers'].split(',')
-    else:
-        subnet.pop('dns_nameservers')
+    if requested['dns_nameservers']:
+        subnet['dns_nameservers'] = requested['dns_nameservers'].split(',')
+    return subnet
+
+def _create_subnets(module, neutron, requested, allocator, net_ids):
+    neutron.format = 'json'
+    bodies = []
+    for subnet in requested:
+        cidr = allocator.allocate(subnet['cidr'])
+        if not cidr:
+            module.fail_json(msg = "Not enough cidr available on your deployment for %s (%s)" % (subnet['name'], subnet['cidr']))
+        bodies.append(_subnet_body(subnet, net_ids[subnet['network_name']], cidr))
     try:
-        new_subnet = neutron.create_subnet(dict(subnet=subnet))
+        if len(bodies) == 1:
+            return [neutron.create_subnet(dict(subnet=bodies[0]))['subnet']]
+        return neutron.create_subnet(dict(subnets=bodies))['subnets']
     except Exception, e:
         module.fail_json(msg = "Failure in creating subnet: %s" % e.message)
-    return new_subnet['subnet']['id']
-
 
 def _delete_subnet(module, neutron, subnet_id):
     try:
@@ -229,28 +422,14 @@ def _delete_subnet(module, neutron, subnet_id):
         module.fail_json( msg = "Error in deleting subnet: %s" % e.message)
     return True
 
-def _list_existing_cidr(module, neutron):
-    subnets = neutron.list_subnets()['subnets']
-    return [subnet['cidr']  for subnet in subnets]
-
-def _get_available_cidr(module, neutron, cidr):
-    current_cidrs = _list_existing_cidr(module, neutron)
-    global _inc
-    if _inc == 10:
-        raise Exception("Not enough cidr available on your deployment")
-    if cidr in current_cidrs:
-        _inc += 1
-        next_cidr =  IPNetwork(cidr).next()
-        return _get_available_cidr(module, neutron, str(next_cidr))
-    return str(cidr)
-
 def main():
 
     argument_spec = openstack_argument_spec()
     argument_spec.update(dict(
-            name                    = dict(required=True),
-            network_name            = dict(required=True),
+            name                    = dict(default=None),
+            network_name            = dict(default=None),
             cidr                    = dict(default='10.0.0.0/24'),
+            subnets                 = dict(default=None, type='list'),
             tenant_name             = dict(default=None),
             state                   = dict(default='present', choices=['absent', 'present']),
             ip_version              = dict(default='4', choices=['4']),
@@ -260,23 +439,47 @@ def main():
             allocation_pool_start   = dict(default='10.0.0.10'),
             allocation_pool_end     = dict(default='10.0.0.40'),
     ))
-    module = AnsibleModule(argument_spec=argument_spec)
+    module = AnsibleModule(argument_spec=argument_spec,
+                           mutually_exclusive=[['name', 'subnets']])
+    if not module.params['subnets'] and not (module.params['name'] and module.params['network_name']):
+        module.fail_json(msg = "name and network_name, or subnets, are required")
+    requested = _requested_subnets(module)
     neutron = _get_neutron_client(module, module.params)
     _set_tenant_id(module)
+    net_ids = _get_net_ids(module, neutron, [subnet['network_name'] for subnet in requested])
+
+    subnets = _list_subnets(module, neutron)
+    existing = {}
+    for subnet in subnets:
+        if subnet['tenant_id'] == _os_tenant_id:
+            existing.setdefault(subnet['name'], subnet)
+
+    changed = False
+    result = {}
     if module.params['state'] == 'present':
-        subnet_id = _get_subnet_id(module, neutron)
-        if not subnet_id:
-            subnet_id = _create_subnet(module, neutron)
-            module.exit_json(changed = True, result = "Created" , id = subnet_id)
-        else:
-            module.exit_json(changed = False, result = "success" , id = subnet_id)
+        missing = [subnet for subnet in requested if subnet['name'] not in existing]
+        if missing:
+            allocator = _CidrAllocator(subnet['cidr'] for subnet in subnets)
+            for subnet in _create_subnets(module, neutron, missing, allocator, net_ids):
+                existing[subnet['name']] = subnet
+            changed = True
+        for subnet in requested:
+            result[subnet['name']] = dict(id = existing[subnet['name']]['id'],
+                                          cidr = existing[subnet['name']]['cidr'])
     else:
-        subnet_id = _get_subnet_id(module, neutron)
-        if not subnet_id:
-            module.exit_json(changed = False, result = "success")
-        else:
-            _delete_subnet(module, neutron, subnet_id)
-            module.exit_json(changed = True, result = "deleted")
+        for subnet in requested:
+            if subnet['name'] in existing:
+                _delete_subnet(module, neutron, existing.pop(subnet['name'])['id'])
+                changed = True
+
+    if module.params['subnets']:
+        if module.params['state'] == 'present':
+            module.exit_json(changed = changed, result = "success", subnets = result)
+        module.exit_json(changed = changed, result = "success")
+    if module.params['state'] == 'present':
+        module.exit_json(changed = changed, result = "Created" if changed else "success",
+                         **result[module.params['name']])
+    module.exit_json(changed = changed, result = "deleted" if changed else "success")
 
 # this is magic, see lib/ansible/module.params['common.py
 from ansible.module_utils.basic import *
@@ -27,6 +27,9 @@ description:
 EXAMPLES = '''
 # Get the snapshot type and version
 - product_snapshot_data:
+
+# Without querying the repositories
+- product_snapshot_data: repo_url=http://example.com/puddles/OpenStack/7.0-RHEL-7/2015-10-01.1/RH7-RHOS-7.0/x86_64/os/
 '''
 
 import logging
@@ -36,6 +39,9 @@ import subprocess
 
 PUDDLE_CHANGELOG_VER_RE = re.compile(r'NEW DIRECTORY: .+\/([0-9]{4}-[0-9]{2}-[0-9]{2}\..)\/.+')
 PUDDLE_URL_VER_RE = re.compile(r'http.+\/([0-9]{4}-[0-9]{2}-[0-9]{2}\..|latest)\/')
+# the changelog is read in ranges of this size, the version is usually
+# in the first one
+CHANGELOG_RANGE = 64 * 1024
 
 # Just for debugging issue, not for normal usage
 logging.basicConfig(level=logging.INFO)
@@ -50,9 +56,17 @@ class NotFoundException(Exception):
         return repr(self.reason)
 
 
+# repoquery results of this process, per package
+_REPOQUERY_CACHE = {}
+
 def _get_openstack_repo():
     """ Get the repository of the OpenStack packages, checking the location
             of the python-keystoneclient package """
+    if 'python-keystoneclient' not in _REPOQUERY_CACHE:
+        _REPOQUERY_CACHE['python-keystoneclient'] = _query_openstack_repo()
+    return _REPOQUERY_CACHE['python-keystoneclient']
+
+def _query_openstack_repo():
     cmd = 'repoquery -q --qf="%{location}" --show-duplicates python-keystoneclient'
     proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     (stdout_data, stderr_data) = proc.communicate()
@@ -76,14 +90,48 @@ def _get_snap_ver_from_mirrorurl(repo_url):
         return matched.groups()[0]
     raise NotFoundException('Puddle/poodle version not matched in repository URL %s' % (repo_url))
 
+def _changelog_lines(url):
+    """ Yield the lines of the changelog, reading it in ranges of
+        CHANGELOG_RANGE bytes if the server supports them """
+    offset = 0
+    pending = ''
+    while True:
+        req = urllib2.Request(url)
+        req.add_header('Range', 'bytes=%d-%d' % (offset, offset + CHANGELOG_RANGE - 1))
+        try:
+            snap_f = urllib2.urlopen(req)
+        except urllib2.HTTPError, err:
+            # the previous range ended exactly at the end of the file
+            if err.code == 416 and offset:
+                break
+            raise
+        try:
+            if snap_f.getcode() != 206:
+                # the whole file, stream it
+                for c_line in snap_f:
+                    yield c_line
+                return
+            data = snap_f.read()
+        finally:
+            snap_f.close()
+        lines = (pending + data).split('\n')
+        pending = lines.pop()
+        for c_line in lines:
+            yield c_line
+        if len(data) < CHANGELOG_RANGE:
+            break
+        offset += len(data)
+    if pending:
+        yield pending
+
 def _get_snap_ver_from_changelog(url):
-    """ Get the version from the changelog file """
+    """ Get the version from the changelog file, reading it only up to the
+        first matching line """
     LOGGER.debug('URL: %s:', url)
-    req = urllib2.Request(url)
-    error_message = 'Unknown error'
+    error_message = 'Version not found in %s' % url
+    lines = _changelog_lines(url)
     try:
-        snap_f = urllib2.urlopen(req)
-        for c_line in snap_f.readlines():
+        for c_line in lines:
             matched = PUDDLE_CHANGELOG_VER_RE.match(c_line.strip())
             if matched:
                 snapshot_type = 'puddle'
@@ -92,11 +140,14 @@ def _get_snap_ver_from_changelog(url):
                 return (snapshot_type, matched.groups()[0])
     except Exception, err:
         error_message = err
+    finally:
+        lines.close()
     raise NotFoundException(error_message)
 
-def _get_puddle_version():
-    """ Get the snapshot version and type (puddle/poodle) """
-    repo_url = _get_openstack_repo()
+def _get_snapshot_url(repo_url=None):
+    """ Get the base URL of the snapshot of the OpenStack repository """
+    if not repo_url:
+        repo_url = _get_openstack_repo()
     LOGGER.debug('REPO_URL: %s', repo_url)
     ver = _get_snap_ver_from_mirrorurl(repo_url)
     LOGGER.debug('VERSION: %s:', ver)
@@ -104,22 +155,33 @@ def _get_puddle_version():
     LOGGER.debug('VERSION_PATTERN: %s:', ver_pat)
     base_snapshot_url = repo_url[:repo_url.find(ver_pat) + len(ver_pat)]
     LOGGER.debug('BASE_SNAPSHOT_URL: %s:', base_snapshot_url)
-    (s_type, s_ver) = _get_snap_ver_from_changelog(base_snapshot_url + 'logs/changelog.log')
-    return (s_type, s_ver)
+    return base_snapshot_url
 
 def main():
     """ Main """
     module = AnsibleModule(
-        argument_spec = dict()
+        argument_spec = dict(
+            repo_url = dict(),
+            snapshots = dict(type='dict', default={}),
+            fetch = dict(type='bool', default=True),
+        )
     )
 
     try:
-        version_data = _get_puddle_version()
+        snapshot_url = _get_snapshot_url(module.params['repo_url'])
+        known = module.params['snapshots'].get(snapshot_url)
+        if known:
+            version_data = (known['type'], known['version'])
+        elif module.params['fetch']:
+            version_data = _get_snap_ver_from_changelog(snapshot_url + 'logs/changelog.log')
+        else:
+            module.exit_json(changed=False, snapshot_url=snapshot_url)
         ansible_facts = {
             'product_snapshot_type': version_data[0],
             'product_snapshot_version': version_data[1]
         }
-        module.exit_json(changed=True, ansible_facts=ansible_facts)
+        module.exit_json(changed=True, ansible_facts=ansible_facts,
+                         snapshot_url=snapshot_url, cached=bool(known))
     except NotFoundException, err:
         module.fail_json(msg='Error retrieving the snapshot type/version: %s' % (err))
 
@@ -30,19 +30,47 @@ options:
   dest:
     description:
     - The image file to create or remove
-    required: true
+    required: false
+  dests:
+    description:
+    - List of image files to create or remove, all with the same options.
+      The images are created concurrently. Either dest or dests is required.
+    required: false
   format:
     description:
     - The image format - default qcow2
     required: false
   size:
     description:
-    - The size of the image in megabytes.
+    - The size of the image in megabytes. Not required with backing_file,
+      the image then has the size of the backing file.
+    required: false
+  backing_file:
+    description:
+    - Create copy-on-write overlays of this image (qcow2), instead of
+      empty images. Existing images are not rebased.
+    required: false
+  backing_format:
+    description:
+    - The format of the backing file, detected when not set.
+    required: false
+  preallocation:
+    choices: [ "off", "metadata", "falloc", "full" ]
+    description:
+    - Preallocation mode of new images, can't be used with backing_file.
+    required: false
+  cluster_size:
+    description:
+    - Cluster size of new qcow2 images, e.g. 64K or 2M.
     required: false
   opt:
     description:
     - Comma separated list of format specific options in a name=value format.
     required: false
+  jobs:
+    description:
+    - How many images are created at the same time - default 10
+    required: false
   state:
     choices: [ "absent", "present" ]
     description:
@@ -55,61 +83,163 @@ examples:
     code: qemu_img dest=/tmp/testimg size=6 format=raw
   - description: Remove the image
     code: qemu_img dest=/tmp/testimg state=absent
+  - description: Clone the guest disks from one base image, enlarged to 40G
+    code: "qemu_img dests={{ guest_disks }} backing_file=/var/lib/libvirt/images/base.qcow2 size=40960"
+  - description: Create preallocated data disks
+    code: "qemu_img dests={{ data_disks }} size=10240 preallocation=metadata cluster_size=2M"
 notes:
   - This module does not change the type of the image.
+  - The result has the format, virtual size and backing file of each image
+    (from C(qemu-img info --output=json)) in C(images).
 '''
 
+import json
 import os
+import subprocess
+import time
+from multiprocessing.pool import ThreadPool
+
+
+class ImageError(Exception):
+    pass
+
+
+def _run(args):
+    # runs in the worker threads: module.run_command would fail the module
+    # from the thread and changes the process' environment and cwd
+    try:
+        proc = subprocess.Popen(args, stdin=open(os.devnull),
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, close_fds=True)
+    except OSError, e:
+        raise ImageError('Unable to run %s: %s' % (' '.join(args), e))
+    stdout, stderr = proc.communicate()
+    if proc.returncode != 0:
+        raise ImageError('%s failed (rc=%d): %s' % (' '.join(args), proc.returncode,
+                                                    stderr.strip() or stdout.strip()))
+    return stdout
+
+
+def _info(qemu_img, path):
+    try:
+        info = json.loads(_run([qemu_img, 'info', '--output=json', path]))
+    except ValueError, e:
+        raise ImageError('Unable to read the image info of %s: %s' % (path, e))
+    return {
+        'format': info.get('format'),
+        'virtual_size': info.get('virtual-size'),
+        'actual_size': info.get('actual-size'),
+        'backing_file': info.get('backing-filename'),
+    }
+
+
+def _create_args(module, qemu_img, dest, size):
+    params = module.params
+    args = [qemu_img, 'create', '-f', params['format']]
+    if params['backing_file']:
+        args.extend(['-b', params['backing_file']])
+        if params['backing_format']:
+            args.extend(['-F', params['backing_format']])
+    options = []
+    if params['opt']:
+        options.append(params['opt'])
+    if params['preallocation']:
+        options.append('preallocation=%s' % params['preallocation'])
+    if params['cluster_size']:
+        options.append('cluster_size=%s' % params['cluster_size'])
+    if options:
+        args.extend(['-o', ','.join(options)])
+    args.append(dest)
+    if size:
+        args.append(str(size))
+    return args
+
+
+def _ensure_present(module, qemu_img, dest, size):
+    changed = False
+    if not os.path.exists(dest):
+        _run(_create_args(module, qemu_img, dest, size))
+        changed = True
+    info = _info(qemu_img, dest)
+    if not info['virtual_size']:
+        raise ImageError('Unable to read virtual disk size of %s' % dest)
+    if size and info['virtual_size'] != size:
+        _run([qemu_img, 'resize', dest, str(size)])
+        info['virtual_size'] = size
+        changed = True
+    return changed, info
+
+
+def _ensure_absent(module, dest):
+    if os.path.exists(dest):
+        os.remove(dest)
+        return True, {}
+    return False, {}
+
 
 def main():
 
     module = AnsibleModule(
         argument_spec = dict(
-            dest=dict(type='str', required=True),
+            dest=dict(type='str'),
+            dests=dict(type='list'),
             opt=dict(type='str'),
             format=dict(type='str', default='qcow2'),
             size=dict(type='int'),
+            backing_file=dict(type='str'),
+            backing_format=dict(type='str'),
+            preallocation=dict(type='str', choices=['off', 'metadata', 'falloc', 'full']),
+            cluster_size=dict(type='str'),
+            jobs=dict(type='int', default=10),
             state=dict(type='str', choices=['absent', 'present'], default='present'),
         ),
+        required_one_of=[['dest', 'dests']],
+        mutually_exclusive=[['dest', 'dests'], ['backing_file', 'preallocation']],
     )
 
-    changed = False
     qemu_img = module.get_bin_path('qemu-img', True)
 
-    dest = module.params['dest']
-    img_format = module.params['format']
-    opt = module.params['opt']
+    dests = module.params['dests'] or [module.params['dest']]
+    size = None
 
     if module.params['state'] == 'present':
-        if not module.params['size']:
+        if module.params['size']:
+            size = module.params['size'] * 1024 * 1024
+        elif not module.params['backing_file']:
             module.fail_json(msg="Parameter 'size' required")
-        size = module.params['size'] * 1024 * 1024
+        if module.params['backing_file'] and not os.path.exists(module.params['backing_file']):
+            module.fail_json(msg="Backing file %s not found" % module.params['backing_file'])
 
-        if not os.path.exists(dest):
-            if not opt:
-                module.run_command('%s create -f %s "%s" %s'%(qemu_img, img_format, dest, size), check_rc=True)
+    def ensure(dest):
+        start = time.time()
+        try:
+            if module.params['state'] == 'present':
+                changed, info = _ensure_present(module, qemu_img, dest, size)
             else:
-                module.run_command('%s create -f %s -o %s "%s" %s'%(qemu_img, img_format, opt, dest, size), check_rc=True)
-            changed = True
-        else:
-            rc, stdout, _ = module.run_command('%s info "%s"'%(qemu_img, dest), check_rc=True)
-            current_size = None
-            for line in stdout.splitlines():
-                if 'virtual size' in line:
-                    ### virtual size: 5.0M (5242880 bytes)
-                    current_size = int(line.split('(')[1].split()[0])
-            if not current_size:
-                module.fail_json(msg='Unable to read virtual disk size of %s'%(dest))
-            if current_size != size:
-                module.run_command('%s resize "%s" %s'%(qemu_img, dest, size), check_rc=True)
-                changed = True
-
-    if module.params['state'] == 'absent':
-        if os.path.exists(dest):
-            os.remove(dest)
-            changed = True
-
-    module.exit_json(changed=changed)
+                changed, info = _ensure_absent(module, dest)
+        except (ImageError, OSError), e:
+            return dest, False, None, str(e)
+        info['changed'] = changed
+        info['duration'] = round(time.time() - start, 3)
+        return dest, changed, info, None
+
+    if len(dests) == 1:
+        results = [ensure(dests[0])]
+    else:
+        pool = ThreadPool(max(1, min(module.params['jobs'], len(dests))))
+        try:
+            results = pool.map(ensure, dests)
+        finally:
+            pool.close()
+            pool.join()
+
+    changed = any(result[1] for result in results)
+    images = dict((dest, info) for dest, _, info, error in results if not error)
+    errors = dict((dest, error) for dest, _, _, error in results if error)
+    if errors:
+        module.fail_json(msg='; '.join(errors[dest] for dest in sorted(errors)),
+                         changed=changed, images=images, errors=errors)
+    module.exit_json(changed=changed, images=images)
 
 # this is magic, see lib/ansible/module_common.py
 #<<INCLUDE_ANSIBLE_MODULE_COMMON>>
@@ -16,11 +16,21 @@
 # You should have received a copy of the GNU General Public License
 # along with this software.  If not, see <http://www.gnu.org/licenses/>.
 
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
 try:
     try:
         from neutronclient.neutron import client
     except ImportError:
         from quantumclient.quantum import client
+    from keystoneclient import access
+    from keystoneclient import exceptions as ks_exceptions
     from keystoneclient.v2_0 import client as ksclient
 except ImportError:
     print("failed=True msg='quantumclient (or neutronclient) and keystone client are required'")
@@ -93,18 +103,130 @@ EXAMPLES = '''
 _os_keystone = None
 _os_tenant_id = None
 
+# BEGIN keystone cache
+# Keystone tokens (with the service catalog) and the tenant ids listed with
+# them are cached on disk between the module runs, per auth_url and
+# credentials. Ansible 1.x modules can't share code, this block is repeated
+# in our modules using keystone and checked to be identical by
+# tools/check_module_blocks.sh. KHALEESI_KEYSTONE_CACHE set to empty string
+# disables the cache.
+KEYSTONE_CACHE = os.environ.get('KHALEESI_KEYSTONE_CACHE', os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'khaleesi', 'keystone.json'))
+# cached token is used only while it's valid at least this many seconds
+KEYSTONE_CACHE_MARGIN = 300
+
+_os_keystone_key = None
+# tenant name -> id, listed with the token
+_os_tenants = None
+# the token refused by a service was renewed
+_os_keystone_renewed = False
+
+def _keystone_cache_key(kwargs):
+    credentials = json.dumps([kwargs.get(name) for name in (
+        'auth_url', 'login_username', 'login_password', 'login_tenant_name')])
+    return hashlib.sha1(credentials).hexdigest()
+
+@contextlib.contextmanager
+def _keystone_cache():
+    # yields the cache locked against other jobs, writes it back if changed;
+    # it's held only to read or update the file, never around a request
+    if not KEYSTONE_CACHE:
+        yield {}
+        return
+    cache_dir = os.path.dirname(KEYSTONE_CACHE)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+    with open(KEYSTONE_CACHE + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(KEYSTONE_CACHE) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            cache = {}
+        before = json.dumps(cache, sort_keys=True)
+        yield cache
+        if json.dumps(cache, sort_keys=True) != before:
+            # readable only by the user, as mkstemp creates it
+            fd, tmp = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f)
+            os.rename(tmp, KEYSTONE_CACHE)
+
+def _keystone_cached(cache):
+    # the entry of our credentials if it still holds our token
+    entry = cache.get(_os_keystone_key)
+    if entry and access.AccessInfo.factory(
+            **entry['auth_ref']).auth_token == _os_keystone.auth_token:
+        return entry
+    return None
+
 def _get_ksclient(module, kwargs):
+    # a cached token is used without asking keystone, it's renewed only
+    # when a request made with it gets a 401, see _keystone_refused
+    global _os_keystone, _os_keystone_key, _os_tenants
+    _os_keystone_key = _keystone_cache_key(kwargs)
+    credentials = dict(username=kwargs.get('login_username'),
+                       password=kwargs.get('login_password'),
+                       tenant_name=kwargs.get('login_tenant_name'),
+                       auth_url=kwargs.get('auth_url'))
     try:
-        kclient = ksclient.Client(username=kwargs.get('login_username'),
-                                 password=kwargs.get('login_password'),
-                                 tenant_name=kwargs.get('login_tenant_name'),
-                                 auth_url=kwargs.get('auth_url'))
+        with _keystone_cache() as cache:
+            entry = cache.get(_os_keystone_key) or {}
+        auth_ref = entry.get('auth_ref')
+        if auth_ref and not access.AccessInfo.factory(
+                **auth_ref).will_expire_soon(KEYSTONE_CACHE_MARGIN):
+            kclient = ksclient.Client(auth_ref=auth_ref, **credentials)
+            _os_tenants = entry.get('tenants')
+        else:
+            kclient = ksclient.Client(**credentials)
+            _os_tenants = None
+            with _keystone_cache() as cache:
+                cache[_os_keystone_key] = {'auth_ref': dict(kclient.auth_ref)}
     except Exception, e:
-        module.fail_json(msg = "Error authenticating to the keystone: %s " % e.message)
-    global _os_keystone
+        module.fail_json(msg = "Error authenticating to the keystone: %s" % e)
     _os_keystone = kclient
     return kclient
 
+def _keystone_refused(module):
+    # the token was refused, revoked or of a cloud redeployed at the same
+    # URL: it's dropped and main() is run again from the start with a new
+    # token and tenant ids, our modules look at the state before changing
+    # it. Returns only if that's not possible, the token was renewed
+    # already or this is a worker thread.
+    global _os_keystone_renewed
+    if _os_keystone_renewed or threading.current_thread().name != 'MainThread':
+        return
+    _os_keystone_renewed = True
+    try:
+        with _keystone_cache() as cache:
+            if _keystone_cached(cache):
+                del cache[_os_keystone_key]
+    except Exception, e:
+        module.fail_json(msg = "Error renewing the keystone token: %s" % e)
+    main()
+
+def _get_tenant_id(module, tenant_name):
+    global _os_tenants
+    if tenant_name not in (_os_tenants or {}):
+        try:
+            _os_tenants = dict((tenant.name, tenant.id)
+                               for tenant in _os_keystone.tenants.list())
+            with _keystone_cache() as cache:
+                entry = _keystone_cached(cache)
+                if entry:
+                    entry['tenants'] = _os_tenants
+        except Exception, e:
+            if isinstance(e, ks_exceptions.Unauthorized):
+                _keystone_refused(module)
+            module.fail_json(msg = "Error in listing tenants: %s" % e)
+    return _os_tenants.get(tenant_name)
+# END keystone cache
+
 
 def _get_endpoint(module, ksclient):
     try:
@@ -126,6 +248,8 @@ def _get_neutron_client(module, kwargs):
         neutron = client.Client('2.0', **kwargs)
     except Exception, e:
         module.fail_json(msg = "Error in connecting to neutron: %s " % e.message)
+    # the client authenticates again when the token is refused
+    neutron.httpclient.authenticate = lambda: _keystone_refused(module)
     return neutron
 
 def _set_tenant_id(module):
@@ -135,10 +259,7 @@ def _set_tenant_id(module):
     else:
         login_tenant_name = module.params['tenant_name']
 
-        for tenant in _os_keystone.tenants.list():
-            if tenant.name == login_tenant_name:
-                _os_tenant_id = tenant.id
-                break
+        _os_tenant_id = _get_tenant_id(module, login_tenant_name)
     if not _os_tenant_id:
             module.fail_json(msg = "The tenant id cannot be found, please check the parameters")
 
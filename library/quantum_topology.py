@@ -0,0 +1,613 @@
+#!/usr/bin/python
+#coding: utf-8 -*-
+
+# (c) 2016, Red Hat, Inc.
+#
+# This module is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+    try:
+        from neutronclient.neutron import client
+    except ImportError:
+        from quantumclient.quantum import client
+    from keystoneclient import access
+    from keystoneclient import exceptions as ks_exceptions
+    from keystoneclient.v2_0 import client as ksclient
+except ImportError:
+    print("failed=True msg='quantumclient (or neutronclient) and keystone client are required'")
+
+DOCUMENTATION = '''
+---
+module: quantum_topology
+short_description: Creates/Removes a whole network topology in OpenStack
+description:
+   - Add or Remove networks, subnets, routers, router gateways and router
+     interfaces of a tenant in one task. The current state is read by one
+     listing of each kind of objects, the missing objects are created by
+     Neutron bulk requests (one request per kind where the plugin supports
+     it) and the routers are configured concurrently.
+   - Objects are matched by name within the tenant, networks used as router
+     gateways by name among all the networks (external ones first).
+options:
+   login_username:
+     description:
+        - login username to authenticate to keystone
+     required: true
+     default: admin
+   login_password:
+     description:
+        - Password of login user
+     required: true
+     default: 'yes'
+   login_tenant_name:
+     description:
+        - The tenant name of the login user
+     required: true
+     default: 'yes'
+   tenant_name:
+     description:
+        - The name of the tenant for whom the topology is created
+     required: false
+     default: None
+   auth_url:
+     description:
+        - The keystone url for authentication
+     required: false
+     default: 'http://127.0.0.1:35357/v2.0/'
+   region_name:
+     description:
+        - Name of the region
+     required: false
+     default: None
+   state:
+     description:
+        - Indicate desired state of the resources, with absent the routers,
+          then the subnets and the networks are removed
+     choices: ['present', 'absent']
+     default: present
+   networks:
+     description:
+        - List of networks, each a dict with name and optionally shared,
+          admin_state_up, router_external, provider_network_type,
+          provider_physical_network and provider_segmentation_id as in
+          quantum_network
+     required: false
+     default: []
+   subnets:
+     description:
+        - List of subnets, each a dict with name, network_name, cidr and
+          optionally ip_version, enable_dhcp, gateway_ip, dns_nameservers
+          (list or comma separated), allocation_pool_start and
+          allocation_pool_end as in quantum_subnet
+     required: false
+     default: []
+   routers:
+     description:
+        - List of routers, each a dict with name and optionally gateway (name
+          of the external network) and interfaces (list of subnet names)
+     required: false
+     default: []
+   jobs:
+     description:
+        - Number of requests to Neutron sent concurrently
+     required: false
+     default: 10
+requirements: ["quantumclient", "neutronclient", "keystoneclient"]
+'''
+
+EXAMPLES = '''
+# Private network of tenant demo, routed to the public network
+- quantum_topology:
+    state: present
+    login_username: admin
+    login_password: admin
+    login_tenant_name: admin
+    tenant_name: demo
+    networks:
+      - name: private
+    subnets:
+      - name: private_subnet
+        network_name: private
+        cidr: 192.168.100.0/24
+        dns_nameservers: [8.8.8.8, 8.8.4.4]
+    routers:
+      - name: routerd1
+        gateway: public
+        interfaces: [private_subnet]
+  register: topology
+# topology.networks.private, topology.subnets.private_subnet and
+# topology.routers.routerd1 are the ids, topology.interfaces.routerd1 maps
+# the subnet names to the ids of the router ports
+'''
+
+_os_keystone = None
+_os_tenant_id = None
+
+# BEGIN keystone cache
+# Keystone tokens (with the service catalog) and the tenant ids listed with
+# them are cached on disk between the module runs, per auth_url and
+# credentials. Ansible 1.x modules can't share code, this block is repeated
+# in our modules using keystone and checked to be identical by
+# tools/check_module_blocks.sh. KHALEESI_KEYSTONE_CACHE set to empty string
+# disables the cache.
+KEYSTONE_CACHE = os.environ.get('KHALEESI_KEYSTONE_CACHE', os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'khaleesi', 'keystone.json'))
+# cached token is used only while it's valid at least this many seconds
+KEYSTONE_CACHE_MARGIN = 300
+
+_os_keystone_key = None
+# tenant name -> id, listed with the token
+_os_tenants = None
+# the token refused by a service was renewed
+_os_keystone_renewed = False
+
+def _keystone_cache_key(kwargs):
+    credentials = json.dumps([kwargs.get(name) for name in (
+        'auth_url', 'login_username', 'login_password', 'login_tenant_name')])
+    return hashlib.sha1(credentials).hexdigest()
+
+@contextlib.contextmanager
+def _keystone_cache():
+    # yields the cache locked against other jobs, writes it back if changed;
+    # it's held only to read or update the file, never around a request
+    if not KEYSTONE_CACHE:
+        yield {}
+        return
+    cache_dir = os.path.dirname(KEYSTONE_CACHE)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+    with open(KEYSTONE_CACHE + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(KEYSTONE_CACHE) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            cache = {}
+        before = json.dumps(cache, sort_keys=True)
+        yield cache
+        if json.dumps(cache, sort_keys=True) != before:
+            # readable only by the user, as mkstemp creates it
+            fd, tmp = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f)
+            os.rename(tmp, KEYSTONE_CACHE)
+
+def _keystone_cached(cache):
+    # the entry of our credentials if it still holds our token
+    entry = cache.get(_os_keystone_key)
+    if entry and access.AccessInfo.factory(
+            **entry['auth_ref']).auth_token == _os_keystone.auth_token:
+        return entry
+    return None
+
+def _get_ksclient(module, kwargs):
+    # a cached token is used without asking keystone, it's renewed only
+    # when a request made with it gets a 401, see _keystone_refused
+    global _os_keystone, _os_keystone_key, _os_tenants
+    _os_keystone_key = _keystone_cache_key(kwargs)
+    credentials = dict(username=kwargs.get('login_username'),
+                       password=kwargs.get('login_password'),
+                       tenant_name=kwargs.get('login_tenant_name'),
+                       auth_url=kwargs.get('auth_url'))
+    try:
+        with _keystone_cache() as cache:
+            entry = cache.get(_os_keystone_key) or {}
+        auth_ref = entry.get('auth_ref')
+        if auth_ref and not access.AccessInfo.factory(
+                **auth_ref).will_expire_soon(KEYSTONE_CACHE_MARGIN):
+            kclient = ksclient.Client(auth_ref=auth_ref, **credentials)
+            _os_tenants = entry.get('tenants')
+        else:
+            kclient = ksclient.Client(**credentials)
+            _os_tenants = None
+            with _keystone_cache() as cache:
+                cache[_os_keystone_key] = {'auth_ref': dict(kclient.auth_ref)}
+    except Exception, e:
+        module.fail_json(msg = "Error authenticating to the keystone: %s" % e)
+    _os_keystone = kclient
+    return kclient
+
+def _keystone_refused(module):
+    # the token was refused, revoked or of a cloud redeployed at the same
+    # URL: it's dropped and main() is run again from the start with a new
+    # token and tenant ids, our modules look at the state before changing
+    # it. Returns only if that's not possible, the token was renewed
+    # already or this is a worker thread.
+    global _os_keystone_renewed
+    if _os_keystone_renewed or threading.current_thread().name != 'MainThread':
+        return
+    _os_keystone_renewed = True
+    try:
+        with _keystone_cache() as cache:
+            if _keystone_cached(cache):
+                del cache[_os_keystone_key]
+    except Exception, e:
+        module.fail_json(msg = "Error renewing the keystone token: %s" % e)
+    main()
+
+def _get_tenant_id(module, tenant_name):
+    global _os_tenants
+    if tenant_name not in (_os_tenants or {}):
+        try:
+            _os_tenants = dict((tenant.name, tenant.id)
+                               for tenant in _os_keystone.tenants.list())
+            with _keystone_cache() as cache:
+                entry = _keystone_cached(cache)
+                if entry:
+                    entry['tenants'] = _os_tenants
+        except Exception, e:
+            if isinstance(e, ks_exceptions.Unauthorized):
+                _keystone_refused(module)
+            module.fail_json(msg = "Error in listing tenants: %s" % e)
+    return _os_tenants.get(tenant_name)
+# END keystone cache
+
+
+def _get_endpoint(module, ksclient):
+    try:
+        endpoint = ksclient.service_catalog.url_for(service_type='network', endpoint_type='publicURL')
+    except Exception, e:
+        module.fail_json(msg = "Error getting network endpoint: %s " %e.message)
+    return endpoint
+
+def _get_neutron_client(module, kwargs):
+    _ksclient = _get_ksclient(module, kwargs)
+    token = _ksclient.auth_token
+    endpoint = _get_endpoint(module, _ksclient)
+    kwargs = {
+            'token': token,
+            'endpoint_url': endpoint,
+            'insecure': module.params['insecure']
+    }
+    try:
+        neutron = client.Client('2.0', **kwargs)
+    except Exception, e:
+        module.fail_json(msg = " Error in connecting to neutron: %s " %e.message)
+    # the client authenticates again when the token is refused
+    neutron.httpclient.authenticate = lambda: _keystone_refused(module)
+    return neutron
+
+def _set_tenant_id(module):
+    global _os_tenant_id
+    if not module.params['tenant_name']:
+        _os_tenant_id = _os_keystone.tenant_id
+    else:
+        tenant_name = module.params['tenant_name']
+
+        _os_tenant_id = _get_tenant_id(module, tenant_name)
+    if not _os_tenant_id:
+        module.fail_json(msg = "The tenant id cannot be found, please check the parameters")
+
+
+
+def _run_tasks(jobs, tasks):
+    """
+    runs the (label, function) tasks concurrently, returns their results in
+    the same order and the errors of the failed tasks; the workers never
+    fail the module, only the main thread may
+    """
+    if not tasks:
+        return [], []
+
+    def run(task):
+        label, func = task
+        try:
+            return True, func()
+        except Exception, e:
+            return False, "%s: %s" % (label, e)
+
+    pool = ThreadPool(max(1, min(jobs, len(tasks))))
+    try:
+        results = pool.map(run, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    return ([result if ok else None for ok, result in results],
+            [result for ok, result in results if not ok])
+
+
+def _run_all(module, tasks):
+    """
+    runs the (label, function) tasks concurrently, returns their results in
+    the same order; fails with the errors of all the failed tasks
+    """
+    results, errors = _run_tasks(module.params['jobs'], tasks)
+    if errors:
+        module.fail_json(msg = '\n'.join(errors))
+    return results
+
+
+def _create_all(module, neutron, resources):
+    """
+    creates the (resource, bodies) by one bulk request per resource, or
+    concurrently one by one when the request fails (bulk isn't supported by
+    all the plugins); returns the created objects of each resource
+    """
+    def bulk(resource, bodies):
+        return getattr(neutron, 'create_' + resource)(
+            {resource + 's': bodies})[resource + 's']
+
+    bulk_resources = [(resource, bodies) for resource, bodies in resources
+                      if len(bodies) > 1]
+    results, _ = _run_tasks(module.params['jobs'], [
+        (resource, lambda resource=resource, bodies=bodies:
+                       bulk(resource, bodies))
+        for resource, bodies in bulk_resources])
+    created = dict((resource, objects) for (resource, _), objects
+                   in zip(bulk_resources, results) if objects is not None)
+
+    # the bodies of the failed bulk requests, all in one pool
+    single = [(resource, body) for resource, bodies in resources
+              if resource not in created for body in bodies]
+    results, errors = _run_tasks(module.params['jobs'], [
+        ("Error in creating %s %s" % (resource, body['name']),
+         lambda resource=resource, body=body:
+             getattr(neutron, 'create_' + resource)({resource: body})[resource])
+        for resource, body in single])
+    if errors:
+        module.fail_json(msg = '\n'.join(errors))
+    for (resource, _), obj in zip(single, results):
+        created.setdefault(resource, []).append(obj)
+    return [created.get(resource, []) for resource, _ in resources]
+
+
+def _read_state(module, neutron):
+    """ current objects, one listing of each kind """
+    try:
+        networks = neutron.list_networks()['networks']
+        subnets = neutron.list_subnets(tenant_id=_os_tenant_id)['subnets']
+        routers = neutron.list_routers(tenant_id=_os_tenant_id)['routers']
+        ports = []
+        if routers:
+            ports = neutron.list_ports(
+                device_owner='network:router_interface',
+                device_id=[router['id'] for router in routers])['ports']
+    except Exception, e:
+        module.fail_json(msg = "Error in listing neutron objects: %s" % e)
+
+    interfaces = {}
+    for port in ports:
+        for fixed_ip in port['fixed_ips']:
+            interfaces.setdefault(port['device_id'], {})[
+                fixed_ip['subnet_id']] = port['id']
+    return {
+        'networks': dict((net['name'], net) for net in networks
+                         if net['tenant_id'] == _os_tenant_id),
+        # gateways may be any network, external ones take precedence
+        'all_networks': dict((net['name'], net) for net in sorted(
+            networks, key=lambda net: bool(net.get('router:external')))),
+        'subnets': dict((subnet['name'], subnet) for subnet in subnets),
+        'routers': dict((router['name'], router) for router in routers),
+        # router id -> subnet id -> port id
+        'interfaces': interfaces,
+    }
+
+
+def _to_bool(value):
+    if isinstance(value, basestring):
+        return value.lower() in BOOLEANS_TRUE
+    return bool(value)
+
+
+def _network_body(network):
+    body = {
+        'name':            network['name'],
+        'tenant_id':       _os_tenant_id,
+        'admin_state_up':  _to_bool(network.get('admin_state_up', True)),
+        'shared':          _to_bool(network.get('shared', False)),
+        'router:external': _to_bool(network.get('router_external', False)),
+    }
+    network_type = network.get('provider_network_type')
+    if network_type:
+        body['provider:network_type'] = network_type
+        if network_type in ('vlan', 'flat'):
+            body['provider:physical_network'] = network.get(
+                'provider_physical_network')
+        if network_type in ('vlan', 'gre'):
+            body['provider:segmentation_id'] = network.get(
+                'provider_segmentation_id')
+    return body
+
+
+def _subnet_body(subnet, network_id):
+    body = {
+        'name':        subnet['name'],
+        'network_id':  network_id,
+        'tenant_id':   _os_tenant_id,
+        'ip_version':  int(subnet.get('ip_version', 4)),
+        'enable_dhcp': _to_bool(subnet.get('enable_dhcp', True)),
+        'cidr':        subnet['cidr'],
+    }
+    if subnet.get('gateway_ip'):
+        body['gateway_ip'] = subnet['gateway_ip']
+    dns_nameservers = subnet.get('dns_nameservers')
+    if dns_nameservers:
+        if isinstance(dns_nameservers, basestring):
+            dns_nameservers = dns_nameservers.split(',')
+        body['dns_nameservers'] = dns_nameservers
+    if subnet.get('allocation_pool_start') and subnet.get('allocation_pool_end'):
+        body['allocation_pools'] = [{
+            'start': subnet['allocation_pool_start'],
+            'end':   subnet['allocation_pool_end'],
+        }]
+    return body
+
+
+def _present(module, neutron, state):
+    networks = module.params['networks']
+    subnets = module.params['subnets']
+    routers = module.params['routers']
+
+    # networks and routers don't depend on anything
+    new_networks = [_network_body(net) for net in networks
+                    if net['name'] not in state['networks']]
+    new_routers = [{'name': router['name'], 'tenant_id': _os_tenant_id}
+                   for router in routers
+                   if router['name'] not in state['routers']]
+    created_networks, created_routers = _create_all(module, neutron, [
+        ('network', new_networks), ('router', new_routers)])
+    for net in created_networks:
+        state['networks'][net['name']] = state['all_networks'][net['name']] = net
+    for router in created_routers:
+        state['routers'][router['name']] = router
+    changed = bool(new_networks or new_routers)
+
+    new_subnets = []
+    for subnet in subnets:
+        if subnet['name'] in state['subnets']:
+            continue
+        network = state['networks'].get(subnet['network_name'])
+        if not network:
+            module.fail_json(msg = "Network %s of subnet %s not found" % (
+                subnet['network_name'], subnet['name']))
+        new_subnets.append(_subnet_body(subnet, network['id']))
+    for subnet in _create_all(module, neutron, [('subnet', new_subnets)])[0]:
+        state['subnets'][subnet['name']] = subnet
+    changed = changed or bool(new_subnets)
+
+    # each router is configured by its own thread, interfaces of one router
+    # are added one by one as neutron updates the router for each of them
+    def configure(router):
+        router_id = state['routers'][router['name']]['id']
+        router_changed = False
+        if router.get('gateway'):
+            network = state['all_networks'].get(router['gateway'])
+            if not network:
+                raise Exception("Gateway network %s not found"
+                                % router['gateway'])
+            gateway = state['routers'][router['name']].get(
+                'external_gateway_info') or {}
+            if gateway.get('network_id') != network['id']:
+                neutron.add_gateway_router(router_id,
+                                           {'network_id': network['id']})
+                router_changed = True
+        interfaces = state['interfaces'].setdefault(router_id, {})
+        for subnet_name in router.get('interfaces', []):
+            subnet = state['subnets'].get(subnet_name)
+            if not subnet:
+                raise Exception("Subnet %s not found" % subnet_name)
+            if subnet['id'] not in interfaces:
+                port = neutron.add_interface_router(
+                    router_id, {'subnet_id': subnet['id']})
+                interfaces[subnet['id']] = port['port_id']
+                router_changed = True
+        return router_changed
+
+    changed = any(_run_all(module, [
+        ("Error in configuring router %s" % router['name'],
+         lambda router=router: configure(router))
+        for router in routers])) or changed
+
+    subnet_names = dict((subnet['id'], name)
+                        for name, subnet in state['subnets'].items())
+    interfaces = {}
+    for router in routers:
+        router_id = state['routers'][router['name']]['id']
+        interfaces[router['name']] = dict(
+            (subnet_names.get(subnet_id, subnet_id), port_id)
+            for subnet_id, port_id in state['interfaces'][router_id].items())
+    module.exit_json(
+        changed=changed,
+        networks=dict((net['name'], state['networks'][net['name']]['id'])
+                      for net in networks),
+        subnets=dict((subnet['name'], state['subnets'][subnet['name']]['id'])
+                     for subnet in subnets),
+        routers=dict((router['name'],
+                      state['routers'][router['name']]['id'])
+                     for router in routers),
+        interfaces=interfaces)
+
+
+def _absent(module, neutron, state):
+    def remove_router(router):
+        for port_id in state['interfaces'].get(router['id'], {}).values():
+            neutron.remove_interface_router(router['id'], {'port_id': port_id})
+        if router.get('external_gateway_info'):
+            neutron.remove_gateway_router(router['id'])
+        neutron.delete_router(router['id'])
+
+    routers = [state['routers'][router['name']]
+               for router in module.params['routers']
+               if router['name'] in state['routers']]
+    _run_all(module, [
+        ("Error in deleting router %s" % router['name'],
+         lambda router=router: remove_router(router))
+        for router in routers])
+
+    # deleting a network deletes its subnets
+    networks = [state['networks'][net['name']]
+                for net in module.params['networks']
+                if net['name'] in state['networks']]
+    network_ids = set(net['id'] for net in networks)
+    subnets = [state['subnets'][subnet['name']]
+               for subnet in module.params['subnets']
+               if subnet['name'] in state['subnets'] and
+               state['subnets'][subnet['name']]['network_id'] not in network_ids]
+    _run_all(module, [
+        ("Error in deleting subnet %s" % subnet['name'],
+         lambda subnet=subnet: neutron.delete_subnet(subnet['id']))
+        for subnet in subnets])
+    _run_all(module, [
+        ("Error in deleting network %s" % net['name'],
+         lambda net=net: neutron.delete_network(net['id']))
+        for net in networks])
+    module.exit_json(changed=bool(routers or subnets or networks),
+                     result="deleted")
+
+
+def main():
+
+    argument_spec = openstack_argument_spec()
+    argument_spec.update(dict(
+            tenant_name                     = dict(default=None),
+            networks                        = dict(default=[], type='list'),
+            subnets                         = dict(default=[], type='list'),
+            routers                         = dict(default=[], type='list'),
+            jobs                            = dict(default=10, type='int'),
+            state                           = dict(default='present', choices=['absent', 'present']),
+            insecure                        = dict(default=False, type='bool'),
+    ))
+    module = AnsibleModule(argument_spec=argument_spec)
+    for kind in ('networks', 'subnets', 'routers'):
+        names = [item.get('name') for item in module.params[kind]]
+        if not all(names) or len(set(names)) != len(names):
+            module.fail_json(msg = "All %s need an unique name" % kind)
+
+    neutron = _get_neutron_client(module, module.params)
+    neutron.format = 'json'
+    _set_tenant_id(module)
+    state = _read_state(module, neutron)
+    if module.params['state'] == 'present':
+        _present(module, neutron, state)
+    else:
+        _absent(module, neutron, state)
+
+# this is magic, see lib/ansible/module_common.py
+from ansible.module_utils.basic import *
+from ansible.module_utils.openstack import *
+main()
@@ -38,7 +38,8 @@ options:
     required: true
   step:
     description:
-    - The step of the deployment to perform
+    - The step of the deployment to perform, or a list of steps performed
+      in order in one run (the pages and ids are read once)
     required: true
   staypuft_session:
     description:
@@ -52,6 +53,23 @@ options:
     description:
     - A dictionary that maps subnets to hosts in a hostgroup
     required: false
+  associate_hosts_map:
+    description:
+    - A dictionary that maps hostgroups to the number of discovered hosts
+      to assign to them
+    required: false
+  jobs:
+    description:
+    - How many requests of a step are sent at the same time
+    required: false
+    default: 8
+  validate_certs:
+    description:
+    - If C(no), the SSL certificate of the staypuft host is not checked.
+      Only set it to C(no) for a host with a self-signed certificate.
+    required: false
+    default: "yes"
+    choices: ["yes", "no"]
 examples:
   vars:
       staypuft_session:
@@ -68,24 +86,23 @@ examples:
           deployment_id=6
           staypuft_session="{{ staypuft_session }}"
           typings_map="{{ typings_map}}"
+          validate_certs=no
 '''
 
 from bs4 import BeautifulSoup
-import urllib2, urllib
+from multiprocessing.pool import ThreadPool
 import ast
+import requests
 
-class NoRedirectHandler(urllib2.HTTPRedirectHandler):
-    def http_error_302(self, req, fp, code, msg, headers):
-        infourl = urllib.addinfourl(fp, headers, req.get_full_url())
-        infourl.status = code
-        infourl.code = code
-        return infourl
-    http_error_300 = http_error_302
-    http_error_301 = http_error_302
-    http_error_303 = http_error_302
-    http_error_307 = http_error_302
+JS_ACCEPT = 'text/javascript, application/javascript, application/ecmascript, application/x-ecmascript'
 
 class Staypuft(object):
+    """
+    Talks to staypuft over one keep-alive session, the parsed pages and
+    the maps of names to ids are kept for the whole run, so several steps
+    read them once. The POSTs of a step are independent, they are sent
+    by up to `jobs` threads at the same time.
+    """
 
     def __init__(self, params):
         self.params = params
@@ -94,87 +111,107 @@ class Staypuft(object):
         staypuft_session=ast.literal_eval(self.params['staypuft_session'])
         self.staypuft_session_cookie = staypuft_session['cookie']
         self.staypuft_session_token = staypuft_session['token']
-        self.step = params['step']
-
-        if self.step == "subnet-typings":
+        self.jobs = max(1, int(self.params.get('jobs') or 1))
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.jobs)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Cookie'] = self.staypuft_session_cookie
+        # passed to each request, a session.verify of False is overridden
+        # by REQUESTS_CA_BUNDLE
+        self.verify = self.params['validate_certs']
+
+        self._pages = {}
+        self.subnet_map = {}
+        self.subnet_type_map = {}
+        self.deploy_hostgroups = {}
+        self.hostgroup_to_hosts_ids_map = {}
+        self.discovered_hosts_ids = []
+        self.associate_hosts_id_map = {}
+
+    def prepare(self, step):
+        if step == "subnet-typings":
             self.typings_map = ast.literal_eval(self.params['typings_map'])
-
-            self.subnet_map= {}
-            self.subnet_type_map = {}
             self.get_subnets()
             self.get_subnets_types()
 
-        if self.step == "gather-ips":
-
-            self.deploy_hostgroups = {}
-
+        if step == "gather-ips":
             self.get_deploy_hostgroups()
 
-        if self.step == "interface-assignments":
+        if step == "interface-assignments":
             self.interface_assignments_map = ast.literal_eval(self.params['interface_assignments_map'])
-
-            self.deploy_hostgroups = {}
-            self.hostgroup_to_hosts_ids_map = {}
-            self.subnet_map= {}
-
             self.get_subnets()
             self.get_deploy_hostgroups()
+            # hosts change with the associations, always read them again
             self.map_hostgrous_to_hosts_ids()
 
-        if self.step == "associate-discovered-hosts":
+        if step == "associate-discovered-hosts":
             self.associate_hosts_map = ast.literal_eval(self.params['associate_hosts_map'])
-
-            self.deploy_hostgroups = {}
-            self.discovered_hosts_ids = []
-            self.associate_hosts_id_map = {}
-
             self.get_deploy_hostgroups()
             self.get_discovered_hosts()
             self.create_associate_hosts_id_map()
 
     def _url_read(self, url):
-        request = urllib2.Request(url)
-        request.add_header('Cookie', self.staypuft_session_cookie)
-        url_handle = urllib2.urlopen(request)
-        return url_handle.read()
+        # We will not follow redirects
+        response = self.session.get(url, allow_redirects=False,
+                                    verify=self.verify)
+        response.raise_for_status()
+        return response.content
 
     def _url_read_json(self, url):
         parsed_json = json.loads(self._url_read(url))
         return parsed_json
 
     def _url_read_page(self, url):
-        parsed_page = BeautifulSoup(self._url_read(url))
-        return parsed_page
+        if url not in self._pages:
+            self._pages[url] = BeautifulSoup(self._url_read(url))
+        return self._pages[url]
 
     def _url_post(self, url, data):
-        request = urllib2.Request(url)
-        request.add_header('Cookie', self.staypuft_session_cookie)
-        request.add_header('X-CSRF-Token', self.staypuft_session_token)
-        request.add_header('Accept', 'text/javascript, application/javascript, application/ecmascript, application/x-ecmascript')
-        request.add_data(data)
-        url_handle = urllib2.urlopen(request)
-        if url_handle.code == 200:
+        response = self.session.post(url, data=data, allow_redirects=False,
+                                     verify=self.verify,
+                                     headers={'X-CSRF-Token': self.staypuft_session_token,
+                                              'Accept': JS_ACCEPT,
+                                              'Content-type': 'application/x-www-form-urlencoded'})
+        if response.status_code == 200:
             return True
         return False
 
     def _url_post_json(self, url, data):
-        request = urllib2.Request(url)
-        request.add_header('Cookie', self.staypuft_session_cookie)
-        request.add_header('X-CSRF-Token', self.staypuft_session_token)
-        request.add_header('Accept', 'text/javascript, application/javascript, application/ecmascript, application/x-ecmascript')
-        request.add_header('Content-type','application/json')
-        request.add_data(data)
-        url_handle = urllib2.urlopen(request)
-        if url_handle.code == 200 or url_handle.code == 302:
+        response = self.session.post(url, data=data, allow_redirects=False,
+                                     verify=self.verify,
+                                     headers={'X-CSRF-Token': self.staypuft_session_token,
+                                              'Accept': JS_ACCEPT,
+                                              'Content-type': 'application/json'})
+        if response.status_code == 200 or response.status_code == 302:
             return True
         return False
 
+    def _post_all(self, posts):
+        ''' sends the (post function, url, data) posts concurrently,
+            returns True if all of them succeeded
+        '''
+        if not posts:
+            return True
+        pool = ThreadPool(min(self.jobs, len(posts)))
+        try:
+            results = pool.map(lambda post: post[0](post[1], post[2]), posts)
+        finally:
+            pool.close()
+            pool.join()
+        return all(results)
+
     def get_subnets(self):
+        if self.subnet_map:
+            return
         response = self._url_read_json("https://%s/api/v2/subnets" % self.ip)
         for result in response['results']:
             self.subnet_map[result['name']] = str(result['id'])
 
     def get_subnets_types(self):
+        if self.subnet_type_map:
+            return
         parsed_page = self._url_read_page("https://%s/deployments/%s/steps/network_configuration" % (self.ip, self.deployment_id))
         subnet_sections = parsed_page.select("[class~=subnet-type-pull]")
         for subnet_section in subnet_sections:
@@ -184,24 +221,23 @@ class Staypuft(object):
         ''' populate discovered_hosts list with host ids of discovered_hosts
         '''
         response = self._url_read_json("https://%s/api/v2/discovered_hosts" % (self.ip))
+        self.discovered_hosts_ids = []
         for result in response['results']:
             self.discovered_hosts_ids.append(str(result['id']))
 
-    def assign_type_to_subnet(self, subnet_type_id, subnet_id):
-        data='subnet_type_id=%s&subnet_id=%s' % (subnet_type_id, subnet_id)
-        success = self._url_post("https://%s/subnet_typings?deployment_id=%s" % (self.ip, self.deployment_id), data)
-        return success
-
     def assign_types_to_subnets(self):
+        posts = []
         for subnet_type_name, subnet_name in self.typings_map.iteritems():
             subnet_type_id = self.subnet_type_map[subnet_type_name]
             subnet_id = self.subnet_map[subnet_name]
-            success = self.assign_type_to_subnet(subnet_type_id, subnet_id)
-            if not success:
-                return False
-        return True
+            posts.append((self._url_post,
+                          "https://%s/subnet_typings?deployment_id=%s" % (self.ip, self.deployment_id),
+                          'subnet_type_id=%s&subnet_id=%s' % (subnet_type_id, subnet_id)))
+        return self._post_all(posts)
 
     def get_deploy_hostgroups(self):
+        if self.deploy_hostgroups:
+            return
         parsed_page = self._url_read_page("https://%s/deployments/%s" % (self.ip, self.deployment_id) )
         for hostgroup_div in parsed_page.select("[class~=form-inline]"):
             hostgroup_name = hostgroup_div.find("label").text
@@ -216,6 +252,7 @@ class Staypuft(object):
 
             using only the hostgroup present in the deploy
         '''
+        self.hostgroup_to_hosts_ids_map = {}
         for hostgroup_name, hostgroup_id  in self.deploy_hostgroups.iteritems():
             hosts_ids = []
             response = self._url_read_json("https://%s/api/v2/hosts?search=hostgroup_id=%s" % (self.ip, hostgroup_id))
@@ -225,22 +262,24 @@ class Staypuft(object):
 
 
     def assign_subnets_to_host_interfaces(self):
+        posts = []
         for hostgroup_name, hosts_ids in self.hostgroup_to_hosts_ids_map.iteritems():
             for host_id in hosts_ids:
                 if hostgroup_name not in self.interface_assignments_map:
                     hostgroup_name = "Default"
                 for interface_name, subnet_name in self.interface_assignments_map[hostgroup_name].iteritems():
                     data="interface=%s" % (interface_name)
-                    success = self._url_post("https://%s/deployments/%s/interface_assignments?host_ids=%s&subnet_id=%s" % (self.ip, self.deployment_id, host_id, self.subnet_map[subnet_name]), data )
-                    if not success:
-                        return False
-        return True
+                    posts.append((self._url_post,
+                                  "https://%s/deployments/%s/interface_assignments?host_ids=%s&subnet_id=%s" % (self.ip, self.deployment_id, host_id, self.subnet_map[subnet_name]),
+                                  data))
+        return self._post_all(posts)
 
     def create_associate_hosts_id_map(self):
         ''' creates a map hostgroup_id -> list of discovered hosts id to assign to it
             by default, if host count is not defined for a partigular hostgroup present on a deploy
             the host count is 1.
         '''
+        self.associate_hosts_id_map = {}
         remaining_discovered_hosts = self.discovered_hosts_ids
         for hostgroup_name, hostgroup_id in self.deploy_hostgroups.iteritems():
             if hostgroup_name in self.associate_hosts_map:
@@ -253,14 +292,15 @@ class Staypuft(object):
             remaining_discovered_hosts = remaining_discovered_hosts[hosts_count:]
 
     def associate_discovered_hosts(self):
+        posts = []
         for hostgroup_id, hosts_ids in self.associate_hosts_id_map.iteritems():
             for host_id in hosts_ids:
                 data={ "hostgroup_id": hostgroup_id , "host_ids": host_id } #% (hostgroup_id, host_id)
                 post_data = json.dumps(data)
-                success = self._url_post_json("https://%s/deployments/%s/associate_host" % (self.ip, self.deployment_id), post_data )
-                if not success:
-                    return False
-        return True
+                posts.append((self._url_post_json,
+                              "https://%s/deployments/%s/associate_host" % (self.ip, self.deployment_id),
+                              post_data))
+        return self._post_all(posts)
 
     def gather_ips(self):
         parsed_page = self._url_read_page("https://%s/deployments/%s" % (self.ip, self.deployment_id))
@@ -277,61 +317,49 @@ class Staypuft(object):
         facts["tempest_ip"] = tempest_ip
         return facts
 
+STEPS = {
+    "subnet-typings": ("assign_types_to_subnets", "unable to assign subnets"),
+    "gather-ips": ("gather_ips", "unable to gather ips"),
+    "interface-assignments": ("assign_subnets_to_host_interfaces", "unable to assign subnets"),
+    "associate-discovered-hosts": ("associate_discovered_hosts", "unable to assign hosts"),
+}
+
 def main():
     module = AnsibleModule(
         argument_spec=dict(
             ip                          =   dict(required=True),
             deployment_id               =   dict(required=True),
-            step                        =   dict(required=True),
+            step                        =   dict(required=True, type='list'),
             staypuft_session            =   dict(required=True),
             typings_map                 =   dict(required=False),
             interface_assignments_map   =   dict(required=False),
             associate_hosts_map         =   dict(required=False),
+            jobs                        =   dict(default=8, type='int'),
+            validate_certs              =   dict(default='yes', type='bool'),
         )
     )
 
-    step=module.params['step']
-
-    # We will not follow redirects
-    opener = urllib2.build_opener(NoRedirectHandler())
-    urllib2.install_opener(opener)
-
-    facts = None
-
-    if step == "subnet-typings":
-        staypuft_deploy = Staypuft(module.params)
-        success = staypuft_deploy.assign_types_to_subnets()
-        fail_msg = "unable to assign subnets"
-
-    elif step == "gather-ips":
-        staypuft_deploy = Staypuft(module.params)
-        facts = staypuft_deploy.gather_ips()
-        if facts:
-            success = True
-        else:
-            success = False
-        fail_msg = "unable to gather ips"
-
-    elif step == "interface-assignments":
-        staypuft_deploy = Staypuft(module.params)
-        success = staypuft_deploy.assign_subnets_to_host_interfaces()
-        fail_msg = "unable to assign subnets"
-
-    elif step == "associate-discovered-hosts":
-        staypuft_deploy = Staypuft(module.params)
-        success = staypuft_deploy.associate_discovered_hosts()
-        fail_msg = "unable to assign hosts"
-
-    else:
-        module.fail_json(msg="unrecognized step: %s" % step)
-
-    if success:
-        if facts:
-            module.exit_json(changed=True, ansible_facts=facts)
-        else:
-            module.exit_json(changed=True)
+    steps = module.params['step']
+    for step in steps:
+        if step not in STEPS:
+            module.fail_json(msg="unrecognized step: %s" % step)
+
+    staypuft_deploy = Staypuft(module.params)
+    facts = {}
+
+    for step in steps:
+        method, fail_msg = STEPS[step]
+        staypuft_deploy.prepare(step)
+        result = getattr(staypuft_deploy, method)()
+        if not result:
+            module.fail_json(msg=fail_msg, step=step)
+        if step == "gather-ips":
+            facts.update(result)
+
+    if facts:
+        module.exit_json(changed=True, ansible_facts=facts)
     else:
-        module.fail_json(msg=fail_msg)
+        module.exit_json(changed=True)
 
 from ansible.module_utils.basic import *
 main()
@@ -24,6 +24,9 @@ options:
     description:
       - name of the guest VM being managed. Note that VM must be previously
         defined with xml.
+      - can be a list of guests, the state or command is then applied to
+        all of them over one connection and per guest results are returned
+        in C(results).
     required: true
     default: null
     aliases: []
@@ -50,8 +53,15 @@ options:
   xml:
     description:
       - XML document used with the define command
+      - can be a list of XML documents, one per guest in C(name) or with
+        the guest names taken from the documents when C(name) is omitted
     required: false
     default: null
+  jobs:
+    description:
+      - number of guests handled concurrently when C(name) is a list
+    required: false
+    default: 10
 requirements:
     - "python >= 2.6"
     - "libvirt-python"
@@ -77,6 +87,8 @@ tasks:
           uri=lxc:///
   - name: start vm
     virt: name=foo state=running uri=lxc:///
+# shut down several guests at once
+- virt: name=alpha,beta,gamma state=shutdown
 '''
 
 VIRT_FAILED = 1
@@ -84,6 +96,8 @@ VIRT_SUCCESS = 0
 VIRT_UNAVAILABLE=2
 
 import sys
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
 
 try:
     import libvirt
@@ -112,6 +126,15 @@ VIRT_STATE_NAME_MAP = {
 class VMNotFound(Exception):
     pass
 
+def not_supported(e):
+    """
+    True for the error of a call missing in libvirt: AttributeError from
+    older python bindings, VIR_ERR_NO_SUPPORT from an older daemon
+    """
+    if isinstance(e, libvirt.libvirtError):
+        return e.get_error_code() == libvirt.VIR_ERR_NO_SUPPORT
+    return isinstance(e, AttributeError)
+
 class LibvirtConnection(object):
 
     def __init__(self, uri, module):
@@ -135,30 +158,86 @@ class LibvirtConnection(object):
         """
         Extra bonus feature: vmid = -1 returns a list of everything
         """
-        conn = self.conn
+        if vmid == -1:
+            return self.list_domains()
 
-        vms = []
+        try:
+            return self.conn.lookupByName(vmid)
+        except libvirt.libvirtError, e:
+            if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+                raise VMNotFound("virtual machine %s not found" % vmid)
+            raise
+
+    def list_domains(self):
+        """
+        All running and defined domains, listed in one call if possible
+        """
+        conn = self.conn
+        try:
+            return conn.listAllDomains(0)
+        except (AttributeError, libvirt.libvirtError), e:
+            if not not_supported(e):
+                raise
 
+        # libvirt < 0.9.13
         # this block of code borrowed from virt-manager:
         # get working domain's name
-        ids = conn.listDomainsID()
-        for id in ids:
-            vm = conn.lookupByID(id)
-            vms.append(vm)
+        vms = [conn.lookupByID(id) for id in conn.listDomainsID()]
         # get defined domain
-        names = conn.listDefinedDomains()
-        for name in names:
-            vm = conn.lookupByName(name)
-            vms.append(vm)
+        vms.extend(conn.lookupByName(name)
+                   for name in conn.listDefinedDomains())
+        return vms
 
-        if vmid == -1:
-            return vms
-
-        for vm in vms:
-            if vm.name() == vmid:
-                return vm
+    def domain_states(self):
+        """
+        Returns dict of domain name -> state, using one bulk stats call
+        if libvirt supports it (>= 1.2.8)
+        """
+        try:
+            records = self.conn.getAllDomainStats(
+                libvirt.VIR_DOMAIN_STATS_STATE)
+        except (AttributeError, libvirt.libvirtError), e:
+            if not not_supported(e):
+                raise
+            return dict((vm.name(), vm.info()[0])
+                        for vm in self.list_domains())
+        return dict((vm.name(), stats['state.state'])
+                    for vm, stats in records)
+
+    def domains_info(self):
+        """
+        Returns dict of domain name -> [state, maxMem, memory, nrVirtCpu,
+        cpuTime, autostart] (virDomain.info() plus autostart flag) of all
+        domains, using one listing of autostarted domains and one bulk stats
+        call if libvirt supports them (>= 1.2.8)
+        """
+        try:
+            flags = (libvirt.VIR_DOMAIN_STATS_STATE |
+                     libvirt.VIR_DOMAIN_STATS_BALLOON |
+                     libvirt.VIR_DOMAIN_STATS_VCPU |
+                     libvirt.VIR_DOMAIN_STATS_CPU_TOTAL)
+            records = self.conn.getAllDomainStats(flags)
+            autostarted = set(vm.name() for vm in self.conn.listAllDomains(
+                libvirt.VIR_CONNECT_LIST_DOMAINS_AUTOSTART))
+        except (AttributeError, libvirt.libvirtError), e:
+            if not not_supported(e):
+                raise
+            return dict((vm.name(), list(vm.info()) + [vm.autostart()])
+                        for vm in self.list_domains())
 
-        raise VMNotFound("virtual machine %s not found" % vmid)
+        info = dict()
+        for vm, stats in records:
+            name = vm.name()
+            # inactive domains have no cpu time
+            info[name] = [
+                stats['state.state'],
+                stats.get('balloon.maximum', 0),
+                stats.get('balloon.current', 0),
+                stats.get('vcpu.current', 0),
+                stats.get('cpu.time', 0),
+                int(name in autostarted),
+            ]
+        return info
 
     def shutdown(self, vmid):
         return self.find_vm(vmid).shutdown()
@@ -184,10 +263,6 @@ class LibvirtConnection(object):
     def undefine(self, vmid):
         return self.find_vm(vmid).undefine()
 
-    def get_status2(self, vm):
-        state = vm.info()[0]
-        return VIRT_STATE_NAME_MAP.get(state,"unknown")
-
     def get_status(self, vmid):
         state = self.find_vm(vmid).info()[0]
         return VIRT_STATE_NAME_MAP.get(state,"unknown")
@@ -230,28 +305,33 @@ class Virt(object):
     def __init__(self, uri, module):
         self.module = module
         self.uri = uri
+        self.conn = None
 
     def __get_conn(self):
-        self.conn = LibvirtConnection(self.uri, self.module)
+        if self.conn is None:
+            self.conn = LibvirtConnection(self.uri, self.module)
         return self.conn
 
+    def connect(self):
+        """ Open the connection, e.g. before sharing it between threads """
+        return self.__get_conn()
+
     def get_vm(self, vmid):
         self.__get_conn()
         return self.conn.find_vm(vmid)
 
     def state(self):
-        vms = self.list_vms()
+        self.__get_conn()
         state = []
-        for vm in vms:
-            state_blurb = self.conn.get_status(vm)
+        for vm, vmstate in self.conn.domain_states().iteritems():
+            state_blurb = VIRT_STATE_NAME_MAP.get(vmstate, "unknown")
             state.append("%s %s" % (vm,state_blurb))
         return state
 
     def info(self):
-        vms = self.list_vms()
+        self.__get_conn()
         info = dict()
-        for vm in vms:
-            data = self.conn.find_vm(vm).info()
+        for vm, data in self.conn.domains_info().iteritems():
             # libvirt returns maxMem, memory, and cpuTime as long()'s, which
             # xmlrpclib tries to convert to regular int's during serialization.
             # This throws exceptions, so convert them to strings here and
@@ -263,8 +343,8 @@ class Virt(object):
                 "memory"    : str(data[2]),
                 "nrVirtCpu" : data[3],
                 "cpuTime"   : str(data[4]),
+                "autostart" : data[5],
             }
-            info[vm]["autostart"] = self.conn.get_autostart(vm)
 
         return info
 
@@ -286,18 +366,13 @@ class Virt(object):
 
     def list_vms(self, state=None):
         self.conn = self.__get_conn()
-        vms = self.conn.find_vm(-1)
+        if not state:
+            return [x.name() for x in self.conn.find_vm(-1)]
+
         results = []
-        for x in vms:
-            try:
-                if state:
-                    vmstate = self.conn.get_status2(x)
-                    if vmstate == state:
-                        results.append(x.name())
-                else:
-                    results.append(x.name())
-            except:
-                pass
+        for vm, vmstate in self.conn.domain_states().iteritems():
+            if VIRT_STATE_NAME_MAP.get(vmstate, "unknown") == state:
+                results.append(vm)
         return results
 
     def virttype(self):
@@ -392,10 +467,89 @@ class Virt(object):
         self.__get_conn()
         return self.conn.define_from_xml(xml)
 
+def guest_state(v, guest, state):
+    """ Bring a single guest to the given state """
+    res = {'changed': False}
+    status = v.status(guest)
+    if state == 'running':
+        if status == 'paused':
+            res['changed'] = True
+            res['msg'] = v.unpause(guest)
+        elif status != 'running':
+            res['changed'] = True
+            res['msg'] = v.start(guest)
+    elif state == 'shutdown':
+        if status != 'shutdown':
+            res['changed'] = True
+            res['msg'] = v.shutdown(guest)
+    elif state == 'destroyed':
+        if status != 'shutdown':
+            res['changed'] = True
+            res['msg'] = v.destroy(guest)
+    elif state == 'paused':
+        if status == 'running':
+            res['changed'] = True
+            res['msg'] = v.pause(guest)
+    return res
+
+def guest_define(v, guest, xml):
+    res = {}
+    try:
+        v.get_vm(guest)
+    except VMNotFound:
+        v.define(xml)
+        res = {'changed': True, 'created': guest}
+    return res
+
+def guest_command(v, guest, command):
+    res = getattr(v, command)(guest)
+    if type(res) != dict:
+        res = { command: res }
+    return res
+
+def domain_name(xml):
+    """ Name of the domain defined by the xml """
+    try:
+        return ElementTree.fromstring(xml).findtext('name')
+    except ElementTree.ParseError:
+        return None
+
+def batch(module, guests, func):
+    """
+    Run func(guest) for every guest over a pool of threads sharing one
+    connection. A single guest keeps the result format of older versions,
+    several guests give per guest results in 'results'.
+    """
+    if len(guests) == 1:
+        return VIRT_SUCCESS, func(guests[0])
+
+    def run(guest):
+        try:
+            return guest, func(guest)
+        except Exception, e:
+            return guest, {'failed': True, 'msg': str(e)}
+
+    pool = ThreadPool(max(1, min(module.params['jobs'], len(guests))))
+    try:
+        results = dict(pool.map(run, guests))
+    finally:
+        pool.close()
+        pool.join()
+
+    res = {
+        'changed': any(r.get('changed', False) for r in results.values()),
+        'results': results,
+    }
+    failed = sorted(g for g, r in results.iteritems() if r.get('failed'))
+    if failed:
+        module.fail_json(msg="failed for guests: %s" % ', '.join(failed),
+                         **res)
+    return VIRT_SUCCESS, res
+
 def core(module):
 
     state      = module.params.get('state', None)
-    guest      = module.params.get('name', None)
+    guests     = module.params.get('name', None) or []
     command    = module.params.get('command', None)
     uri        = module.params.get('uri', None)
     xml        = module.params.get('xml', None)
@@ -410,51 +564,35 @@ def core(module):
         return VIRT_SUCCESS, res
 
     if state:
-        if not guest:
+        if not guests:
             module.fail_json(msg = "state change requires a guest specified")
 
-        res['changed'] = False
-        if state == 'running':
-            if v.status(guest) is 'paused':
-                res['changed'] = True
-                res['msg'] = v.unpause(guest)
-            elif v.status(guest) is not 'running':
-                res['changed'] = True
-                res['msg'] = v.start(guest)
-        elif state == 'shutdown':
-            if v.status(guest) is not 'shutdown':
-                res['changed'] = True
-                res['msg'] = v.shutdown(guest)
-        elif state == 'destroyed':
-            if v.status(guest) is not 'shutdown':
-                res['changed'] = True
-                res['msg'] = v.destroy(guest)
-        elif state == 'paused':
-            if v.status(guest) is 'running':
-                res['changed'] = True
-                res['msg'] = v.pause(guest)
-        else:
-            module.fail_json(msg="unexpected state")
-
-        return VIRT_SUCCESS, res
+        # threads share the connection, so open it before starting them
+        v.connect()
+        return batch(module, guests,
+                     lambda guest: guest_state(v, guest, state))
 
     if command:
         if command in VM_COMMANDS:
-            if not guest:
-                module.fail_json(msg = "%s requires 1 argument: guest" % command)
             if command == 'define':
                 if not xml:
                     module.fail_json(msg = "define requires xml argument")
-                try:
-                    v.get_vm(guest)
-                except VMNotFound:
-                    v.define(xml)
-                    res = {'changed': True, 'created': guest}
-                return VIRT_SUCCESS, res
-            res = getattr(v, command)(guest)
-            if type(res) != dict:
-                res = { command: res }
-            return VIRT_SUCCESS, res
+                xmls = xml if isinstance(xml, list) else [xml]
+                if not guests and isinstance(xml, list):
+                    guests = [domain_name(x) for x in xmls]
+                if len(guests) != len(xmls) or not all(guests):
+                    module.fail_json(
+                        msg = "define requires a guest name for every xml")
+                by_guest = dict(zip(guests, xmls))
+                v.connect()
+                return batch(module, guests,
+                             lambda guest: guest_define(v, guest,
+                                                        by_guest[guest]))
+            if not guests:
+                module.fail_json(msg = "%s requires 1 argument: guest" % command)
+            v.connect()
+            return batch(module, guests,
+                         lambda guest: guest_command(v, guest, command))
 
         elif hasattr(v, command):
             res = getattr(v, command)()
@@ -463,18 +601,19 @@ def core(module):
             return VIRT_SUCCESS, res
 
         else:
-            module.fail_json(msg="Command %s not recognized" % basecmd)
+            module.fail_json(msg="Command %s not recognized" % command)
 
     module.fail_json(msg="expected state or command parameter to be specified")
 
 def main():
 
     module = AnsibleModule(argument_spec=dict(
-        name = dict(aliases=['guest']),
+        name = dict(aliases=['guest'], type='list'),
         state = dict(choices=['running', 'shutdown', 'destroyed', 'paused']),
         command = dict(choices=ALL_COMMANDS),
         uri = dict(default='qemu:///system'),
         xml = dict(),
+        jobs = dict(type='int', default=10),
     ))
 
     if not HAS_VIRT:
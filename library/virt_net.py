@@ -85,7 +85,8 @@ EXAMPLES = '''
 # Undefine a network
 - virt_net: command=undefine name=br_nat
 # Gather facts about networks
-# Facts will be available as 'ansible_libvirt_networks'
+# Facts will be available as 'ansible_libvirt_networks', including
+# ip_address, netmask, dhcp_ranges and dhcp_hosts of the networks
 - virt_net: command=facts
 # Gather information about network managed by 'libvirt' remotely using uri
 - virt_net: command=info uri='{{ item }}'
@@ -163,6 +164,23 @@ class LibvirtConnection(object):
     def find_entry(self, entryid):
         # entryid = -1 returns a list of everything
 
+        if entryid == -1:
+            return self.list_entries()
+
+        try:
+            return self.conn.networkLookupByName(entryid)
+        except libvirt.libvirtError, e:
+            if e.get_error_code() == libvirt.VIR_ERR_NO_NETWORK:
+                raise EntryNotFound("network %s not found" % entryid)
+            raise
+
+    def list_entries(self):
+        try:
+            return self.conn.listAllNetworks(0)
+        except AttributeError:
+            pass
+
+        # libvirt < 0.10.2
         results = []
 
         # Get active entries
@@ -175,14 +193,30 @@ class LibvirtConnection(object):
             entry = self.conn.networkLookupByName(name)
             results.append(entry)
 
-        if entryid == -1:
-            return results
-
-        for entry in results:
-            if entry.name() == entryid:
-                return entry
+        return results
 
-        raise EntryNotFound("network %s not found" % entryid)
+    def entry_flags(self):
+        """
+        Returns (entries, active, persistent, autostart) - all networks and
+        sets of names of those active, persistent and autostarted. Uses one
+        listing per set if libvirt supports it, instead of calls per network.
+        """
+        try:
+            entries = self.conn.listAllNetworks(0)
+            names = lambda flags: set(
+                entry.name() for entry in self.conn.listAllNetworks(flags))
+            return (entries,
+                    names(libvirt.VIR_CONNECT_LIST_NETWORKS_ACTIVE),
+                    names(libvirt.VIR_CONNECT_LIST_NETWORKS_PERSISTENT),
+                    names(libvirt.VIR_CONNECT_LIST_NETWORKS_AUTOSTART))
+        except AttributeError:
+            entries = self.list_entries()
+            names = lambda check: set(
+                entry.name() for entry in entries if check(entry))
+            return (entries,
+                    names(lambda entry: entry.isActive()),
+                    names(lambda entry: entry.isPersistent()),
+                    names(lambda entry: entry.autostart()))
 
     def create(self, entryid):
         if not self.module.check_mode:
@@ -306,20 +340,19 @@ class VirtNetwork(object):
         return self.conn.find_entry(entryid)
 
     def list_nets(self, state=None):
-        results = []
-        for entry in self.conn.find_entry(-1):
-            if state:
-                if state == self.conn.get_status2(entry):
-                    results.append(entry.name())
-            else:
-                results.append(entry.name())
-        return results
+        if not state:
+            return [entry.name() for entry in self.conn.find_entry(-1)]
+
+        entries, active, _, _ = self.conn.entry_flags()
+        return [entry.name() for entry in entries
+                if state == ENTRY_STATE_ACTIVE_MAP[entry.name() in active]]
 
     def state(self):
+        entries, active, _, _ = self.conn.entry_flags()
         results = []
-        for entry in self.list_nets():
-            state_blurb = self.conn.get_status(entry)
-            results.append("%s %s" % (entry,state_blurb))
+        for entry in entries:
+            state_blurb = ENTRY_STATE_ACTIVE_MAP[entry.name() in active]
+            results.append("%s %s" % (entry.name(),state_blurb))
         return results
 
     def autostart(self, entryid):
@@ -360,28 +393,15 @@ class VirtNetwork(object):
 
     def facts(self, facts_mode='facts'):
         results = dict()
-        for entry in self.list_nets():
-            results[entry] = dict()
-            results[entry]["autostart"] = self.conn.get_autostart(entry)
-            results[entry]["persistent"] = self.conn.get_persistent(entry)
-            results[entry]["state"] = self.conn.get_status(entry)
-            results[entry]["bridge"] = self.conn.get_bridge(entry)
-            results[entry]["uuid"] = self.conn.get_uuid(entry)
-
-            try:
-                results[entry]["forward_mode"] = self.conn.get_forward(entry)
-            except ValueError as e:
-                pass
-
-            try:
-                results[entry]["domain"] = self.conn.get_domain(entry)
-            except ValueError as e:
-                pass
-
-            try:
-                results[entry]["macaddress"] = self.conn.get_macaddress(entry)
-            except ValueError as e:
-                pass
+        entries, active, persistent, autostart = self.conn.entry_flags()
+        for entry in entries:
+            name = entry.name()
+            results[name] = parse_network_xml(entry.XMLDesc(0))
+            results[name]["autostart"] = \
+                ENTRY_STATE_AUTOSTART_MAP[name in autostart]
+            results[name]["persistent"] = \
+                ENTRY_STATE_PERSISTENT_MAP[name in persistent]
+            results[name]["state"] = ENTRY_STATE_ACTIVE_MAP[name in active]
 
         facts = dict()
         if facts_mode == 'facts':
@@ -392,6 +412,53 @@ class VirtNetwork(object):
         return facts
 
 
+def parse_network_xml(desc):
+    """
+    Returns facts about the network from a single parse of its xml
+    """
+    xml = etree.fromstring(desc)
+    result = dict()
+    result["uuid"] = xml.findtext('uuid')
+
+    bridge = xml.find('bridge')
+    result["bridge"] = bridge.get('name') if bridge is not None else None
+
+    forward = xml.find('forward')
+    if forward is not None:
+        result["forward_mode"] = forward.get('mode')
+
+    domain = xml.find('domain')
+    if domain is not None:
+        result["domain"] = domain.get('name')
+
+    mac = xml.find('mac')
+    if mac is not None:
+        result["macaddress"] = mac.get('address')
+
+    dhcp_ranges = []
+    dhcp_hosts = []
+    for ip in xml.findall('ip'):
+        if "ip_address" not in result and \
+                ip.get('family', 'ipv4') == 'ipv4':
+            result["ip_address"] = ip.get('address')
+            result["netmask"] = ip.get('netmask')
+            if ip.get('prefix'):
+                result["prefix"] = ip.get('prefix')
+        for dhcp_range in ip.findall('dhcp/range'):
+            dhcp_ranges.append(dict(start=dhcp_range.get('start'),
+                                    end=dhcp_range.get('end')))
+        for host in ip.findall('dhcp/host'):
+            dhcp_hosts.append(dict((key, host.get(key))
+                                   for key in ('mac', 'name', 'ip')
+                                   if host.get(key)))
+    if dhcp_ranges:
+        result["dhcp_ranges"] = dhcp_ranges
+    if dhcp_hosts:
+        result["dhcp_hosts"] = dhcp_hosts
+
+    return result
+
+
 def core(module):
 
     state     = module.params.get('state', None)
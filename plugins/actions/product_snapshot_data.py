@@ -0,0 +1,129 @@
+"""
+caches the results of the product_snapshot_data module on the controller
+
+The module finds the snapshot (puddle/poodle) URL of the host's OpenStack
+repository and reads the snapshot version from its changelog. All the
+hosts of a run usually use the same snapshot, so the type and version are
+kept in KHALEESI_SNAPSHOT_CACHE (~/.cache/khaleesi/snapshots.json by
+default) per snapshot URL for KHALEESI_SNAPSHOT_CACHE_TTL seconds and
+handed to the module, which then only fetches the changelog of unknown
+snapshots.
+
+The hosts are run in forked workers, so a snapshot missing in the cache
+is fetched holding a lock of its URL: the other workers needing the same
+snapshot wait for it and use the cached result instead of fetching the
+changelog again. The cache itself is locked only while read or written.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from ansible import utils
+
+# KHALEESI_SNAPSHOT_CACHE set to empty string disables the cache
+SNAPSHOT_CACHE = os.environ.get('KHALEESI_SNAPSHOT_CACHE', os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'khaleesi', 'snapshots.json'))
+# 'latest' snapshot URLs move, keep the results only for about one run
+SNAPSHOT_CACHE_TTL = int(os.environ.get('KHALEESI_SNAPSHOT_CACHE_TTL', 600))
+
+
+def _cache_dir():
+    cache_dir = os.path.dirname(SNAPSHOT_CACHE)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+    return cache_dir
+
+
+@contextlib.contextmanager
+def _snapshot_lock(snapshot_url):
+    # serializes the fetches of one snapshot, across workers and jobs
+    if not SNAPSHOT_CACHE:
+        yield
+        return
+    _cache_dir()
+    with open('%s.%s.lock' % (SNAPSHOT_CACHE, hashlib.sha1(
+            snapshot_url).hexdigest()[:16]), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+@contextlib.contextmanager
+def _snapshot_cache():
+    # yields the fresh entries locked against other workers and jobs,
+    # writes them back if changed
+    if not SNAPSHOT_CACHE:
+        yield {}
+        return
+    cache_dir = _cache_dir()
+    with open(SNAPSHOT_CACHE + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(SNAPSHOT_CACHE) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            cache = {}
+        expired = time.time() - SNAPSHOT_CACHE_TTL
+        cache = dict((url, entry) for url, entry in cache.items()
+                     if entry.get('time', 0) > expired)
+        before = json.dumps(cache, sort_keys=True)
+        yield cache
+        if json.dumps(cache, sort_keys=True) != before:
+            fd, tmp = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f)
+            os.rename(tmp, SNAPSHOT_CACHE)
+
+
+class ActionModule(object):
+
+    def __init__(self, runner):
+        self.runner = runner
+
+    def _execute(self, conn, tmp, module_name, inject, args, **kwargs):
+        return self.runner._execute_module(conn, tmp, module_name, '',
+                                           inject=inject, complex_args=args,
+                                           **kwargs)
+
+    def run(self, conn, tmp, module_name, module_args, inject,
+            complex_args=None, **kwargs):
+        args = dict(complex_args or {})
+        args.update(utils.parse_kv(module_args))
+
+        with _snapshot_cache() as cache:
+            args['snapshots'] = cache
+        # finds the snapshot URL, and the version if the snapshot is known;
+        # each execution transfers the module and removes its remote tmp
+        args['fetch'] = False
+        result = self._execute(conn, tmp, module_name, inject, args)
+        data = result.result
+        if (not result.comm_ok or data.get('failed')
+                or 'ansible_facts' in data):
+            return result
+
+        snapshot_url = data['snapshot_url']
+        # the repository is known now, skip the repoquery
+        args['repo_url'] = snapshot_url
+        args['fetch'] = True
+        with _snapshot_lock(snapshot_url):
+            # fetched meanwhile by another worker?
+            with _snapshot_cache() as cache:
+                args['snapshots'] = cache
+            result = self._execute(conn, tmp, module_name, inject, args)
+            facts = result.result.get('ansible_facts')
+            if result.comm_ok and facts and not result.result.get('cached'):
+                with _snapshot_cache() as cache:
+                    cache[snapshot_url] = {
+                        'type': facts['product_snapshot_type'],
+                        'version': facts['product_snapshot_version'],
+                        'time': time.time()}
+        return result
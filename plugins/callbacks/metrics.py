@@ -0,0 +1,169 @@
+"""
+exports per playbook metrics for the Prometheus node exporter textfile
+collector, enabled by setting KHALEESI_METRICS_DIR
+
+At the end of each playbook <playbook>.prom is (atomically) written to
+KHALEESI_METRICS_DIR with
+
+  - khaleesi_tasks_total: per host and status (ok, changed, failed,
+    unreachable, skipped) task results
+  - khaleesi_task_duration_seconds: histogram of task durations
+  - khaleesi_playbook_duration_seconds: time spent in the playbook
+
+all labeled with the playbook name (as in cli.execute.PLAYBOOKS) and the
+product, installer and distro from the generated settings.
+
+Runner callbacks are called in the forked workers, so everything is
+measured from the playbook callbacks and the AggregateStats, which
+run in the main process.
+"""
+
+import os
+import tempfile
+import time
+
+METRICS_DIR = os.getenv('KHALEESI_METRICS_DIR')
+# 'prometheus' (text format 0.0.4) or 'openmetrics'
+METRICS_FORMAT = os.getenv('KHALEESI_METRICS_FORMAT', 'prometheus')
+
+# label name -> dotted path in the settings
+SETTINGS_LABELS = (
+    ('product', 'product.name'),
+    ('product_version', 'product.full_version'),
+    ('installer', 'installer.type'),
+    ('distro', 'distro.name'),
+    ('distro_version', 'distro.full_version'),
+)
+# status label -> AggregateStats.summarize key
+STATUSES = (
+    ('ok', 'ok'),
+    ('changed', 'changed'),
+    ('failed', 'failures'),
+    ('unreachable', 'unreachable'),
+    ('skipped', 'skipped'),
+)
+DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _setting(settings, path):
+    value = settings
+    for key in path.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return ''
+        value = value[key]
+    return str(value)
+
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(labels):
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in labels)
+
+
+class CallbackModule(object):
+    """
+    aggregates the playbook metrics in memory and writes them at the end
+    """
+
+    def __init__(self):
+        self.disabled = not METRICS_DIR
+        self._playbook_start = None
+        self._task_start = None
+        self._durations = []
+
+    def _end_task(self):
+        if self._task_start is not None:
+            self._durations.append(time.time() - self._task_start)
+            self._task_start = None
+
+    def _playbook_name(self):
+        playbook = getattr(self, 'playbook', None)
+        filename = getattr(playbook, 'filename', None) or 'unknown'
+        name = os.path.splitext(os.path.basename(filename))[0]
+        return name.replace('_', '-')
+
+    def _common_labels(self):
+        playbook = getattr(self, 'playbook', None)
+        settings = getattr(playbook, 'extra_vars', None) or {}
+        labels = [('playbook', self._playbook_name())]
+        labels.extend((name, _setting(settings, path))
+                      for name, path in SETTINGS_LABELS)
+        return labels
+
+    def _histogram(self, lines, name, labels, values):
+        values = sorted(values)
+        index = 0
+        for bound in DURATION_BUCKETS:
+            while index < len(values) and values[index] <= bound:
+                index += 1
+            lines.append('%s_bucket%s %d' % (
+                name, _labels(labels + [('le', str(float(bound)))]), index))
+        lines.append('%s_bucket%s %d' % (
+            name, _labels(labels + [('le', '+Inf')]), len(values)))
+        lines.append('%s_sum%s %f' % (name, _labels(labels), sum(values)))
+        lines.append('%s_count%s %d' % (name, _labels(labels), len(values)))
+
+    def _render(self, stats, duration):
+        openmetrics = METRICS_FORMAT == 'openmetrics'
+        labels = self._common_labels()
+        lines = []
+
+        # OpenMetrics names the counter family without the _total suffix
+        family = 'khaleesi_tasks' if openmetrics else 'khaleesi_tasks_total'
+        lines.append('# HELP %s Task results per host and status.' % family)
+        lines.append('# TYPE %s counter' % family)
+        for host in sorted(stats.processed.keys()):
+            summary = stats.summarize(host)
+            for status, key in STATUSES:
+                lines.append('khaleesi_tasks_total%s %d' % (
+                    _labels(labels + [('host', host), ('status', status)]),
+                    summary[key]))
+
+        name = 'khaleesi_task_duration_seconds'
+        lines.append('# HELP %s Duration of tasks (all hosts).' % name)
+        lines.append('# TYPE %s histogram' % name)
+        self._histogram(lines, name, labels, self._durations)
+
+        name = 'khaleesi_playbook_duration_seconds'
+        lines.append('# HELP %s Time spent in the playbook.' % name)
+        lines.append('# TYPE %s gauge' % name)
+        lines.append('%s%s %f' % (name, _labels(labels), duration))
+
+        if openmetrics:
+            lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def _write(self, content):
+        if not os.path.isdir(METRICS_DIR):
+            os.makedirs(METRICS_DIR)
+        path = os.path.join(METRICS_DIR, self._playbook_name() + '.prom')
+        # the collector must never read a half written file
+        fd, tmp = tempfile.mkstemp(dir=METRICS_DIR, prefix='.',
+                                   suffix='.prom.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, path)
+
+    def playbook_on_start(self):
+        self._playbook_start = time.time()
+        self._task_start = None
+        self._durations = []
+
+    def playbook_on_play_start(self, name):
+        self._end_task()
+
+    def playbook_on_setup(self):
+        self._end_task()
+
+    def playbook_on_task_start(self, name, is_conditional):
+        self._end_task()
+        self._task_start = time.time()
+
+    def playbook_on_stats(self, stats):
+        self._end_task()
+        start = self._playbook_start or time.time()
+        self._write(self._render(stats, time.time() - start))
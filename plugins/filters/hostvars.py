@@ -0,0 +1,91 @@
+"""
+Single-pass aggregation of a fact over the hostvars of a list of nodes.
+
+The fact is either a dotted path ('ansible_eth0.macaddress') or a list of
+keys. Nodes missing (part of) the fact get `default`, or are left out
+when `default` is None.
+
+    {{ hostvars | hostvars_sum(groups.compute, 'ansible_memtotal_mb') }}
+    {{ hostvars | hostvars_group_by(groups.all, 'ansible_distribution') }}
+"""
+
+
+def _keys(fact):
+    if isinstance(fact, basestring):
+        return fact.split('.')
+    return fact
+
+
+def _facts(hostvars, nodes, fact, default=None):
+    """ Yields (node, value) of the fact for every node which has it """
+    keys = _keys(fact)
+    for node in nodes:
+        value = hostvars[node]
+        for key in keys:
+            try:
+                value = value[key]
+            except (KeyError, IndexError, TypeError):
+                value = default
+                break
+        if value is not None:
+            yield node, value
+
+
+def hostvars_sum(hostvars, nodes, fact, default=None):
+    total = 0
+    for _, value in _facts(hostvars, nodes, fact, default):
+        total += value
+    return total
+
+
+def hostvars_min(hostvars, nodes, fact, default=None):
+    result = None
+    for _, value in _facts(hostvars, nodes, fact, default):
+        if result is None or value < result:
+            result = value
+    return result
+
+
+def hostvars_max(hostvars, nodes, fact, default=None):
+    result = None
+    for _, value in _facts(hostvars, nodes, fact, default):
+        if result is None or value > result:
+            result = value
+    return result
+
+
+def hostvars_count(hostvars, nodes, fact, equals=None, default=None):
+    """ Number of nodes having the fact, or having it equal to `equals` """
+    count = 0
+    for _, value in _facts(hostvars, nodes, fact, default):
+        if equals is None or value == equals:
+            count += 1
+    return count
+
+
+def hostvars_group_by(hostvars, nodes, fact, default=None):
+    """ Maps each value of the fact to the list of nodes having it """
+    groups = {}
+    for node, value in _facts(hostvars, nodes, fact, default):
+        groups.setdefault(value, []).append(node)
+    return groups
+
+
+def hostvars_histogram(hostvars, nodes, fact, default=None):
+    """ Maps each value of the fact to the number of nodes having it """
+    histogram = {}
+    for _, value in _facts(hostvars, nodes, fact, default):
+        histogram[value] = histogram.get(value, 0) + 1
+    return histogram
+
+
+class FilterModule(object):
+    def filters(self):
+        return {
+            'hostvars_sum': hostvars_sum,
+            'hostvars_min': hostvars_min,
+            'hostvars_max': hostvars_max,
+            'hostvars_count': hostvars_count,
+            'hostvars_group_by': hostvars_group_by,
+            'hostvars_histogram': hostvars_histogram,
+        }
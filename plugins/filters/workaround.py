@@ -1,13 +1,66 @@
+import os
+
 from ansible import utils
 
+# Set to a file path to log every workaround check (one bug id per line),
+# which helps finding workarounds which are never used anymore.
+STATS_FILE = os.getenv('KHALEESI_WORKAROUND_STATS')
+# How many workarounds dicts to remember the enabled bugs for
+SNAPSHOTS_MAX = 32
+
+_snapshots = {}
+
+
+def _is_registry(workarounds):
+    """ the precompiled registry generated by ksgen (workarounds_registry) """
+    return 'version' in workarounds and \
+        isinstance(workarounds.get('enabled'), list)
+
+
+def _enabled_bugs(workarounds):
+    """ Returns frozenset of the enabled bug ids, memoized by dict identity
+
+    The snapshot keeps a reference to the dict, so its id can't be reused
+    by another dict while the snapshot is cached.
+    """
+    snapshot = _snapshots.get(id(workarounds))
+    if snapshot is not None and snapshot[0] is workarounds:
+        return snapshot[1]
+
+    if _is_registry(workarounds):
+        enabled = frozenset(workarounds['enabled'])
+    else:
+        enabled = frozenset(
+            bug_id for bug_id, entry in workarounds.iteritems()
+            if isinstance(entry, dict) and
+            utils.boolean(entry.get('enabled', False)))
+
+    if len(_snapshots) >= SNAPSHOTS_MAX:
+        _snapshots.clear()
+    _snapshots[id(workarounds)] = (workarounds, enabled)
+    return enabled
+
+
+def _record_checks(bugs):
+    if not STATS_FILE:
+        return
+    # tasks are templated in forked workers, a single O_APPEND write is
+    # atomic for short lines, so all workers can share the file
+    fd = os.open(STATS_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, ''.join('%s\n' % bug_id for bug_id in bugs))
+    finally:
+        os.close(fd)
+
 
 def workaround_enabled(workarounds, *bugs, **kw):
     if not isinstance(workarounds, dict):
         return False
 
+    _record_checks(bugs)
+    enabled = _enabled_bugs(workarounds)
     for bug_id in bugs:
-        enabled = workarounds.get(bug_id, {}).get('enabled', False)
-        if not utils.boolean(enabled):
+        if bug_id not in enabled:
             return False
     return True
 
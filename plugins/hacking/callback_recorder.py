@@ -0,0 +1,68 @@
+"""
+records every callback invocation, so it can be replayed offline
+by tools/replay_callbacks.py against any callback plugin
+
+Each event is appended to KHALEESI_CALLBACK_RECORD as one JSON line:
+
+    [seconds since recorder start, method name, args, kwargs]
+
+Runner callbacks are called from the forked workers, so the events are
+written with a single O_APPEND write each, instead of using a buffered,
+or compressed, stream. Remove the file before a run to start a new
+recording.
+"""
+
+import json
+import os
+import time
+
+RECORD_PATH = os.getenv('KHALEESI_CALLBACK_RECORD',
+                        '/tmp/callback_events.jsonl')
+
+STATS_KEY = '__stats__'
+# attributes of ansible.callbacks.AggregateStats
+STATS_FIELDS = ('processed', 'failures', 'ok', 'dark', 'changed', 'skipped')
+EVENT_PREFIXES = ('runner_on_', 'playbook_on_')
+
+
+def _default(obj):
+    """ serialize what json can't, AggregateStats gets restored on replay """
+    if all(hasattr(obj, field) for field in STATS_FIELDS):
+        return {STATS_KEY: dict((field, getattr(obj, field))
+                                for field in STATS_FIELDS)}
+    return repr(obj)
+
+
+class CallbackModule(object):
+    """
+    records all runner_on_* and playbook_on_* callbacks
+    """
+
+    def __init__(self):
+        self._start = time.time()
+        self._fd = None
+
+    def _write(self, line):
+        # forked workers inherit the fd, O_APPEND keeps their writes whole
+        if self._fd is None:
+            self._fd = os.open(RECORD_PATH,
+                               os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.write(self._fd, line)
+
+    def _record(self, method, args, kwargs):
+        event = [round(time.time() - self._start, 6), method, args, kwargs]
+        try:
+            line = json.dumps(event, separators=(',', ':'), default=_default)
+        except UnicodeDecodeError:
+            # command output which isn't utf-8
+            line = json.dumps(event, separators=(',', ':'), default=_default,
+                              encoding='latin-1')
+        self._write(line + '\n')
+
+    def __getattr__(self, name):
+        if not name.startswith(EVENT_PREFIXES):
+            raise AttributeError(name)
+
+        def record(*args, **kwargs):
+            self._record(name, args, kwargs)
+        return record
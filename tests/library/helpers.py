@@ -0,0 +1,179 @@
+"""
+Helpers for the tests of the modules in library/.
+
+A module is loaded from its source with a stand-in AnsibleModule (the
+ansible 1.x boilerplate import is replaced), and the remote APIs it talks
+to are replaced by a local HTTP server, see StandIn.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import json
+import ssl
+import subprocess
+import threading
+import urlparse
+from distutils.spawn import find_executable
+from os.path import dirname, exists, join, realpath
+
+TEST_DIR = dirname(realpath(__file__))
+LIBRARY_DIR = join(dirname(dirname(TEST_DIR)), 'library')
+BOILERPLATE = 'from ansible.module_utils.basic import *'
+TRUE_STRINGS = ('y', 'yes', 'on', '1', 'true')
+
+
+class ModuleExit(BaseException):
+    """ Raised by exit_json and fail_json. Like the SystemExit of the real
+        ones, it is not an Exception: a module catching Exception or
+        exiting from a worker thread is seen by the tests """
+
+    def __init__(self, result, failed):
+        BaseException.__init__(self, result, failed)
+        self.result = result
+        self.failed = failed
+
+
+class FakeModule(object):
+    """ The part of AnsibleModule used by our modules, the params are the
+        defaults of the argument_spec updated with `params`, bools given
+        as strings are converted like ansible does """
+
+    params_override = {}
+
+    def __init__(self, argument_spec, **kwargs):
+        self.argument_spec = argument_spec
+        self.params = dict((name, spec.get('default'))
+                           for name, spec in argument_spec.items())
+        self.params.update(self.params_override)
+        for name, spec in argument_spec.items():
+            value = self.params[name]
+            if spec.get('type') == 'bool' and isinstance(value, basestring):
+                self.params[name] = value.lower() in TRUE_STRINGS
+
+    def exit_json(self, **kwargs):
+        raise ModuleExit(kwargs, failed=False)
+
+    def fail_json(self, **kwargs):
+        kwargs['failed'] = True
+        raise ModuleExit(kwargs, failed=True)
+
+    def run_command(self, args):
+        process = subprocess.Popen(args, shell=isinstance(args, basestring),
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        return process.returncode, stdout, stderr
+
+    def get_bin_path(self, arg):
+        return find_executable(arg)
+
+
+def load_module(name):
+    """ Returns the namespace of library/<name>.py (or of library/<name>),
+        without running main() """
+    path = join(LIBRARY_DIR, name + '.py')
+    if not exists(path):
+        path = join(LIBRARY_DIR, name)
+    with open(path) as module_file:
+        source = module_file.read()
+    assert BOILERPLATE in source
+    source = source.replace(BOILERPLATE, '').replace('\nmain()', '\n')
+    namespace = {'__name__': name, 'json': json, 'AnsibleModule': FakeModule}
+    exec(compile(source, path, 'exec'), namespace)
+    return namespace
+
+
+def run_module(namespace, **params):
+    """ Runs main() of a loaded module, returns the ModuleExit """
+    class Module(FakeModule):
+        params_override = params
+    namespace['AnsibleModule'] = Module
+    try:
+        namespace['main']()
+    except ModuleExit, e:
+        return e
+    raise AssertionError('main() returned without exit_json or fail_json')
+
+
+class FakeTime(object):
+    """ Stands for the time module of a module: sleeping only moves the
+        clock, the sleeps are kept in `sleeps` """
+
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class Request(object):
+    def __init__(self, method, path, query, headers, body):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self):
+        url = urlparse.urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        request = Request(self.command, url.path,
+                          dict(urlparse.parse_qsl(url.query)),
+                          dict(self.headers.items()),
+                          self.rfile.read(length) if length else '')
+        with self.server.lock:
+            self.server.requests.append(request)
+        status, body = self.server.reply(request)
+        if not isinstance(body, basestring):
+            body = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = _handle
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class StandIn(object):
+    """ A local HTTP server standing in for a remote API. `reply(request)`
+        returns (status, body), a body which is not a string is sent as
+        JSON. The requests are kept in `requests`. With a certfile it
+        serves HTTPS. """
+
+    def __init__(self, reply, certfile=None):
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.reply = reply
+        self.server.requests = self.requests = []
+        self.server.lock = threading.Lock()
+        if certfile:
+            self.server.socket = ssl.wrap_socket(self.server.socket,
+                                                 certfile=certfile,
+                                                 server_side=True)
+        self.address = '127.0.0.1:%d' % self.server.server_port
+        self.url = '%s://%s/' % ('https' if certfile else 'http', self.address)
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
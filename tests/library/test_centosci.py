@@ -0,0 +1,108 @@
+"""
+Tests of library/centosci.py against a local stand-in of the Duffy API.
+
+Usage:
+    py.test test_centosci.py [options]
+"""
+
+import itertools
+import pytest
+
+from helpers import FakeTime, StandIn, load_module, run_module
+
+NO_HOSTS = 'Failed to allocate nodes'
+
+
+class Duffy(object):
+    """ Replies to Node/get with the next hosts of the script (or with the
+        error string of the script), Node/done and Node/fail always work """
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.sessions = itertools.count(1)
+
+    def __call__(self, request):
+        if request.path.endswith('/Node/get'):
+            reply = self.script.pop(0) if self.script else NO_HOSTS
+            if isinstance(reply, list):
+                return 200, {'hosts': reply[:int(request.query['count'])],
+                             'ssid': 's%d' % next(self.sessions)}
+            return 200, reply
+        return 200, 'Done'
+
+
+@pytest.fixture
+def centosci(monkeypatch):
+    monkeypatch.setenv('PROVISIONER_KEY', 'key')
+    namespace = load_module('centosci')
+    namespace['time'] = FakeTime(now=0.0)
+    return namespace
+
+
+def run(centosci, script, **params):
+    with StandIn(Duffy(script)) as duffy:
+        result = run_module(centosci, url=duffy.url + 'Duffy/', **params)
+    calls = [(r.path.split('/')[-1], r.query.get('ssid') or r.query['count'])
+             for r in duffy.requests]
+    return result, calls
+
+
+def test_hufty_session_is_returned(centosci):
+    result, calls = run(centosci, [['n1.hufty', 'n2'], ['n3', 'n4']],
+                        count='2', ram_gb=32)
+    assert not result.failed
+    assert [h['hostname'] for h in result.result['hosts']] == ['n3', 'n4']
+    assert result.result['ssids'] == ['s2']
+    assert result.result['rejected'] == ['n1.hufty']
+    assert calls == [('get', '2'), ('done', 's1'), ('get', '2')]
+
+
+def test_hufty_hosts_are_kept_for_small_jobs(centosci):
+    result, calls = run(centosci, [['n1.hufty', 'n2']], count='2', ram_gb=8)
+    assert not result.failed
+    assert [h['hostname'] for h in result.result['hosts']] == ['n1.hufty',
+                                                               'n2']
+    assert calls == [('get', '2')]
+
+
+def test_short_session_is_returned(centosci):
+    result, calls = run(centosci, [['n1'], ['n2', 'n3']], count='2')
+    assert not result.failed
+    assert [h['hostname'] for h in result.result['hosts']] == ['n2', 'n3']
+    assert result.result['ssids'] == ['s2']
+    assert result.result['ssid'] == 's2'
+    assert calls == [('get', '2'), ('done', 's1'), ('get', '2')]
+
+
+def test_backoff_doubles_up_to_max(centosci):
+    result, calls = run(centosci, [NO_HOSTS] * 4 + [['n1']],
+                        retry_delay=10, retry_delay_max=30)
+    assert not result.failed
+    assert result.result['attempts'] == 5
+    assert centosci['time'].sleeps == [10, 20, 30, 30]
+
+
+def test_fails_at_deadline(centosci):
+    result, calls = run(centosci, [], timeout=60, retry_delay=10,
+                        retry_delay_max=120)
+    assert result.failed
+    # the last wait is cut to the deadline
+    assert centosci['time'].sleeps == [10, 20, 30]
+    assert result.result['attempts'] == 4
+    assert result.result['msg'].startswith('Got 0 of 1 hosts after 4 attempts')
+    assert NO_HOSTS in result.result['msg']
+
+
+def test_done(centosci):
+    result, calls = run(centosci, [], request='done', ssid='s9')
+    assert not result.failed
+    assert result.result['changed']
+    assert calls == [('done', 's9')]
+
+
+def test_fails_without_key(centosci, monkeypatch):
+    monkeypatch.delenv('PROVISIONER_KEY')
+    result, calls = run(centosci, [])
+    assert result.failed
+    assert 'PROVISIONER_KEY' in result.result['msg']
+    assert calls == []
@@ -0,0 +1,39 @@
+"""
+Tests of library/collect_diagnostics.py, collecting from the local host.
+
+Usage:
+    py.test test_collect_diagnostics.py [options]
+"""
+
+import tarfile
+import pytest
+
+from helpers import load_module, run_module
+
+COMMANDS = [{'name': 'var/log/extra/uname', 'cmd': 'echo Linux'},
+            {'fact': 'problems_found', 'cmd': 'echo one; echo two'},
+            {'fact': 'nothing_found', 'cmd': '! echo -n'}]
+
+
+@pytest.fixture
+def collect_diagnostics():
+    return load_module('collect_diagnostics')
+
+
+def test_facts_and_archive(collect_diagnostics, tmpdir):
+    dest = str(tmpdir.join('host.tar.gz'))
+    result = run_module(collect_diagnostics, dest=dest, commands=COMMANDS)
+    assert not result.failed, result.result
+    assert result.result['ansible_facts'] == {
+        'problems_found': ['one', 'two'], 'nothing_found': []}
+    archive = tarfile.open(dest)
+    assert archive.extractfile('host/var/log/extra/uname').read() == 'Linux\n'
+
+
+def test_failure_sets_the_facts(collect_diagnostics, tmpdir):
+    dest = str(tmpdir.join('missing', 'host.tar.gz'))
+    result = run_module(collect_diagnostics, dest=dest, commands=COMMANDS)
+    assert result.failed
+    assert result.result['msg'].startswith('Error writing %s' % dest)
+    assert result.result['ansible_facts'] == {'problems_found': [],
+                                              'nothing_found': []}
@@ -0,0 +1,147 @@
+"""
+Tests of the keystone cache block of our OpenStack modules, run through
+library/quantum_network.py against a local stand-in of keystone and
+neutron.
+
+Usage:
+    py.test test_keystone_cache.py [options]
+"""
+
+import json
+import pytest
+
+from helpers import StandIn, load_module, run_module
+
+pytest.importorskip('keystoneclient')
+pytest.importorskip('neutronclient')
+pytest.importorskip('ansible.module_utils.openstack')
+
+
+class Cloud(object):
+    """ Keystone and neutron at the same URL. A redeploy changes the token
+        and the tenant ids, the networks are lost. """
+
+    def __init__(self):
+        self.deploy = 1
+        self.networks = []
+
+    @property
+    def token(self):
+        return 'token-%d' % self.deploy
+
+    def tenant_id(self, name):
+        return '%s-%d' % (name, self.deploy)
+
+    def redeploy(self):
+        self.deploy += 1
+        self.networks = []
+
+    def __call__(self, request):
+        if request.path == '/v2.0/tokens':
+            return 200, self.access(request.headers['host'])
+        if request.headers.get('x-auth-token') != self.token:
+            return 401, {'error': {'message': 'The request you have made '
+                                   'requires authentication.'}}
+        if request.path == '/v2.0/tenants':
+            return 200, {'tenants': [{'id': self.tenant_id(name),
+                                      'name': name, 'enabled': True}
+                                     for name in ('admin', 'demo')]}
+        if request.path == '/v2.0/networks.json':
+            if request.method == 'POST':
+                network = json.loads(request.body)['network']
+                network['id'] = 'net-%d' % len(self.networks)
+                self.networks.append(network)
+                return 201, {'network': network}
+            return 200, {'networks': [
+                n for n in self.networks
+                if all(n.get(k) == v for k, v in request.query.items())]}
+        return 404, 'not found'
+
+    def access(self, host):
+        url = 'http://%s/v2.0' % host
+        endpoints = [{'publicURL': url, 'adminURL': url,
+                      'internalURL': url, 'region': 'RegionOne'}]
+        return {'access': {
+            'token': {'id': self.token, 'expires': '2099-01-01T00:00:00Z',
+                      'tenant': {'id': self.tenant_id('admin'),
+                                 'name': 'admin'}},
+            'user': {'id': 'u', 'name': 'admin', 'roles': []},
+            'serviceCatalog': [
+                {'type': 'identity', 'name': 'keystone',
+                 'endpoints': endpoints},
+                {'type': 'network', 'name': 'neutron', 'endpoints': [
+                    dict(e, publicURL='http://%s' % host)
+                    for e in endpoints]}]}}
+
+
+@pytest.fixture
+def cloud():
+    with StandIn(Cloud()) as stand_in:
+        yield stand_in
+
+
+def run(cloud, cache, **params):
+    """ Runs the module in a fresh namespace, returns the result and the
+        calls made, as (method, path) """
+    namespace = load_module('quantum_network')
+    namespace['KEYSTONE_CACHE'] = cache
+    first = len(cloud.requests)
+    params = dict(dict(name='private', tenant_name='demo',
+                       auth_url=cloud.url + 'v2.0', login_username='admin',
+                       login_password='secret', login_tenant_name='admin'),
+                  **params)
+    result = run_module(namespace, **params)
+    return result, [(r.method, r.path)
+                    for r in cloud.requests[first:]]
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return str(tmpdir.join('keystone.json'))
+
+
+def test_cache_hit(cloud, cache):
+    result, calls = run(cloud, cache)
+    assert result.result['changed']
+    assert calls.count(('POST', '/v2.0/tokens')) == 1
+    assert calls.count(('GET', '/v2.0/tenants')) == 1
+    result, calls = run(cloud, cache)
+    assert not result.failed
+    assert not result.result['changed']
+    assert calls == [('GET', '/v2.0/networks.json')]
+    assert cloud.server.reply.networks[0]['tenant_id'] == 'demo-1'
+
+
+def test_new_tenant_is_listed(cloud, cache):
+    run(cloud, cache)
+    result, calls = run(cloud, cache, tenant_name='admin')
+    assert result.result['changed']
+    assert calls == [('GET', '/v2.0/networks.json'),
+                     ('POST', '/v2.0/networks.json')]
+    result, calls = run(cloud, cache, tenant_name='nope')
+    assert result.failed
+    assert calls == [('GET', '/v2.0/tenants')]
+
+
+def test_refused_token_is_renewed(cloud, cache):
+    run(cloud, cache)
+    cloud.server.reply.redeploy()
+    result, calls = run(cloud, cache)
+    assert result.result['changed']
+    # refused by neutron, then the module is run again with a new token
+    # and the tenant ids of the new cloud
+    assert calls == [('GET', '/v2.0/networks.json'),
+                     ('POST', '/v2.0/tokens'),
+                     ('GET', '/v2.0/tenants'),
+                     ('GET', '/v2.0/networks.json'),
+                     ('POST', '/v2.0/networks.json')]
+    assert cloud.server.reply.networks[0]['tenant_id'] == 'demo-2'
+    result, calls = run(cloud, cache)
+    assert calls == [('GET', '/v2.0/networks.json')]
+
+
+def test_cache_disabled(cloud):
+    for i in range(2):
+        result, calls = run(cloud, '')
+        assert not result.failed
+        assert calls.count(('POST', '/v2.0/tokens')) == 1
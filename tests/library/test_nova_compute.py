@@ -0,0 +1,334 @@
+"""
+Tests of library/nova_compute.py with a fake Nova client counting the API
+calls.
+
+Usage:
+    py.test test_nova_compute.py [options]
+"""
+
+import collections
+import copy
+import itertools
+import re
+import pytest
+
+from helpers import FakeTime, load_module, run_module
+
+pytest.importorskip('ansible.module_utils.openstack')
+
+
+class NotFound(Exception):
+    pass
+
+
+class FakeExceptions(object):
+    NotFound = NotFound
+    Unauthorized = AuthorizationFailure = type('Unauthorized',
+                                               (Exception,), {})
+
+
+class FakeServer(object):
+    def __init__(self, nova, name, metadata):
+        self.nova = nova
+        self.id = 'server-%d' % next(nova.ids)
+        self.name = name
+        self.metadata = dict(metadata or {})
+        self.status = 'BUILD'
+        self.polls = 0
+        self.addresses = {}
+        self.updated = nova.clock()
+
+    def add_floating_ip(self, ip):
+        self.nova.floating_ips.associate(ip, self)
+
+    @property
+    def _info(self):
+        return dict(id=self.id, name=self.name, status=self.status)
+
+    def tick(self):
+        self.polls += 1
+        if self.status == 'BUILD' and self.polls >= 2:
+            self.status = 'ACTIVE'
+            self.addresses = {'private': [{'addr': '10.0.0.%d' % self.polls,
+                                           'OS-EXT-IPS:type': 'fixed'}]}
+            self.updated = self.nova.clock()
+
+
+class FakeServers(object):
+    """ Servers become ACTIVE on their second poll. The servers of a
+        multi-create are named <name>-<uuid>, like Nova does since
+        Icehouse. """
+
+    def __init__(self, nova):
+        self.nova = nova
+        self.calls = nova.calls
+        self.all = collections.OrderedDict()
+        self.deleted = []
+        # set to an exception to fail the requests for several servers
+        self.multi_create_error = None
+        # names which can't be given to a server
+        self.update_errors = set()
+
+    def _tick(self):
+        for server in self.all.values():
+            server.tick()
+
+    def create(self, name, image, flavor, meta=None, min_count=None,
+               max_count=None, **kwargs):
+        self.calls['servers.create'] += 1
+        count = max_count or 1
+        if count > 1 and self.multi_create_error:
+            raise self.multi_create_error
+        created = []
+        for i in range(count):
+            server = FakeServer(self.nova, name, meta)
+            if count > 1:
+                server.name = '%s-%08x-uuid' % (name, i)
+            self.all[server.id] = server
+            created.append(server)
+        self.nova.on_create(name)
+        return created[0]
+
+    def list(self, detailed=True, search_opts=None):
+        self.calls['servers.list'] += 1
+        self._tick()
+        search_opts = search_opts or {}
+        pattern = search_opts.get('name', '')
+        since = search_opts.get('changes-since')
+        listed = list(self.all.values())
+        if since:
+            listed = [s for s in listed + self.deleted if s.updated >= since]
+        return [s for s in listed if re.search(pattern, s.name)]
+
+    def get(self, server_id):
+        self.calls['servers.get'] += 1
+        self._tick()
+        server_id = getattr(server_id, 'id', server_id)
+        if server_id not in self.all:
+            raise NotFound(server_id)
+        return self.all[server_id]
+
+    def update(self, server, name):
+        self.calls['servers.update'] += 1
+        if name in self.update_errors:
+            raise Exception('Conflict: %s' % name)
+        server = self.all[server.id]
+        server.name = name
+        server.updated = self.nova.clock()
+
+    def delete(self, server):
+        self.calls['servers.delete'] += 1
+        server_id = getattr(server, 'id', server)
+        if server_id not in self.all:
+            raise NotFound(server_id)
+        server = self.all.pop(server_id)
+        server.status = 'DELETED'
+        server.updated = self.nova.clock()
+        self.deleted.append(server)
+
+
+class FakeNetwork(object):
+    def __init__(self, id, label):
+        self.id = id
+        self.label = label
+
+
+class FakeNetworks(object):
+    def __init__(self, nova):
+        self.calls = nova.calls
+
+    def list(self):
+        self.calls['networks.list'] += 1
+        return [FakeNetwork('net-private', 'private')]
+
+
+class FakeFloatingIP(object):
+    def __init__(self, ip, pool):
+        self.id = 'fip-' + ip
+        self.ip = ip
+        self.pool = pool
+        self.instance_id = None
+
+
+class FakeFloatingIPs(object):
+    """ 2 free IPs in each of the pools ext and int. An IP in `thefts` is
+        taken over by another server right after it's attached. """
+
+    def __init__(self, nova):
+        self.nova = nova
+        self.calls = nova.calls
+        self.all = collections.OrderedDict(
+            (ip, FakeFloatingIP(ip, pool)) for ip, pool in [
+                ('172.16.0.1', 'ext'), ('172.16.0.2', 'ext'),
+                ('192.168.0.1', 'int'), ('192.168.0.2', 'int')])
+        self.thefts = set()
+
+    def list(self):
+        self.calls['floating_ips.list'] += 1
+        return [copy.copy(f_ip) for f_ip in self.all.values()]
+
+    def get(self, id):
+        self.calls['floating_ips.get'] += 1
+        return copy.copy(self.all[id[len('fip-'):]])
+
+    def create(self, pool=None):
+        self.calls['floating_ips.create'] += 1
+        f_ip = FakeFloatingIP('10.%d.0.%d' % (len(pool or ''),
+                                              len(self.all)), pool)
+        self.all[f_ip.ip] = f_ip
+        return f_ip
+
+    def associate(self, ip, server):
+        self.calls['add_floating_ip'] += 1
+        f_ip = self.all[ip]
+        if f_ip.instance_id is not None:
+            raise Exception('Floating IP %s is associated' % ip)
+        f_ip.instance_id = 'thief' if ip in self.thefts else server.id
+        if f_ip.instance_id == server.id:
+            server.addresses.setdefault('private', []).append(
+                {'addr': ip, 'OS-EXT-IPS:type': 'floating'})
+            server.updated = self.nova.clock()
+
+
+class FakeNova(object):
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.ids = itertools.count(1)
+        self.ticks = itertools.count()
+        self.servers = FakeServers(self)
+        self.networks = FakeNetworks(self)
+        self.floating_ips = FakeFloatingIPs(self)
+        self.intruders = []
+
+    def clock(self):
+        return '2016-01-01T00:%05d' % next(self.ticks)
+
+    def authenticate(self):
+        pass
+
+    def on_create(self, name):
+        # servers booted by other jobs at the same time
+        while self.intruders:
+            server = FakeServer(self, self.intruders.pop(0), {})
+            self.servers.all[server.id] = server
+
+
+@pytest.fixture
+def nova():
+    return FakeNova()
+
+
+@pytest.fixture
+def nova_compute(nova):
+    namespace = load_module('nova_compute')
+
+    class client(object):
+        @staticmethod
+        def Client(*args, **kwargs):
+            return nova
+
+    class floating_ips(object):
+        @staticmethod
+        def FloatingIPManager(api):
+            return api.floating_ips
+
+    namespace.update(nova_client=client, floating_ips=floating_ips,
+                     exceptions=FakeExceptions, time=FakeTime())
+    return namespace
+
+
+def run(nova_compute, **params):
+    params = dict(dict(name='web', count=3, image_id='image', flavor_id=1,
+                       wait_for=600), **params)
+    result = run_module(nova_compute, **params)
+    assert not result.failed, result.result
+    return result.result
+
+
+def test_count_is_booted_by_one_request(nova_compute, nova):
+    result = run(nova_compute)
+    assert sorted(result['servers']) == ['web-1', 'web-2', 'web-3']
+    assert all(s['status'] == 'ACTIVE' for s in result['servers'].values())
+    # listing of the existing servers, of the request, one poll
+    assert nova.calls == {'servers.create': 1, 'servers.list': 3,
+                          'servers.update': 3}
+
+
+def test_servers_of_other_jobs_are_left_alone(nova_compute, nova):
+    nova.intruders = ['web-9', 'other-web-1']
+    result = run(nova_compute)
+    assert sorted(result['servers']) == ['web-1', 'web-2', 'web-3']
+    names = sorted(s.name for s in nova.servers.all.values())
+    assert names == ['other-web-1', 'web-1', 'web-2', 'web-3', 'web-9']
+    assert nova.calls['servers.update'] == 3
+    assert nova.calls['servers.delete'] == 0
+
+
+def test_one_by_one_fallback(nova_compute, nova):
+    nova.servers.multi_create_error = Exception('Quota exceeded')
+    result = run(nova_compute)
+    assert sorted(result['servers']) == ['web-1', 'web-2', 'web-3']
+    assert 'Unable to boot all 3 servers by one request' in (
+        result['attempts_errors_log'][0])
+    assert nova.calls == {'servers.create': 4, 'servers.list': 3}
+
+
+def test_leftovers_are_deleted(nova_compute, nova):
+    nova.servers.update_errors = set(['web-2'])
+    result = run(nova_compute)
+    assert sorted(result['servers']) == ['web-1', 'web-2', 'web-3']
+    assert sorted(s.name for s in nova.servers.all.values()) == [
+        'web-1', 'web-2', 'web-3']
+    # the 2 servers of the request left without slot are deleted, waited
+    # on (one get each) before their replacements are booted
+    assert nova.calls['servers.delete'] == 2
+    assert nova.calls['servers.get'] == 2
+    assert nova.calls['servers.create'] == 3
+    assert nova.calls['servers.update'] == 2
+
+
+def test_networks_are_listed_once(nova_compute, nova):
+    run(nova_compute, nics=[{'net-id': 'net-private'}])
+    assert nova.calls['networks.list'] == 1
+
+
+def test_networks_are_not_listed_without_nics(nova_compute, nova):
+    run(nova_compute, count=None, names=['db-1', 'db-2'])
+    assert nova.calls['networks.list'] == 0
+    assert nova.calls['servers.create'] == 2
+
+
+def floating(server):
+    return sorted(a['addr'] for a in server.addresses.get('private', [])
+                  if a['OS-EXT-IPS:type'] == 'floating')
+
+
+def test_floating_ip_of_each_pool(nova_compute, nova):
+    run(nova_compute, count=2, floating_ip_pools=['ext', 'int'])
+    ips = [floating(s) for s in nova.servers.all.values()]
+    assert sorted(ip.split('.')[0] for ip in sum(ips, [])) == [
+        '172', '172', '192', '192']
+    assert all(len(set(ip.split('.')[0] for ip in server_ips)) == 2
+               for server_ips in ips)
+    # one listing to pick the IPs, one to check none was taken over
+    assert nova.calls['floating_ips.list'] == 2
+    assert nova.calls['floating_ips.get'] == 0
+    assert nova.calls['floating_ips.create'] == 0
+    assert nova.calls['add_floating_ip'] == 4
+
+
+def test_floating_ip_is_created_when_pool_is_empty(nova_compute, nova):
+    run(nova_compute, count=3, floating_ip_pools=['int'])
+    assert nova.calls['floating_ips.create'] == 1
+    assert all(len(floating(s)) == 1 for s in nova.servers.all.values())
+
+
+def test_floating_ip_taken_over(nova_compute, nova):
+    nova.floating_ips.thefts = set(['172.16.0.1', '172.16.0.2'])
+    run(nova_compute, count=1, name='web-1', floating_ip_pools=['ext'])
+    server, = nova.servers.all.values()
+    assert len(floating(server)) == 1
+    # both free IPs are stolen, one is created by the third round
+    assert nova.calls['floating_ips.list'] == 4
+    assert nova.calls['floating_ips.create'] == 1
+    assert nova.calls['floating_ips.get'] == 0
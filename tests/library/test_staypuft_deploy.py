@@ -0,0 +1,173 @@
+"""
+Tests of library/staypuft_deploy.py against a local HTTPS stand-in of
+staypuft, with a self-signed certificate made by openssl.
+
+Usage:
+    py.test test_staypuft_deploy.py [options]
+"""
+
+import re
+import subprocess
+import pytest
+
+from helpers import StandIn, load_module, run_module
+
+requests = pytest.importorskip('requests')
+pytest.importorskip('bs4')
+
+DEPLOYMENT = '''<html>
+<div class="form-inline"><label for="11">Controller (Neutron)</label></div>
+<div class="form-inline"><label for="12">Generic RHEL 7</label></div>
+<b>Public API:</b><span><div> <p>10.0.0.5</p></div></span>
+</html>'''
+NETWORK_CONFIGURATION = '''<html>
+<div class="subnet-type-pull" data-subnet-type-id="1">Tenant</div>
+<div class="subnet-type-pull" data-subnet-type-id="2">Public API</div>
+</html>'''
+SESSION = "{'cookie': '_session_id=abc', 'token': 'tok'}"
+
+
+class Staypuft(object):
+    """ Deployment 7 with the hostgroups 11 and 12 of 3 hosts each, and 6
+        discovered hosts """
+
+    def __init__(self, post_status=200):
+        self.post_status = post_status
+
+    def __call__(self, request):
+        if request.headers.get('cookie') != '_session_id=abc':
+            return 403, 'no session'
+        if request.method == 'POST':
+            if request.headers.get('x-csrf-token') != 'tok':
+                return 422, 'no token'
+            if request.path.endswith('/associate_host'):
+                return 302, ''
+            return self.post_status, 'ok'
+        if request.path == '/deployments/7':
+            return 200, DEPLOYMENT
+        if request.path == '/deployments/7/steps/network_configuration':
+            return 200, NETWORK_CONFIGURATION
+        if request.path == '/api/v2/subnets':
+            return 200, {'results': [{'id': 21, 'name': 'tenant'},
+                                     {'id': 22, 'name': 'public'}]}
+        if request.path == '/api/v2/discovered_hosts':
+            return 200, {'results': [{'id': i} for i in range(100, 106)]}
+        match = re.match(r'hostgroup_id=(\d+)$',
+                         request.query.get('search', ''))
+        if request.path == '/api/v2/hosts' and match:
+            hostgroup = int(match.group(1))
+            return 200, {'results': [{'id': hostgroup * 10 + i,
+                                      'ip': '10.1.%d.%d' % (hostgroup, i)}
+                                     for i in range(3)]}
+        return 404, 'not found'
+
+
+@pytest.fixture(scope='module')
+def certfile(tmpdir_factory):
+    """ A self-signed certificate of 127.0.0.1, with its key """
+    path = str(tmpdir_factory.mktemp('staypuft').join('cert.pem'))
+    try:
+        subprocess.check_call(['openssl', 'req', '-x509', '-nodes', '-days',
+                               '1', '-newkey', 'rsa:2048', '-subj',
+                               '/CN=127.0.0.1', '-keyout', path,
+                               '-out', path + '.crt'],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        pytest.skip('openssl is needed to make a certificate')
+    with open(path, 'a') as pem:
+        pem.write(open(path + '.crt').read())
+    return path
+
+
+@pytest.fixture
+def staypuft(monkeypatch):
+    # certificates are checked against the certfile or the default bundle
+    monkeypatch.delenv('REQUESTS_CA_BUNDLE', raising=False)
+    monkeypatch.delenv('CURL_CA_BUNDLE', raising=False)
+    return load_module('staypuft_deploy')
+
+
+def run(staypuft, certfile, step, stand_in=None, **params):
+    params.setdefault('validate_certs', 'no')
+    with StandIn(stand_in or Staypuft(), certfile=certfile) as server:
+        result = run_module(staypuft, ip=server.address, deployment_id='7',
+                            staypuft_session=SESSION, step=step, **params)
+    return result, server.requests
+
+
+def test_subnet_typings(staypuft, certfile):
+    result, requests_ = run(staypuft, certfile, ['subnet-typings'],
+                            typings_map="{'Tenant': 'tenant'}")
+    assert not result.failed
+    posts = [(r.path, r.query, r.body) for r in requests_
+             if r.method == 'POST']
+    assert posts == [('/subnet_typings', {'deployment_id': '7'},
+                      'subnet_type_id=1&subnet_id=21')]
+
+
+def test_steps_read_pages_once(staypuft, certfile):
+    result, requests_ = run(staypuft, certfile,
+                            ['subnet-typings', 'interface-assignments',
+                             'gather-ips'],
+                            typings_map="{'Tenant': 'tenant'}",
+                            interface_assignments_map="{'Default': "
+                                                      "{'eth1': 'public'}}")
+    assert not result.failed
+    gets = [r.path for r in requests_ if r.method == 'GET']
+    assert gets.count('/api/v2/subnets') == 1
+    assert gets.count('/deployments/7') == 1
+    # one assignment for each of the 6 hosts of the deployment
+    assignments = [r for r in requests_
+                   if r.path == '/deployments/7/interface_assignments']
+    assert len(assignments) == 6
+    assert result.result['ansible_facts'] == {'public_api_ip': '10.0.0.5',
+                                              'tempest_ip': '10.1.12.0'}
+
+
+def test_associate_discovered_hosts(staypuft, certfile):
+    result, requests_ = run(staypuft, certfile,
+                            ['associate-discovered-hosts'],
+                            associate_hosts_map="{'Controller (Neutron)': 3}",
+                            jobs=4)
+    assert not result.failed
+    associated = sorted(r.body for r in requests_ if r.method == 'POST')
+    assert len(associated) == 4
+    assert len(set(associated)) == 4
+
+
+def test_failed_post_fails(staypuft, certfile):
+    result, requests_ = run(staypuft, certfile, ['subnet-typings'],
+                            stand_in=Staypuft(post_status=500),
+                            typings_map="{'Tenant': 'tenant'}")
+    assert result.failed
+    assert result.result['msg'] == 'unable to assign subnets'
+    assert result.result['step'] == 'subnet-typings'
+
+
+def test_unrecognized_step(staypuft, certfile):
+    result, requests_ = run(staypuft, certfile, ['subnet-typings', 'nope'])
+    assert result.failed
+    assert requests_ == []
+
+
+def test_certificate_is_checked_by_default(staypuft, certfile):
+    with StandIn(Staypuft(), certfile=certfile) as server:
+        with pytest.raises(requests.exceptions.SSLError):
+            run_module(staypuft, ip=server.address, deployment_id='7',
+                       staypuft_session=SESSION, step=['gather-ips'])
+    assert server.requests == []
+
+
+def test_trusted_certificate(staypuft, certfile, monkeypatch):
+    monkeypatch.setenv('REQUESTS_CA_BUNDLE', certfile + '.crt')
+    result, requests_ = run(staypuft, certfile, ['gather-ips'],
+                            validate_certs='yes')
+    assert not result.failed
+
+
+def test_validate_certs_no_overrides_ca_bundle(staypuft, certfile,
+                                               monkeypatch):
+    monkeypatch.setenv('REQUESTS_CA_BUNDLE', requests.certs.where())
+    result, requests_ = run(staypuft, certfile, ['gather-ips'],
+                            validate_certs='no')
+    assert not result.failed
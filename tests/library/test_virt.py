@@ -0,0 +1,203 @@
+"""
+Tests of library/virt.py with a fake libvirt connection counting the calls.
+
+Usage:
+    py.test test_virt.py [options]
+"""
+
+import collections
+import types
+import pytest
+
+from helpers import load_module, run_module
+
+VIR_ERR_NO_SUPPORT = 3
+VIR_ERR_INTERNAL_ERROR = 1
+VIR_ERR_NO_DOMAIN = 42
+VIR_CONNECT_LIST_DOMAINS_AUTOSTART = 64
+
+
+class libvirtError(Exception):
+    def __init__(self, msg, code):
+        Exception.__init__(self, msg)
+        self.code = code
+
+    def get_error_code(self):
+        return self.code
+
+
+class FakeDomain(object):
+    def __init__(self, conn, id, name, state, autostart):
+        self.calls = conn.calls
+        self.id = id
+        self._name = name
+        self.state = state
+        self._autostart = autostart
+
+    def name(self):
+        return self._name
+
+    def info(self):
+        self.calls['info'] += 1
+        return [self.state, 2048L, 1024L, 2, 99L]
+
+    def autostart(self):
+        self.calls['autostart'] += 1
+        return self._autostart
+
+    def shutdown(self):
+        self.calls['shutdown'] += 1
+        self.state = 5
+        return 0
+
+
+class FakeConnection(object):
+    """ vm0 and vm2 are running, vm1 and vm3 shut off, vm0 autostarted.
+        `bulk` is how the bulk calls of libvirt >= 1.2.8 behave: 'yes' they
+        work, 'no' they are missing from the python bindings, 'daemon'
+        the daemon doesn't support them. """
+
+    def __init__(self, bulk):
+        self.calls = collections.Counter()
+        self.domains = [FakeDomain(self, i, 'vm%d' % i, 1 if i % 2 == 0 else 5,
+                                   int(i == 0))
+                        for i in range(4)]
+        self.bulk = bulk
+        self.error = None
+
+    def _bulk(self, name):
+        if self.bulk == 'no':
+            raise AttributeError("'virConnect' object has no attribute '%s'"
+                                 % name)
+        self.calls[name] += 1
+        if self.error:
+            raise libvirtError('internal error', self.error)
+        if self.bulk == 'daemon':
+            raise libvirtError('this function is not supported by the '
+                               'connection driver: %s' % name,
+                               VIR_ERR_NO_SUPPORT)
+
+    def listAllDomains(self, flags):
+        self._bulk('listAllDomains')
+        if flags & VIR_CONNECT_LIST_DOMAINS_AUTOSTART:
+            return [d for d in self.domains if d._autostart]
+        return list(self.domains)
+
+    def getAllDomainStats(self, flags):
+        self._bulk('getAllDomainStats')
+        return [(d, {'state.state': d.state, 'balloon.maximum': 2048L,
+                     'balloon.current': 1024L, 'vcpu.current': 2,
+                     'cpu.time': 99L})
+                for d in self.domains]
+
+    def listDomainsID(self):
+        self.calls['listDomainsID'] += 1
+        return [d.id for d in self.domains if d.state == 1]
+
+    def listDefinedDomains(self):
+        self.calls['listDefinedDomains'] += 1
+        return [d.name() for d in self.domains if d.state != 1]
+
+    def lookupByID(self, id):
+        self.calls['lookupByID'] += 1
+        return self.domains[id]
+
+    def lookupByName(self, name):
+        self.calls['lookupByName'] += 1
+        for domain in self.domains:
+            if domain.name() == name:
+                return domain
+        raise libvirtError('no domain %s' % name, VIR_ERR_NO_DOMAIN)
+
+
+def fake_libvirt(conn):
+    libvirt = types.ModuleType('libvirt')
+    libvirt.__dict__.update(
+        libvirtError=libvirtError, open=lambda uri: conn,
+        VIR_ERR_NO_SUPPORT=VIR_ERR_NO_SUPPORT,
+        VIR_ERR_NO_DOMAIN=VIR_ERR_NO_DOMAIN,
+        VIR_CONNECT_LIST_DOMAINS_AUTOSTART=VIR_CONNECT_LIST_DOMAINS_AUTOSTART,
+        VIR_DOMAIN_STATS_STATE=1, VIR_DOMAIN_STATS_CPU_TOTAL=2,
+        VIR_DOMAIN_STATS_BALLOON=4, VIR_DOMAIN_STATS_VCPU=8)
+    return libvirt
+
+
+@pytest.fixture(params=['yes', 'no', 'daemon'])
+def conn(request):
+    return FakeConnection(request.param)
+
+
+@pytest.fixture
+def virt(conn):
+    namespace = load_module('virt')
+    namespace.update(libvirt=fake_libvirt(conn), HAS_VIRT=True)
+    return namespace
+
+
+def run(virt, **params):
+    result = run_module(virt, **params)
+    assert not result.failed, result.result
+    return result.result
+
+
+def test_list_vms(virt, conn):
+    result = run(virt, command='list_vms')
+    assert sorted(result['list_vms']) == ['vm0', 'vm1', 'vm2', 'vm3']
+    if conn.bulk == 'yes':
+        assert conn.calls == {'listAllDomains': 1}
+    else:
+        # the running domains by id, the others by name
+        assert conn.calls['listDomainsID'] == 1
+        assert conn.calls['lookupByID'] == 2
+        assert conn.calls['listDefinedDomains'] == 1
+        assert conn.calls['lookupByName'] == 2
+        assert conn.calls['info'] == 0
+
+
+def test_list_vms_by_state(virt, conn):
+    result = run(virt, command='list_vms', state='running')
+    assert sorted(result['list_vms']) == ['vm0', 'vm2']
+    if conn.bulk == 'yes':
+        assert conn.calls == {'getAllDomainStats': 1}
+    else:
+        assert conn.calls['info'] == 4
+
+
+def test_info(virt, conn):
+    result = run(virt, command='info')
+    assert sorted(result) == ['vm0', 'vm1', 'vm2', 'vm3']
+    assert result['vm0'] == {'state': 'running', 'maxMem': '2048',
+                             'memory': '1024', 'nrVirtCpu': 2,
+                             'cpuTime': '99', 'autostart': 1}
+    assert result['vm1']['state'] == 'shutdown'
+    assert result['vm1']['autostart'] == 0
+    if conn.bulk == 'yes':
+        assert conn.calls == {'getAllDomainStats': 1, 'listAllDomains': 1}
+    else:
+        assert conn.calls['info'] == 4
+        assert conn.calls['autostart'] == 4
+
+
+def test_status_of_guests(virt, conn):
+    result = run(virt, command='status', name=['vm0', 'vm1', 'vm2'], jobs=2)
+    assert result['results'] == {'vm0': {'status': 'running'},
+                                 'vm1': {'status': 'shutdown'},
+                                 'vm2': {'status': 'running'}}
+    assert conn.calls == {'lookupByName': 3, 'info': 3}
+
+
+def test_state_of_guests(virt, conn):
+    result = run(virt, state='shutdown', name=['vm0', 'vm1', 'vm2'])
+    assert result['changed']
+    assert conn.calls['shutdown'] == 2
+    assert conn.calls['info'] == 3
+
+
+def test_other_libvirt_errors_fail(virt, conn):
+    if conn.bulk == 'no':
+        pytest.skip('no bulk call to fail')
+    conn.error = VIR_ERR_INTERNAL_ERROR
+    result = run_module(virt, command='info')
+    assert result.failed
+    assert result.result['msg'] == 'internal error'
+    assert conn.calls['info'] == 0
@@ -0,0 +1,178 @@
+"""
+Tests of library/wait_for_ssh against a local TCP server standing in for
+sshd, and a stand-in ssh command logging its runs.
+
+Usage:
+    py.test test_wait_for_ssh.py [options]
+"""
+
+import os
+import socket
+import threading
+import time
+import pytest
+
+from helpers import load_module, run_module
+
+BANNER = 'SSH-2.0-OpenSSH_7.4\r\n'
+FAKE_SSH = '''#!/bin/sh
+echo "$@" >> %s
+echo 'boottime=1000'
+'''
+
+
+class Sshd(object):
+    """ Listens on a port of 127.0.0.x from `up_after` seconds on, sends
+        `banner` (None for no banner) `banner_delay` seconds after a
+        connection is accepted. The port refuses connections until then. """
+
+    def __init__(self, banner=BANNER, banner_delay=0.0, up_after=0.0):
+        self.banner = banner
+        self.banner_delay = banner_delay
+        self.up_after = up_after
+        self.connections = []
+        self.stopped = threading.Event()
+        # a free port, refusing connections until listened on
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+
+    def _listen(self):
+        listener = socket.socket()
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('', self.port))
+        listener.listen(16)
+        listener.settimeout(0.05)
+        return listener
+
+    def _serve(self, listener):
+        if listener is None:
+            if self.stopped.wait(self.up_after):
+                return
+            listener = self._listen()
+        while not self.stopped.is_set():
+            try:
+                conn, _ = listener.accept()
+            except socket.timeout:
+                continue
+            self.connections.append(conn)
+            thread = threading.Thread(target=self._greet, args=(conn,))
+            thread.daemon = True
+            thread.start()
+        listener.close()
+
+    def _greet(self, conn):
+        if self.banner is not None and not self.stopped.wait(
+                self.banner_delay):
+            conn.sendall(self.banner)
+
+    def __enter__(self):
+        listener = None if self.up_after else self._listen()
+        self.thread = threading.Thread(target=self._serve, args=(listener,))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        for conn in self.connections:
+            conn.close()
+
+
+@pytest.fixture
+def ssh_log(tmpdir, monkeypatch):
+    """ The runs of the stand-in ssh command, put first in PATH """
+    log = tmpdir.join('ssh.log')
+    ssh = tmpdir.join('ssh')
+    ssh.write(FAKE_SSH % log)
+    ssh.chmod(0755)
+    monkeypatch.setenv('PATH', '%s:%s' % (tmpdir, os.environ['PATH']))
+    return log
+
+
+@pytest.fixture
+def wait_for_ssh(ssh_log):
+    return load_module('wait_for_ssh')
+
+
+def run(wait_for_ssh, sshd, **params):
+    params = dict(dict(host='127.0.0.1', port=sshd.port, timeout=5,
+                       conntimeout=2, delay=0.1, min_reached_count=2),
+                  **params)
+    start = time.time()
+    with sshd:
+        result = run_module(wait_for_ssh, **params)
+    return result, time.time() - start
+
+
+def ssh_runs(ssh_log):
+    return len(ssh_log.readlines()) if ssh_log.check() else 0
+
+
+def test_late_banner(wait_for_ssh, ssh_log):
+    result, took = run(wait_for_ssh, Sshd(banner_delay=0.5))
+    assert not result.failed, result.result
+    assert result.result['rc'] == 0
+    assert result.result['attempts'] == 2
+    assert not result.result['changed']
+    # ssh runs only after each banner
+    assert ssh_runs(ssh_log) == 2
+    assert took >= 1.0
+
+
+def test_no_banner_times_out(wait_for_ssh, ssh_log):
+    result, took = run(wait_for_ssh, Sshd(banner=None), timeout=2,
+                       conntimeout=1)
+    assert result.failed
+    assert result.result['rc'] == 1
+    assert 'timed out' in result.result['stderr']
+    assert 'with exit code 255' in result.result['msg']
+    # each connection waits the conntimeout for its banner
+    assert 2 <= result.result['attempts'] <= 3
+    assert ssh_runs(ssh_log) == 0
+    assert took < 4
+
+
+def test_not_ssh(wait_for_ssh, ssh_log):
+    result, took = run(wait_for_ssh, Sshd(banner='HTTP/1.1 400 Bad\r\n'),
+                       timeout=1)
+    assert result.failed
+    assert "no SSH banner: 'HTTP/1.1 400" in result.result['stderr']
+    assert ssh_runs(ssh_log) == 0
+
+
+def test_refused_times_out(wait_for_ssh, ssh_log):
+    result, took = run(wait_for_ssh, Sshd(up_after=60), timeout=1,
+                       delay=0.2)
+    assert result.failed
+    assert result.result['rc'] == 1
+    assert 'Connection refused' in result.result['stderr']
+    # refusals are immediate, attempts are only spaced by the delay
+    assert result.result['attempts'] >= 4
+    assert ssh_runs(ssh_log) == 0
+    assert took < 2
+
+
+def test_refused_then_reached(wait_for_ssh, ssh_log):
+    result, took = run(wait_for_ssh, Sshd(up_after=1.0), delay=0.2)
+    assert not result.failed, result.result
+    assert result.result['rc'] == 0
+    assert result.result['changed']
+    assert result.result['attempts'] >= 4
+    assert ssh_runs(ssh_log) == 2
+    assert 1.0 <= took < 3
+
+
+def test_hosts(wait_for_ssh, ssh_log):
+    with Sshd(banner_delay=0.2) as sshd:
+        result = run_module(wait_for_ssh, hosts=['127.0.0.1', '127.0.0.2'],
+                            port=sshd.port, delay=0.1, timeout=5,
+                            min_reached_count=1)
+    assert not result.failed, result.result
+    hosts = result.result['hosts']
+    assert sorted(hosts) == ['127.0.0.1', '127.0.0.2']
+    assert all(host['rc'] == 0 and host['attempts'] == 1
+               for host in hosts.values())
+    assert ssh_runs(ssh_log) == 2
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of the hostvars_* filters (plugins/filters/hostvars.py)
+against the equivalent Jinja loops used in our playbooks.
+
+usage: bench_hostvars_filters.py [nodes] [repeat]
+"""
+
+from __future__ import print_function
+
+import imp
+import os
+import sys
+import timeit
+
+import jinja2
+
+FILTERS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, 'plugins', 'filters', 'hostvars.py')
+FACT = 'ansible_memory_mb.real.total'
+
+JINJA_LOOPS = {
+    'sum': """{% set values = [] %}{% for node in nodes %}
+{% if hostvars[node].ansible_memory_mb is defined %}
+{% if values.append(hostvars[node].ansible_memory_mb.real.total) %}
+{% endif %}{% endif %}{% endfor %}{{ values | sum }}""",
+    'max': """{% set values = [] %}{% for node in nodes %}
+{% if hostvars[node].ansible_memory_mb is defined %}
+{% if values.append(hostvars[node].ansible_memory_mb.real.total) %}
+{% endif %}{% endif %}{% endfor %}{{ values | max }}""",
+    'histogram': """{% set hist = {} %}{% for node in nodes %}
+{% set distro = hostvars[node].ansible_distribution %}
+{% if hist.update({distro: hist.get(distro, 0) + 1}) %}
+{% endif %}{% endfor %}{{ hist }}""",
+}
+
+FILTER_CALLS = {
+    'sum': "{{ hostvars | hostvars_sum(nodes, '%s') }}" % FACT,
+    'max': "{{ hostvars | hostvars_max(nodes, '%s') }}" % FACT,
+    'histogram': ("{{ hostvars | hostvars_histogram(nodes,"
+                  " 'ansible_distribution') }}"),
+}
+
+
+def fake_hostvars(count):
+    hostvars = {}
+    for index in range(count):
+        node = 'node%d' % index
+        hostvars[node] = {
+            'ansible_distribution': ('RedHat', 'CentOS', 'Fedora')[index % 3],
+        }
+        # some nodes have no facts gathered
+        if index % 10:
+            hostvars[node]['ansible_memory_mb'] = {
+                'real': {'total': 1024 * (index % 16 + 1)}}
+    return hostvars
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    hostvars_filters = imp.load_source('hostvars_filters', FILTERS_FILE)
+    env = jinja2.Environment()
+    env.filters.update(hostvars_filters.FilterModule().filters())
+
+    hostvars = fake_hostvars(count)
+    variables = {'hostvars': hostvars, 'nodes': sorted(hostvars)}
+
+    print('%d nodes, %d renders each' % (count, repeat))
+    for name in sorted(JINJA_LOOPS):
+        loop = env.from_string(JINJA_LOOPS[name])
+        call = env.from_string(FILTER_CALLS[name])
+        assert loop.render(variables).strip() == call.render(variables), name
+
+        loop_time = timeit.timeit(lambda: loop.render(variables),
+                                  number=repeat)
+        call_time = timeit.timeit(lambda: call.render(variables),
+                                  number=repeat)
+        print('%-10s jinja loop: %8.2f ms  filter: %8.2f ms  (%.1fx)' % (
+            name, loop_time * 1000 / repeat, call_time * 1000 / repeat,
+            loop_time / call_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+#!/bin/sh
+# Ansible 1.x modules can't share code, so the code used by several of our
+# modules is repeated in each of them, between "# BEGIN <block>" and
+# "# END <block>" lines. Checks that the copies are identical to the one of
+# the reference module, which is the one to edit before copying it over the
+# others.
+cd "$(dirname "$0")/.."
+
+block() {
+    sed -n "/^# BEGIN $1\$/,/^# END $1\$/p" "$2"
+}
+
+status=0
+check() {
+    name=$1
+    reference=$2
+    block "$name" $reference > /tmp/module_block.$$
+    for module in $(grep -l "^# BEGIN $name\$" library/*.py); do
+        if ! block "$name" $module | diff -u /tmp/module_block.$$ - ; then
+            echo "$module: $name block differs from $reference"
+            status=1
+        fi
+    done
+    rm -f /tmp/module_block.$$
+}
+
+check "keystone cache" library/quantum_network.py
+check "polling" library/nova_compute.py
+check "stack watch" library/heat_stack.py
+exit $status
@@ -1,5 +1,5 @@
 from configure import Configuration, ConfigurationError
-from ksgen import docstring, yaml_utils, utils
+from ksgen import docstring, yaml_utils, utils, workarounds
 from ksgen.tree import OrderedTree
 from ksgen.yaml_utils import LookupDirective
 from docopt import docopt, DocoptExit
@@ -76,6 +76,7 @@ Options:
         self.all_settings = loader.settings()
 
         self._replace_in_string_lookup()
+        self._add_workarounds_registry()
 
         logger.debug(yaml_utils.to_yaml("All Settings", self.all_settings))
         logger.info("Writing to file: %s", self.output_file)
@@ -318,6 +319,20 @@ Options:
                                                       lookup_value, value)
                         value = sub_lookup_dict[key]
 
+    def _add_workarounds_registry(self):
+        """
+        Precompile the enabled workarounds for the `bug` filter plugin
+        """
+        try:
+            settings = self.all_settings['workarounds']
+        except KeyError:
+            return
+        if not isinstance(settings, dict):
+            return
+        self.all_settings[workarounds.REGISTRY_KEY] = \
+            workarounds.registry(settings)
+
+
 class Loader(object):
     def __init__(self, config_dir, settings):
         self._settings = settings
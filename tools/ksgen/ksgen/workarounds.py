@@ -0,0 +1,63 @@
+"""
+Precompiled registry of the workarounds enabled in the generated settings,
+so that the `bug` filter plugin doesn't need to evaluate every workaround
+entry on every task of every host.
+"""
+
+from collections import OrderedDict
+import logging
+import re
+
+
+REGISTRY_KEY = 'workarounds_registry'
+REGISTRY_VERSION = 1
+# same values as accepted by ansible.utils.boolean used in the filter plugin
+TRUE_VALUES = ("true", "t", "y", "1", "yes")
+logger = logging.getLogger(__name__)
+
+
+def is_enabled(entry):
+    """
+    returns True if the workaround entry is a mapping with 'enabled' set
+    """
+    if not isinstance(entry, dict):
+        return False
+    return str(entry.get('enabled', False)).lower() in TRUE_VALUES
+
+
+def group_of(bug_id):
+    """
+    returns the bug tracker part of the bug id, e.g. 'rhbz' for 'rhbz1234'
+    """
+    match = re.match('[a-zA-Z_]*', str(bug_id))
+    return match.group(0).lower()
+
+
+def registry(workarounds):
+    """
+    Compiles the workarounds settings into a registry of
+
+        version: format version of the registry
+        ids:     sorted ids of all workarounds
+        enabled: sorted ids of the enabled workarounds
+        groups:  bitmap per bug tracker group, bit N is set when ids[N]
+                 is enabled
+    """
+    ids = sorted(str(k) for k, v in workarounds.iteritems()
+                 if isinstance(v, dict))
+    enabled = []
+    groups = OrderedDict()
+    for index, bug_id in enumerate(ids):
+        group = group_of(bug_id)
+        groups.setdefault(group, 0)
+        if is_enabled(workarounds[bug_id]):
+            enabled.append(bug_id)
+            groups[group] |= 1 << index
+
+    logger.debug("Workarounds enabled: %s of %s", len(enabled), len(ids))
+    return OrderedDict([
+        ('version', REGISTRY_VERSION),
+        ('ids', ids),
+        ('enabled', enabled),
+        ('groups', groups),
+    ])
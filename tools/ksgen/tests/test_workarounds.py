@@ -0,0 +1,50 @@
+"""
+Usage:
+    python test_workarounds.py <method_name>
+    py.test test_workarounds.py [options]
+"""
+
+from test_utils import main
+from ksgen import workarounds
+
+
+def test_is_enabled():
+    assert workarounds.is_enabled({'enabled': True})
+    assert workarounds.is_enabled({'enabled': 'yes'})
+    assert not workarounds.is_enabled({'enabled': False})
+    assert not workarounds.is_enabled({'desc': 'no enabled key'})
+    assert not workarounds.is_enabled(True)
+
+
+def test_group_of():
+    assert workarounds.group_of('rhbz1138740') == 'rhbz'
+    assert workarounds.group_of('lp1234') == 'lp'
+    assert workarounds.group_of('1234') == ''
+
+
+def test_registry():
+    settings = {
+        'rhbz2': {'enabled': True},
+        'rhbz1': {'enabled': False},
+        'lp3': {'enabled': 'true'},
+        'rhbz4': {'enabled': True},
+        'enabled': True,   # global flag, not a workaround
+    }
+    registry = workarounds.registry(settings)
+
+    assert registry['version'] == workarounds.REGISTRY_VERSION
+    assert registry['ids'] == ['lp3', 'rhbz1', 'rhbz2', 'rhbz4']
+    assert registry['enabled'] == ['lp3', 'rhbz2', 'rhbz4']
+    assert registry['groups']['lp'] == 0b0001
+    assert registry['groups']['rhbz'] == 0b1100
+
+
+def test_registry_empty():
+    registry = workarounds.registry({})
+    assert registry['ids'] == []
+    assert registry['enabled'] == []
+    assert registry['groups'] == {}
+
+
+if __name__ == '__main__':
+    main(locals())
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+"""
+Replays callback events recorded by plugins/hacking/callback_recorder.py
+into callback plugins at full speed, reporting throughput and memory of
+each plugin. Every plugin is replayed in its own forked process.
+
+usage:
+    replay_callbacks.py replay RECORDING PLUGIN [PLUGIN ...]
+    replay_callbacks.py generate [--hosts N] [--tasks N] RECORDING
+
+'generate' writes a synthetic recording, so the plugins can be measured
+without recording a real run first. Recordings ending with .gz are
+read and written gzip compressed.
+"""
+
+from __future__ import print_function
+
+import argparse
+import gzip
+import imp
+import json
+import os
+import resource
+import sys
+import time
+
+STATS_KEY = '__stats__'
+# events are decoded in chunks, decoding isn't measured
+CHUNK_SIZE = 10000
+
+
+class ReplayStats(object):
+    """ stand-in for ansible.callbacks.AggregateStats """
+
+    def __init__(self, processed, failures, ok, dark, changed, skipped):
+        self.processed = processed
+        self.failures = failures
+        self.ok = ok
+        self.dark = dark
+        self.changed = changed
+        self.skipped = skipped
+
+    def summarize(self, host):
+        return dict(
+            ok=self.ok.get(host, 0),
+            failures=self.failures.get(host, 0),
+            unreachable=self.dark.get(host, 0),
+            changed=self.changed.get(host, 0),
+            skipped=self.skipped.get(host, 0)
+        )
+
+
+def _decode(obj):
+    if STATS_KEY in obj:
+        return ReplayStats(**obj[STATS_KEY])
+    return obj
+
+
+def open_recording(path, mode='r'):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 'b')
+    return open(path, mode)
+
+
+def read_chunks(path):
+    """ yields lists of (method, args, kwargs) """
+    chunk = []
+    with open_recording(path) as f:
+        for line in f:
+            _, method, args, kwargs = json.loads(line, object_hook=_decode)
+            chunk.append((method, args,
+                          dict((str(k), v) for k, v in kwargs.iteritems())))
+            if len(chunk) == CHUNK_SIZE:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def replay(recording, plugin_path, show_output=False):
+    """ returns dict with the number of events, time and memory used """
+    name = os.path.splitext(os.path.basename(plugin_path))[0]
+    module = imp.load_source('replayed_' + name, plugin_path)
+
+    stdout = sys.stdout
+    if not show_output:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        rss_start = None
+        callback = module.CallbackModule()
+        events = 0
+        elapsed = 0.0
+        for chunk in read_chunks(recording):
+            if rss_start is None:
+                # don't account the decoded chunk to the plugin
+                rss_start = resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss
+            start = time.time()
+            for method, args, kwargs in chunk:
+                # same dispatching as ansible.callbacks.call_callback_module,
+                # a plugin that set self.disabled to True is not called
+                if getattr(callback, 'disabled', False):
+                    continue
+                for fn in (getattr(callback, method, None),
+                           getattr(callback, 'on_any', None)):
+                    if fn is not None:
+                        fn(*args, **kwargs)
+            elapsed += time.time() - start
+            events += len(chunk)
+        disabled = bool(getattr(callback, 'disabled', False))
+        start = time.time()
+        del callback   # plugins like timing report from __del__
+        elapsed += time.time() - start
+        rss_end = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        rss_start = rss_start or rss_end
+    finally:
+        if not show_output:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    return {
+        'plugin': plugin_path,
+        'events': events,
+        'seconds': elapsed,
+        'events_per_second': events / elapsed if elapsed else None,
+        'max_rss_growth_kb': rss_end - rss_start,
+        'disabled': disabled,
+    }
+
+
+def replay_in_child(recording, plugin_path, show_output=False):
+    """ replay in a forked process, so plugins don't affect each other """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            result = replay(recording, plugin_path, show_output)
+        except Exception as e:
+            result = {'plugin': plugin_path, 'error': repr(e)}
+        with os.fdopen(write_fd, 'w') as f:
+            json.dump(result, f)
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        result = json.load(f)
+    os.waitpid(pid, 0)
+    return result
+
+
+def generate(recording, hosts, tasks):
+    """ writes synthetic recording of a play of `tasks` on `hosts` """
+    host_names = ['host%d' % i for i in range(hosts)]
+    stats = dict((field, {}) for field in ('processed', 'failures', 'ok',
+                                           'dark', 'changed', 'skipped'))
+    clock = [0.0]
+
+    def event(f, method, *args, **kwargs):
+        clock[0] += 0.001
+        f.write(json.dumps([round(clock[0], 6), method, args, kwargs],
+                           separators=(',', ':')) + '\n')
+
+    with open_recording(recording, 'w') as f:
+        event(f, 'playbook_on_start')
+        event(f, 'playbook_on_play_start', 'synthetic play')
+        for task in range(tasks):
+            event(f, 'playbook_on_task_start', 'task %d' % task, False)
+            for index, host in enumerate(host_names):
+                stats['processed'][host] = 1
+                kind = (task + index) % 20
+                if kind == 0:
+                    event(f, 'runner_on_skipped', host, item=None)
+                    counter = 'skipped'
+                else:
+                    res = {
+                        'changed': kind % 3 == 0,
+                        'cmd': 'echo task %d' % task,
+                        'rc': 0,
+                        'start': '2016-01-01 00:00:00.000000',
+                        'end': '2016-01-01 00:00:01.000000',
+                        'delta': '0:00:01.000000',
+                        'stdout': 'task %d output on %s' % (task, host),
+                        'stderr': '',
+                        'invocation': {'module_name': 'shell',
+                                       'module_args': 'echo task %d' % task},
+                    }
+                    event(f, 'runner_on_ok', host, res)
+                    counter = 'ok'
+                    if res['changed']:
+                        stats['changed'][host] = \
+                            stats['changed'].get(host, 0) + 1
+                stats[counter][host] = stats[counter].get(host, 0) + 1
+        event(f, 'playbook_on_stats', {STATS_KEY: stats})
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Replay recorded callback events into callback plugins.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    replay_parser = subparsers.add_parser(
+        'replay', help='replay recording into callback plugins')
+    replay_parser.add_argument('recording')
+    replay_parser.add_argument('plugins', nargs='+', metavar='plugin',
+                               help='path to callback plugin file')
+    replay_parser.add_argument('--show-output', action='store_true',
+                               help="don't hide output of the plugins")
+    replay_parser.add_argument('--json', action='store_true',
+                               help='print results as JSON')
+
+    generate_parser = subparsers.add_parser(
+        'generate', help='write a synthetic recording')
+    generate_parser.add_argument('recording')
+    generate_parser.add_argument('--hosts', type=int, default=500)
+    generate_parser.add_argument('--tasks', type=int, default=2000)
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.command == 'generate':
+        generate(args.recording, args.hosts, args.tasks)
+        return 0
+
+    results = [replay_in_child(args.recording, plugin, args.show_output)
+               for plugin in args.plugins]
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return 0
+
+    for result in results:
+        if 'error' in result:
+            print('%-40s ERROR: %s' % (result['plugin'], result['error']))
+            continue
+        if result['disabled']:
+            print('%-40s disabled, not called' % result['plugin'])
+            continue
+        print('%-40s %9d events %8.2fs %10.0f events/s %8d KB max RSS growth'
+              % (result['plugin'], result['events'], result['seconds'],
+                 result['events_per_second'] or 0,
+                 result['max_rss_growth_kb']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
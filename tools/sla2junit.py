@@ -1,8 +1,3 @@
-
-import json
-import sys
-from xml.etree import ElementTree
-
 """
 this script converts rally sla from JSON format to JUnit xml file
 
@@ -11,63 +6,182 @@ this script converts rally sla from JSON format to JUnit xml file
     - sla2 - PASS/FAIL
 - BenchmarkScenario2
     - sla3 - PASS/FAIL
-"""
 
+usage: sla2junit.py INPUT [INPUT ...] OUTPUT
 
-def json2dict(json_sla):
-    with open(json_sla) as js:
-        data = json.load(js)
-
-    tests = {}
-
-    for sla in data:
-        scenario = sla["benchmark"]
-        tests.setdefault(scenario, {"status": True, "tests": {}})
-        sla_status = sla["status"]
-        tests[scenario]["status"] = (tests[scenario]["status"] and
-                                     sla_status.lower() == "passed")
-        tests[scenario]["tests"][sla["criterion"]] = dict(
-            status=sla_status,
-            detail=sla["detail"],
-            pos=sla["pos"]
-        )
-    return tests
-
-
-def dict2xml(tests):
-    testsuite = ElementTree.Element("testsuite")
-    for scenario, sdict in tests.iteritems():
-        criteria = sdict["tests"]
-        suit_status = "passed" if sdict["status"] else "failed"
-        # suite = ElementTree.SubElement(testsuite, "suite",
-        #                                attrib=dict(
-        #                                    # status=suit_status,
-        #                                    name=scenario))
-        for name, sla_results in criteria.iteritems():
-            # JSON has "PASS/FAIL" and we need "passed/failed"
-            test_status = sla_results["status"].lower() + "ed"
-            test = ElementTree.SubElement(testsuite, "testcase",
-                                          attrib=dict(
-                                              classname=scenario,
-                                              # status=sla_results["status"],
-                                              name=name,
-                                              pos=str(sla_results["pos"])))
-            if not test_status == "passed":
-                fail = ElementTree.SubElement(test, "failure")
-            test.text = sla_results["detail"]
-
-    return testsuite
+The inputs are the output of 'rally task sla_check --json' or of 'rally
+task results'. With the results, the testcases of a scenario also get its
+load duration as time and the statistics of its iterations as properties.
+The testcases of all the inputs are merged in one testsuite.
+
+The inputs are decoded one scenario at a time and the testcases are
+written as they are read (to a temporary file, the totals of the
+testsuite go first), so big rally runs are converted in constant memory.
+"""
+
+import io
+import json
+import math
+import shutil
+import sys
+import tempfile
+from xml.etree import ElementTree
+from xml.sax.saxutils import quoteattr
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = ' \t\n\r'
+
+
+def iter_json_array(fileobj):
+    """ Yields the items of the JSON array in the file one by one, only the
+        item being decoded is kept in memory """
+    decoder = json.JSONDecoder()
+    buf, pos, eof = u'', 0, False
+    # '[', then an item or ']', then ',' or ']', then an item after ','
+    expect = '['
+    while True:
+        while pos < len(buf) and buf[pos] in WHITESPACE:
+            pos += 1
+        if pos == len(buf):
+            if eof:
+                raise ValueError('unexpected end of the JSON array')
+            buf, pos = fileobj.read(CHUNK_SIZE), 0
+            eof = not buf
+            continue
+        char = buf[pos]
+        if expect == '[':
+            if char != '[':
+                raise ValueError('expected a JSON array, found %r' % char)
+            pos += 1
+            expect = 'first'
+            continue
+        if char == ']' and expect in ('first', ','):
+            return
+        if expect == ',':
+            if char != ',':
+                raise ValueError('expected "," or "]", found %r' % char)
+            pos += 1
+            expect = 'item'
+            continue
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            end = None
+        # a number cut at the end of the buffer is decoded too early
+        if end is None or (end == len(buf) and not eof):
+            if eof:
+                raise ValueError('invalid JSON item at %r' % buf[pos:pos + 40])
+            # the read grows with the item, so it is decoded in linear time
+            more = fileobj.read(max(CHUNK_SIZE, len(buf) - pos))
+            buf, pos, eof = buf[pos:] + more, 0, not more
+            continue
+        yield item
+        pos = end
+        expect = ','
+
+
+def percentile(values, percent):
+    """ The percentile of the sorted values, interpolated like rally """
+    if not values:
+        return None
+    k = (len(values) - 1) * percent
+    f, c = math.floor(k), math.ceil(k)
+    if f == c:
+        return values[int(k)]
+    return values[int(f)] * (c - k) + values[int(c)] * (k - f)
+
+
+def iteration_stats(iterations):
+    """ Statistics of the durations of the successful iterations """
+    durations = sorted(it["duration"] for it in iterations
+                       if not it.get("error"))
+    stats = dict(iterations=len(iterations),
+                 failed_iterations=len(iterations) - len(durations))
+    if durations:
+        stats.update(duration_min=durations[0],
+                     duration_avg=sum(durations) / len(durations),
+                     duration_p95=percentile(durations, 0.95),
+                     duration_max=durations[-1])
+    return stats
+
+
+def iter_slas(item):
+    """ Yields (scenario, pos, criterion, passed, detail, time, stats) of
+        the SLA criteria of a sla_check or results item """
+    if "benchmark" in item:
+        # rally task sla_check --json
+        yield (item["benchmark"], item["pos"], item["criterion"],
+               item["status"].lower() == "pass", item["detail"], None, {})
+        return
+    # rally task results
+    key = item["key"]
+    iterations = item.get("result", [])
+    stats = iteration_stats(iterations)
+    for name in ("load_duration", "full_duration"):
+        if name in item:
+            stats[name] = item[name]
+    duration = item.get("load_duration")
+    if duration is None:
+        duration = sum(it["duration"] for it in iterations)
+    for sla in item.get("sla", []):
+        yield (key["name"], key["pos"], sla["criterion"], sla["success"],
+               sla["detail"], duration, stats)
+
+
+def testcase(scenario, pos, criterion, passed, detail, time, stats):
+    test = ElementTree.Element("testcase",
+                               attrib=dict(classname=scenario,
+                                           name=criterion,
+                                           pos=str(pos)))
+    if time is not None:
+        test.set("time", "%.3f" % time)
+    if stats:
+        properties = ElementTree.SubElement(test, "properties")
+        for name in sorted(stats):
+            value = stats[name]
+            if isinstance(value, float):
+                value = "%.3f" % value
+            ElementTree.SubElement(properties, "property",
+                                   attrib=dict(name=name, value=str(value)))
+    if not passed:
+        ElementTree.SubElement(test, "failure", attrib=dict(message=detail))
+    test.text = detail
+    return test
+
+
+def convert(inputs, output):
+    totals = dict(tests=0, failures=0, time=0.0)
+    with tempfile.TemporaryFile() as spool:
+        for path in inputs:
+            with io.open(path, encoding="utf-8") as js:
+                for item in iter_json_array(js):
+                    time = None
+                    for sla in iter_slas(item):
+                        passed, time = sla[3], sla[5]
+                        spool.write(ElementTree.tostring(testcase(*sla)))
+                        spool.write(b"\n")
+                        totals["tests"] += 1
+                        totals["failures"] += not passed
+                    # the criteria of a scenario share its duration
+                    if time is not None:
+                        totals["time"] += time
+        spool.seek(0)
+        with open(output, "wb") as xml:
+            xml.write(('<testsuite name="rally" tests=%s failures=%s '
+                       'errors="0" time=%s>\n' % (
+                           quoteattr(str(totals["tests"])),
+                           quoteattr(str(totals["failures"])),
+                           quoteattr("%.3f" % totals["time"]))).encode("ascii"))
+            shutil.copyfileobj(spool, xml)
+            xml.write(b"</testsuite>\n")
+    return totals
 
 
 def main():
-    tests = json2dict(sys.argv[1])
-    xml = ElementTree.ElementTree(dict2xml(tests))
-    xml.write(sys.argv[2])
-    # xml.write(sys.argv[2], encoding="UTF-8", xml_declaration=True)
+    if len(sys.argv) < 3:
+        sys.exit(__doc__)
+    convert(sys.argv[1:-1], sys.argv[-1])
 
 
 if __name__ == '__main__':
     sys.exit(main())
-
-
-
@@ -95,6 +95,7 @@ library = ./library:$VIRTUAL_ENV/share/ansible/
 ssh_args =  -F ssh.config.ansible
 pipelining=True
 callback_plugins = plugins/callbacks/
+action_plugins = plugins/actions/
 EOF
     fi
     popd